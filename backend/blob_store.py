@@ -0,0 +1,351 @@
+"""
+Armazenamento dos conteúdos pesados das tasks (DANFSe, XML da NFS-e, retorno bruto da SEFIN).
+
+Cada conteúdo é endereçado pelo SHA-256 dos bytes originais e gravado uma única vez; a task
+guarda só a referência ({"sha256", "tamanho", "gzip"}) no campo "<campo>_ref". Textos (XML,
+JSON de retorno) são gravados com gzip; PDFs vão em binário, sem o Base64.
+
+Backends (BLOB_STORE):
+  - "gridfs" (padrão): bucket "blobs" no próprio MongoDB;
+  - "fs": arquivos em BLOB_DIR/<2 primeiros hex>/<sha256>.
+
+Leitores devem usar texto_campo/pdf_campo, que aceitam tanto o campo inline antigo quanto a
+referência, para que tasks ainda não migradas continuem funcionando.
+
+Blobs sem nenhuma task apontando para eles (task descartada, falha entre gravar o blob e a
+task) são removidos por coletar_orfaos:
+
+    python -m backend.blob_store          # migra as tasks com conteúdo inline
+    python -m backend.blob_store orfaos   # remove blobs órfãos (mais antigos que BLOB_CARENCIA_HORAS)
+"""
+from datetime import datetime, timedelta
+from gridfs import GridFSBucket
+from typing import Iterator, Optional
+import base64
+import gzip
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import zlib
+
+BLOB_STORE = os.getenv("BLOB_STORE", "gridfs")
+BLOB_DIR = os.getenv("BLOB_DIR", os.path.join("uploads", "blobs"))
+BLOB_BUCKET = "blobs"
+TAMANHO_PEDACO = 64 * 1024
+# Blob recém-gravado pode ainda não ter a task atualizada: a coleta só remove os mais antigos
+BLOB_CARENCIA_HORAS = int(os.getenv("BLOB_CARENCIA_HORAS", "24"))
+
+# Campos de transmit que vão para o store (receipt.bruto é tratado à parte)
+CAMPOS_TRANSMIT_TEXTO = ("raw_response", "xml_nfse")
+
+# O XML assinado da DPS (response.xml) só vai para o store quando a nota não será mais enviada
+STATUS_DPS_NO_STORE = ("accepted", "canceled")
+
+# Onde as tasks guardam referências (usado pela coleta de órfãos)
+CAMPOS_REF = ("transmit.raw_response_ref", "transmit.xml_nfse_ref", "transmit.pdf_ref",
+              "transmit.receipt.bruto_ref", "response.xml_ref")
+
+log = logging.getLogger(__name__)
+
+
+# ------------------------------------------------
+# Backends
+# ------------------------------------------------
+def _caminho(sha: str) -> str:
+    return os.path.join(BLOB_DIR, sha[:2], sha)
+
+
+def _gravar(db, sha: str, dados: bytes):
+    if BLOB_STORE == "fs":
+        destino = _caminho(sha)
+        if os.path.exists(destino):
+            os.utime(destino)  # reaproveitado agora: a coleta de órfãos não pode levá-lo
+            return
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        # grava num temporário e renomeia: leitores nunca veem arquivo pela metade
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(destino))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(dados)
+            os.replace(tmp, destino)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return
+
+    reaproveitado = db[f"{BLOB_BUCKET}.files"].update_many({"filename": sha},
+                                                            {"$set": {"uploadDate": datetime.utcnow()}})
+    if reaproveitado.matched_count:
+        return
+    GridFSBucket(db, bucket_name=BLOB_BUCKET).upload_from_stream(sha, dados)
+
+
+def _pedacos_gravados(db, sha: str) -> Iterator[bytes]:
+    if BLOB_STORE == "fs":
+        with open(_caminho(sha), "rb") as f:
+            while True:
+                pedaco = f.read(TAMANHO_PEDACO)
+                if not pedaco:
+                    return
+                yield pedaco
+
+    with GridFSBucket(db, bucket_name=BLOB_BUCKET).open_download_stream_by_name(sha) as stream:
+        while True:
+            pedaco = stream.read(TAMANHO_PEDACO)
+            if not pedaco:
+                return
+            yield pedaco
+
+
+# ------------------------------------------------
+# API
+# ------------------------------------------------
+def guardar(db, dados: bytes, comprimir: bool = False) -> dict:
+    """Grava os bytes (se ainda não existirem) e devolve a referência para a task."""
+    sha = hashlib.sha256(dados).hexdigest()
+    _gravar(db, sha, gzip.compress(dados, mtime=0) if comprimir else dados)
+    return {"sha256": sha, "tamanho": len(dados), "gzip": comprimir}
+
+
+def guardar_texto(db, texto: str) -> dict:
+    return guardar(db, texto.encode("utf-8"), comprimir=True)
+
+
+def guardar_pdf_base64(db, pdf_b64: str) -> dict:
+    return guardar(db, base64.b64decode(pdf_b64))
+
+
+def iterar(db, ref: dict) -> Iterator[bytes]:
+    """Conteúdo original em pedaços (já descomprimido), para StreamingResponse."""
+    pedacos = _pedacos_gravados(db, ref["sha256"])
+    if not ref.get("gzip"):
+        yield from pedacos
+        return
+    d = zlib.decompressobj(wbits=31)
+    for pedaco in pedacos:
+        saida = d.decompress(pedaco)
+        if saida:
+            yield saida
+    resto = d.flush()
+    if resto:
+        yield resto
+
+
+def ler(db, ref: dict) -> bytes:
+    return b"".join(iterar(db, ref))
+
+
+def existe(db, ref: dict) -> bool:
+    """O blob da referência está gravado? (para responder 404 antes de começar um stream)"""
+    if BLOB_STORE == "fs":
+        return os.path.exists(_caminho(ref["sha256"]))
+    return db[f"{BLOB_BUCKET}.files"].find_one({"filename": ref["sha256"]}, {"_id": 1}) is not None
+
+
+def texto_campo(db, container: Optional[dict], campo: str) -> Optional[str]:
+    """Valor textual de `campo`, seja inline (legado) ou via `<campo>_ref`."""
+    if not container:
+        return None
+    if container.get(campo):
+        return container[campo]
+    ref = container.get(f"{campo}_ref")
+    return ler(db, ref).decode("utf-8") if ref else None
+
+
+def pdf_campo(db, transmit: Optional[dict]) -> Optional[bytes]:
+    """Bytes do DANFSe da task (pdf_base64 inline legado ou pdf_ref)."""
+    if not transmit:
+        return None
+    if transmit.get("pdf_base64"):
+        return base64.b64decode(transmit["pdf_base64"])
+    ref = transmit.get("pdf_ref")
+    return ler(db, ref) if ref else None
+
+
+def descarregar_transmit(db, transmit: dict) -> dict:
+    """
+    Versão de transmit para gravar na task: PDF/XML/retorno bruto viram referências.
+    Campos vazios são simplesmente omitidos.
+    """
+    saida = dict(transmit)
+    for campo in CAMPOS_TRANSMIT_TEXTO:
+        valor = saida.pop(campo, None)
+        if valor:
+            saida[f"{campo}_ref"] = guardar_texto(db, valor)
+
+    pdf_b64 = saida.pop("pdf_base64", None)
+    if pdf_b64:
+        saida["pdf_ref"] = guardar_pdf_base64(db, pdf_b64)
+
+    receipt = saida.get("receipt")
+    if isinstance(receipt, dict) and receipt.get("bruto"):
+        receipt = dict(receipt)
+        receipt["bruto_ref"] = guardar_texto(db, receipt.pop("bruto"))
+        saida["receipt"] = receipt
+    return saida
+
+
+def descarregar_resultado(db, update_set: dict, xml_dps: Optional[str]) -> dict:
+    """
+    Monta o update final da transmissão (campos de update_set) com os conteúdos pesados
+    no store. Se a nota foi autorizada, o XML da DPS também sai da task.
+
+    Nunca levanta: se o store falhar (disco cheio, permissão, GridFS), o resultado vai
+    inline, como antes do store, e migrar_tasks o move depois. Uma nota já autorizada
+    pela SEFIN não pode perder a chave/XML por causa do armazenamento.
+    """
+    try:
+        saida = dict(update_set)
+        saida["transmit"] = descarregar_transmit(db, saida["transmit"])
+        update = {"$set": saida}
+        if saida.get("status") in STATUS_DPS_NO_STORE and xml_dps:
+            saida["response.xml_ref"] = guardar_texto(db, xml_dps)
+            update["$unset"] = {"response.xml": ""}
+        return update
+    except Exception:
+        log.exception("Falha gravando o resultado da transmissão no store '%s'; gravando inline na task",
+                      BLOB_STORE)
+        return {"$set": update_set}
+
+
+# ------------------------------------------------
+# Migração das tasks antigas
+# ------------------------------------------------
+FILTRO_TASKS_INLINE = {"$or": [
+    {"transmit.pdf_base64": {"$nin": [None, ""]}},
+    {"transmit.raw_response": {"$nin": [None, ""]}},
+    {"transmit.xml_nfse": {"$nin": [None, ""]}},
+    {"transmit.receipt.bruto": {"$nin": [None, ""]}},
+    {"status": {"$in": list(STATUS_DPS_NO_STORE)}, "response.xml": {"$nin": [None, ""]}},
+]}
+
+
+def migrar_tasks(db, lote: int = 200) -> int:
+    """
+    Move os conteúdos inline das tasks existentes para o store e retorna quantas foram migradas.
+    Percorre por _id crescente; pode ser interrompida e executada de novo.
+    """
+    projecao = {"status": 1, "transmit": 1, "response.xml": 1}
+    migradas = 0
+    ultimo = None
+    while True:
+        filtro = dict(FILTRO_TASKS_INLINE)
+        if ultimo is not None:
+            filtro["_id"] = {"$gt": ultimo}
+        tasks = list(db.tasks.find(filtro, projecao).sort("_id", 1).limit(lote))
+        if not tasks:
+            return migradas
+        ultimo = tasks[-1]["_id"]
+
+        for t in tasks:
+            try:
+                db.tasks.update_one({"_id": t["_id"]}, _update_migracao(db, t))
+                migradas += 1
+            except Exception as e:
+                log.warning("Falha migrando task %s para o store: %s", t["_id"], e)
+
+
+def _update_migracao(db, t: dict) -> dict:
+    tr = t.get("transmit") or {}
+    novo = descarregar_transmit(db, tr)
+    definir, remover = {}, {}
+
+    for campo in CAMPOS_TRANSMIT_TEXTO + ("pdf_base64",):
+        if campo in tr:
+            remover[f"transmit.{campo}"] = ""
+    for campo in CAMPOS_TRANSMIT_TEXTO + ("pdf",):
+        if f"{campo}_ref" in novo:
+            definir[f"transmit.{campo}_ref"] = novo[f"{campo}_ref"]
+    if "bruto_ref" in (novo.get("receipt") or {}):
+        definir["transmit.receipt.bruto_ref"] = novo["receipt"]["bruto_ref"]
+        remover["transmit.receipt.bruto"] = ""
+
+    # o XML da DPS só sai da task depois de autorizada (até lá o scheduler ainda o envia)
+    xml_dps = (t.get("response") or {}).get("xml")
+    if t.get("status") in STATUS_DPS_NO_STORE and xml_dps:
+        definir["response.xml_ref"] = guardar_texto(db, xml_dps)
+        remover["response.xml"] = ""
+
+    update = {}
+    if definir:
+        update["$set"] = definir
+    if remover:
+        update["$unset"] = remover
+    return update
+
+
+# ------------------------------------------------
+# Coleta de órfãos
+# ------------------------------------------------
+def _referenciados(db) -> set:
+    """SHA-256 de todos os blobs apontados por alguma task."""
+    shas = set()
+    filtro = {"$or": [{c: {"$exists": True}} for c in CAMPOS_REF]}
+    for t in db.tasks.find(filtro, {c: 1 for c in CAMPOS_REF}).batch_size(1000):
+        for campo in CAMPOS_REF:
+            valor = t
+            for parte in campo.split("."):
+                valor = valor.get(parte) if isinstance(valor, dict) else None
+            if isinstance(valor, dict) and valor.get("sha256"):
+                shas.add(valor["sha256"])
+    return shas
+
+
+def _gravados_antes(db, limite: datetime) -> Iterator[str]:
+    if BLOB_STORE == "fs":
+        for raiz, _, arquivos in os.walk(BLOB_DIR):
+            for nome in arquivos:
+                caminho = os.path.join(raiz, nome)
+                if len(nome) == 64 and datetime.utcfromtimestamp(os.path.getmtime(caminho)) < limite:
+                    yield nome
+        return
+    for f in db[f"{BLOB_BUCKET}.files"].find({"uploadDate": {"$lt": limite}}, {"filename": 1}):
+        yield f["filename"]
+
+
+def _remover(db, sha: str, limite: datetime):
+    """Remove o blob se ele continua mais antigo que o limite (não foi reaproveitado no meio da coleta)."""
+    if BLOB_STORE == "fs":
+        try:
+            if datetime.utcfromtimestamp(os.path.getmtime(_caminho(sha))) < limite:
+                os.remove(_caminho(sha))
+        except FileNotFoundError:
+            pass
+        return
+    bucket = GridFSBucket(db, bucket_name=BLOB_BUCKET)
+    for f in db[f"{BLOB_BUCKET}.files"].find({"filename": sha, "uploadDate": {"$lt": limite}}, {"_id": 1}):
+        bucket.delete(f["_id"])
+
+
+def coletar_orfaos(db, carencia_horas: int = BLOB_CARENCIA_HORAS, remover: bool = True) -> int:
+    """
+    Remove os blobs gravados há mais de carencia_horas que nenhuma task referencia e retorna
+    quantos eram órfãos (com remover=False só conta). A carência cobre o intervalo entre
+    gravar o blob e gravar a task que aponta para ele.
+    """
+    # o limite é fixado antes de ler as referências: blob mais novo que ele nunca é removido
+    limite = datetime.utcnow() - timedelta(hours=carencia_horas)
+    referenciados = _referenciados(db)
+    orfaos = 0
+    for sha in _gravados_antes(db, limite):
+        if sha in referenciados:
+            continue
+        orfaos += 1
+        if remover:
+            _remover(db, sha, limite)
+    return orfaos
+
+
+if __name__ == "__main__":
+    # python -m backend.blob_store [orfaos]  (na raiz do projeto)
+    from db import db as _db
+
+    if "orfaos" in sys.argv[1:]:
+        total = coletar_orfaos(_db)
+        print(f"{total} blobs órfãos removidos do store '{BLOB_STORE}'.")
+    else:
+        total = migrar_tasks(_db)
+        print(f"{total} tasks migradas para o store '{BLOB_STORE}'.")
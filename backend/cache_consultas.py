@@ -0,0 +1,131 @@
+"""
+Cache persistente das consultas externas de cadastro (CNPJ na ReceitaWS, CEP na ViaCEP, município no IBGE).
+
+Duas camadas: um LRU em memória na frente da collection 'cache_consultas'. Cada entrada
+guarda o resultado (ou o "não encontrado", com TTL próprio e menor), quando vence e até
+quando ainda pode ser servida vencida:
+
+  - dentro do TTL: devolvida direto, sem HTTP;
+  - vencida, mas dentro da janela de obsolescência: devolvida na hora e revalidada em
+    background (stale-while-revalidate), a menos que o chamador exija dado novo;
+  - fora da janela (ou ausente): consultada no provedor e gravada.
+
+Provedor indisponível (ProvedorIndisponivel) não é cacheado: devolve a entrada antiga, se
+houver, ou None. O índice TTL em 'remover_em' limpa a collection sozinho.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pymongo.errors import PyMongoError
+from backend.enriquecimento import ProvedorIndisponivel
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+# TTL de cada tipo de consulta (dias) e do "não encontrado" (horas)
+TTL_DIAS = {
+    "cnpj": float(os.getenv("CACHE_CNPJ_TTL_DIAS", "30")),
+    "cep": float(os.getenv("CACHE_CEP_TTL_DIAS", "180")),
+    "ibge": float(os.getenv("CACHE_IBGE_TTL_DIAS", "365")),
+}
+TTL_NEGATIVO_HORAS = float(os.getenv("CACHE_NEGATIVO_TTL_HORAS", "24"))
+# Por quanto tempo depois de vencida a entrada ainda pode ser servida enquanto é revalidada
+OBSOLETO_DIAS = float(os.getenv("CACHE_OBSOLETO_DIAS", "30"))
+CACHE_MEMORIA_MAX = int(os.getenv("CACHE_CONSULTAS_MEMORIA_MAX", "20000"))
+
+_memoria = OrderedDict()  # _id -> documento do cache
+_lock = threading.Lock()
+_revalidando = set()
+_revalidacao = ThreadPoolExecutor(max_workers=2, thread_name_prefix="revalidacao_cache")
+
+
+def _lembrar(doc: dict):
+    with _lock:
+        _memoria[doc["_id"]] = doc
+        _memoria.move_to_end(doc["_id"])
+        while len(_memoria) > CACHE_MEMORIA_MAX:
+            _memoria.popitem(last=False)
+
+
+def _ler(db, chave: str) -> dict | None:
+    with _lock:
+        doc = _memoria.get(chave)
+        if doc:
+            _memoria.move_to_end(chave)
+            return doc
+    try:
+        doc = db.cache_consultas.find_one({"_id": chave})
+    except PyMongoError as e:
+        log.warning("Falha lendo %s do cache: %s", chave, e)
+        return None
+    if doc:
+        _lembrar(doc)
+    return doc
+
+
+def _buscar_e_gravar(db, tipo: str, chave: str, valor_chave, buscar):
+    """Consulta o provedor e grava o resultado (positivo ou negativo). Propaga ProvedorIndisponivel."""
+    valor = buscar(valor_chave)
+    agora = datetime.utcnow()
+    expira_em = agora + (timedelta(days=TTL_DIAS[tipo]) if valor is not None
+                         else timedelta(hours=TTL_NEGATIVO_HORAS))
+    doc = {
+        "_id": chave, "tipo": tipo, "valor": valor, "encontrado": valor is not None,
+        "obtido_em": agora, "expira_em": expira_em, "remover_em": expira_em + timedelta(days=OBSOLETO_DIAS),
+    }
+    try:
+        db.cache_consultas.replace_one({"_id": chave}, doc, upsert=True)
+    except PyMongoError as e:
+        log.warning("Falha gravando %s no cache: %s", chave, e)
+    _lembrar(doc)
+    return valor
+
+
+def _revalidar(db, tipo: str, chave: str, valor_chave, buscar):
+    try:
+        _buscar_e_gravar(db, tipo, chave, valor_chave, buscar)
+    except ProvedorIndisponivel:
+        pass
+    except Exception as e:
+        log.warning("Falha revalidando %s: %s", chave, e)
+    finally:
+        with _lock:
+            _revalidando.discard(chave)
+
+
+def consultar(db, tipo: str, valor_chave: str, buscar, permitir_obsoleto: bool = True):
+    """
+    Resultado de buscar(valor_chave) passando pelo cache. 'tipo' define o TTL ('cnpj', 'cep', 'ibge').
+    Com permitir_obsoleto=False, entrada vencida é sempre consultada de novo na hora.
+    """
+    chave = f"{tipo}:{valor_chave}"
+    agora = datetime.utcnow()
+    doc = _ler(db, chave)
+
+    if doc and doc["expira_em"] > agora:
+        return doc["valor"]
+
+    if doc and permitir_obsoleto and doc["remover_em"] > agora:
+        with _lock:
+            disparar = chave not in _revalidando
+            _revalidando.add(chave)
+        if disparar:
+            _revalidacao.submit(_revalidar, db, tipo, chave, valor_chave, buscar)
+        return doc["valor"]
+
+    try:
+        return _buscar_e_gravar(db, tipo, chave, valor_chave, buscar)
+    except ProvedorIndisponivel:
+        return doc["valor"] if doc else None
+
+
+def invalidar(*chaves: str):
+    """Esquece do LRU as chaves informadas ('tipo:valor'), ou todas se nenhuma for informada."""
+    with _lock:
+        if not chaves:
+            _memoria.clear()
+            return
+        for c in chaves:
+            _memoria.pop(c, None)
@@ -0,0 +1,72 @@
+"""
+Cache em memória dos certificados A1 (PFX) já decifrados.
+
+Assinatura, transmissão e validação do certificado leem o mesmo PKCS#12; decifrá-lo
+é caro (derivação de chave + RSA), então cada arquivo é carregado uma vez por processo
+e reaproveitado. A chave do cache é caminho + mtime + tamanho + hash da senha, de modo
+que um novo upload no mesmo caminho nunca devolve o certificado antigo.
+"""
+from collections import OrderedDict, namedtuple
+from cryptography.hazmat.primitives.serialization import pkcs12
+import hashlib
+import os
+import threading
+import time
+
+CERT_CACHE_MAX = int(os.getenv("CERT_CACHE_MAX", "128"))
+CERT_CACHE_TTL_SEGUNDOS = int(os.getenv("CERT_CACHE_TTL_SEGUNDOS", "3600"))
+
+CertificadoA1 = namedtuple("CertificadoA1", ["private_key", "certificate", "additional_certs", "pfx_data"])
+
+_cache = OrderedDict()  # caminho absoluto -> (impressão, carregado_em, CertificadoA1)
+_lock = threading.Lock()
+
+
+def impressao_certificado(pfx_path: str, pfx_password: str) -> tuple:
+    """Identifica a versão do certificado: muda quando o arquivo é regravado ou a senha muda."""
+    st = os.stat(pfx_path)
+    senha_hash = hashlib.sha256((pfx_password or "").encode()).hexdigest()
+    return st.st_mtime_ns, st.st_size, senha_hash
+
+
+def carregar_certificado(pfx_path: str, pfx_password: str) -> CertificadoA1:
+    """
+    Devolve chave privada, certificado e cadeia do PFX, decifrando o arquivo só na
+    primeira chamada (ou quando ele mudou / a entrada expirou).
+    Erros de leitura ou senha errada propagam a exceção original e não ficam em cache.
+    """
+    chave = os.path.abspath(pfx_path)
+    impressao = impressao_certificado(pfx_path, pfx_password)
+    agora = time.monotonic()
+
+    with _lock:
+        entrada = _cache.get(chave)
+        if entrada and entrada[0] == impressao and agora - entrada[1] < CERT_CACHE_TTL_SEGUNDOS:
+            _cache.move_to_end(chave)
+            return entrada[2]
+
+    with open(pfx_path, "rb") as f:
+        pfx_data = f.read()
+    private_key, certificate, additional_certs = pkcs12.load_key_and_certificates(
+        pfx_data, pfx_password.encode() if pfx_password else None
+    )
+    cert = CertificadoA1(private_key, certificate, additional_certs, pfx_data)
+
+    with _lock:
+        _cache[chave] = (impressao, agora, cert)
+        _cache.move_to_end(chave)
+        while len(_cache) > CERT_CACHE_MAX:
+            _cache.popitem(last=False)
+
+    return cert
+
+
+def invalidar_certificado(*pfx_paths: str):
+    """Remove do cache os certificados informados (ou todos, se nenhum for informado)."""
+    with _lock:
+        if not pfx_paths:
+            _cache.clear()
+            return
+        for p in pfx_paths:
+            if p:
+                _cache.pop(os.path.abspath(p), None)
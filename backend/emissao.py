@@ -0,0 +1,116 @@
+"""
+Etapa de CPU da emissão em lote: montagem + assinatura das DPS num pool de processos.
+
+A busca de clientes, a reserva de números de DPS e a gravação das tasks ficam com quem
+chama (precisam do banco); aqui só entram dados prontos e saem XMLs assinados, para que
+a assinatura RSA de centenas de notas não dispute o GIL com a API.
+
+O tempo de cada assinatura é medido no filho e devolvido junto com o pedaço; o processo da
+API é quem o registra em ASSINATURA_SEGUNDOS (o registro de métricas do filho não é exposto).
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from backend.nfse_builder import build_nfse_tree
+from backend.metricas import ASSINATURA_SEGUNDOS
+from backend.signer import assinar_xml_sem_metrica
+import multiprocessing
+import os
+import threading
+import time
+
+MAX_PROCESSOS = int(os.getenv("EMISSAO_MAX_PROCESSOS", str(os.cpu_count() or 2)))
+TAMANHO_PEDACO = int(os.getenv("EMISSAO_TAMANHO_PEDACO", "50"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """Pool persistente (o certificado decifrado fica em cache dentro de cada processo)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: não herda threads/conexões do processo da API (scheduler, MongoClient)
+            _pool = ProcessPoolExecutor(max_workers=MAX_PROCESSOS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _descartar_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _montar_e_assinar_pedaco(emitter: dict, pfx_path: str, pfx_password: str, itens: list) -> tuple:
+    """
+    Roda no processo filho. Devolve ([(True, xml_assinado) | (False, mensagem_de_erro)] na ordem
+    dos itens, [segundos de cada assinatura concluída]).
+    """
+    resultados, tempos = [], []
+    for it in itens:
+        try:
+            tree = build_nfse_tree(
+                emitter, it["client"], it["service"],
+                numero_dps=it["numero_dps"], serie_dps=it["serie_dps"],
+                competencia=it["competencia"],
+                data_emissao=it.get("data_emissao")
+            )
+            inicio = time.perf_counter()
+            xml = assinar_xml_sem_metrica(tree, pfx_path=pfx_path, pfx_password=pfx_password)
+            tempos.append(time.perf_counter() - inicio)
+            resultados.append((True, xml))
+        except Exception as e:
+            resultados.append((False, str(e)))
+    return resultados, tempos
+
+
+def _observar_assinaturas(tempos: list):
+    for segundos in tempos:
+        ASSINATURA_SEGUNDOS.observar(segundos, tag="infDPS")
+
+
+def montar_e_assinar(emitter: dict, itens: list, ao_concluir_pedaco=None) -> list:
+    """
+    Monta e assina as DPS de um emissor. Cada item traz client, service, numero_dps,
+    serie_dps, competencia e data_emissao. Devolve [(ok, xml_ou_erro)] na ordem dos itens.
+
+    ao_concluir_pedaco(inicio, resultados) é chamado a cada pedaço pronto (na ordem),
+    para quem chama gravar e reportar progresso sem esperar o lote inteiro.
+    """
+    pfx_path = emitter["certificado_path"]
+    pfx_password = emitter.get("senha_certificado") or ""
+    pedacos = [(i, itens[i:i + TAMANHO_PEDACO]) for i in range(0, len(itens), TAMANHO_PEDACO)]
+
+    # Lote pequeno: não compensa serializar para outro processo
+    if len(pedacos) <= 1:
+        if not itens:
+            return []
+        resultados, tempos = _montar_e_assinar_pedaco(emitter, pfx_path, pfx_password, itens)
+        _observar_assinaturas(tempos)
+        if ao_concluir_pedaco and resultados:
+            ao_concluir_pedaco(0, resultados)
+        return resultados
+
+    pool = _get_pool()
+    futuros = []
+    try:
+        for inicio, pedaco in pedacos:
+            futuros.append((inicio, pool.submit(_montar_e_assinar_pedaco, emitter, pfx_path, pfx_password, pedaco)))
+        resultados = []
+        for inicio, futuro in futuros:
+            parcial, tempos = futuro.result()
+            _observar_assinaturas(tempos)
+            resultados.extend(parcial)
+            if ao_concluir_pedaco:
+                ao_concluir_pedaco(inicio, parcial)
+        return resultados
+    except BrokenProcessPool:
+        # um filho morreu (OOM, kill): recria o pool na próxima chamada
+        _descartar_pool()
+        raise
+    finally:
+        # abortou no meio (job expirado, erro ao gravar): não deixa pedaços assinando à toa no pool
+        for _, futuro in futuros:
+            futuro.cancel()
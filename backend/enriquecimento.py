@@ -0,0 +1,182 @@
+"""
+Motor de enriquecimento cadastral: consultas à ReceitaWS (CNPJ), ViaCEP (CEP) e IBGE (município).
+
+Cada provedor tem o próprio orçamento: um token bucket (requisições por minuto) e um teto de
+requisições simultâneas. O orçamento é do processo, então a importação de clientes, a
+atualização diária e o /clients/enrich dividem a mesma cota em vez de cada um dormir por conta.
+Um 429 pausa o provedor inteiro (Retry-After ou backoff exponencial) e a consulta é repetida.
+
+As consultas devolvem o dado, None quando o provedor responde "não encontrado", ou levantam
+ProvedorIndisponivel (tentativas esgotadas, HTTP inesperado, JSON inválido) — a distinção é o
+que permite ao backend/cache_consultas.py cachear o "não encontrado" sem cachear falhas.
+
+consultar_em_paralelo dispara várias consultas num pool de threads; quem limita o ritmo são
+os buckets, não o tamanho do pool.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+import logging
+import os
+import random
+import requests
+import threading
+import time
+
+RECEITAWS_URL = "https://www.receitaws.com.br/v1/cnpj/{}"
+VIACEP_URL = "https://viacep.com.br/ws/{}/json/"
+IBGE_MUNICIPIOS_URL = "https://servicodados.ibge.gov.br/api/v1/localidades/municipios"
+
+# Tentativas por consulta (429 e falhas de conexão) e base do backoff exponencial
+MAX_TENTATIVAS = int(os.getenv("ENRIQUECIMENTO_MAX_TENTATIVAS", "4"))
+BACKOFF_SEGUNDOS = float(os.getenv("ENRIQUECIMENTO_BACKOFF_SEGUNDOS", "2"))
+MAX_THREADS = int(os.getenv("ENRIQUECIMENTO_MAX_THREADS", "16"))
+
+log = logging.getLogger(__name__)
+
+
+class ProvedorIndisponivel(Exception):
+    """O provedor não respondeu de forma utilizável; a consulta pode ser repetida mais tarde."""
+
+
+class TokenBucket:
+    """Token bucket thread-safe: 'por_minuto' fichas/minuto, acumulando no máximo 'rajada'."""
+
+    def __init__(self, por_minuto: float, rajada: int = 1):
+        self.taxa = por_minuto / 60.0
+        self.capacidade = max(1, rajada)
+        self._fichas = float(self.capacidade)
+        self._ultimo = time.monotonic()
+        self._pausado_ate = 0.0
+        self._lock = threading.Lock()
+
+    def adquirir(self):
+        """Bloqueia até haver uma ficha (e o provedor não estar pausado) e a consome."""
+        while True:
+            with self._lock:
+                agora = time.monotonic()
+                self._fichas = min(self.capacidade, self._fichas + (agora - self._ultimo) * self.taxa)
+                self._ultimo = agora
+                espera = self._pausado_ate - agora
+                if espera <= 0:
+                    if self._fichas >= 1:
+                        self._fichas -= 1
+                        return
+                    espera = (1 - self._fichas) / self.taxa
+            time.sleep(espera)
+
+    def pausar(self, segundos: float):
+        """Suspende as fichas por 'segundos' (usado ao receber 429) e zera o acumulado."""
+        with self._lock:
+            self._pausado_ate = max(self._pausado_ate, time.monotonic() + segundos)
+            self._fichas = 0.0
+
+
+class Provedor:
+    """Orçamento de um serviço externo: bucket + semáforo de concorrência + sessão keep-alive."""
+
+    def __init__(self, nome: str, por_minuto: float, rajada: int, simultaneas: int):
+        self.nome = nome
+        self.bucket = TokenBucket(por_minuto, rajada)
+        self._simultaneas = threading.BoundedSemaphore(simultaneas)
+        self.sessao = requests.Session()
+        self.sessao.mount("https://", HTTPAdapter(pool_maxsize=simultaneas))
+
+    def get(self, url: str, timeout: float = 15, **kwargs):
+        """
+        GET respeitando o orçamento. Repete em 429 e em falha de conexão com backoff;
+        devolve a Response (qualquer outro status) ou None se as tentativas acabarem.
+        """
+        for tentativa in range(MAX_TENTATIVAS):
+            espera = BACKOFF_SEGUNDOS * (2 ** tentativa) + random.uniform(0, 1)
+            self.bucket.adquirir()
+            try:
+                with self._simultaneas:
+                    resp = self.sessao.get(url, timeout=timeout, **kwargs)
+            except RequestException as e:
+                log.warning("%s: falha de conexão (%s/%s): %s", self.nome, tentativa + 1, MAX_TENTATIVAS, e)
+                if tentativa + 1 < MAX_TENTATIVAS:
+                    time.sleep(espera)
+                continue
+
+            if resp.status_code != 429:
+                return resp
+
+            retry_after = resp.headers.get("Retry-After", "")
+            pausa = float(retry_after) if retry_after.isdigit() else espera
+            log.info("%s: rate limit (429); pausando %.1fs (%s/%s)", self.nome, pausa, tentativa + 1, MAX_TENTATIVAS)
+            self.bucket.pausar(pausa)
+        return None
+
+
+# ReceitaWS pública: 3 consultas/minuto. ViaCEP e IBGE não publicam limite; os padrões são conservadores.
+RECEITAWS = Provedor("ReceitaWS", float(os.getenv("RECEITAWS_POR_MINUTO", "3")),
+                     int(os.getenv("RECEITAWS_RAJADA", "1")), int(os.getenv("RECEITAWS_SIMULTANEAS", "1")))
+VIACEP = Provedor("ViaCEP", float(os.getenv("VIACEP_POR_MINUTO", "300")),
+                  int(os.getenv("VIACEP_RAJADA", "10")), int(os.getenv("VIACEP_SIMULTANEAS", "8")))
+IBGE = Provedor("IBGE", float(os.getenv("IBGE_POR_MINUTO", "300")),
+                int(os.getenv("IBGE_RAJADA", "10")), int(os.getenv("IBGE_SIMULTANEAS", "4")))
+
+
+def _json(provedor: Provedor, resp, nao_encontrado=(404,)):
+    """JSON da resposta; None para os status de "não encontrado"; ProvedorIndisponivel no resto."""
+    if resp is None:
+        raise ProvedorIndisponivel(f"{provedor.nome}: tentativas esgotadas")
+    if resp.status_code in nao_encontrado:
+        return None
+    if resp.status_code != 200:
+        raise ProvedorIndisponivel(f"{provedor.nome}: HTTP {resp.status_code}")
+    try:
+        return resp.json()
+    except ValueError:
+        raise ProvedorIndisponivel(f"{provedor.nome}: resposta não é JSON")
+
+
+def consultar_cnpj(cnpj: str) -> dict | None:
+    """Dados cadastrais do CNPJ na ReceitaWS; None se não encontrado."""
+    data = _json(RECEITAWS, RECEITAWS.get(RECEITAWS_URL.format(cnpj), timeout=15))
+
+    # Se a API retornar ERROR (CNPJ inválido/inexistente), não retornamos dict vazio, retornamos None
+    if not isinstance(data, dict) or data.get("status") == "ERROR":
+        return None
+
+    return {
+        "nome": data.get("nome"), "email": data.get("email"),
+        "cep": (data.get("cep") or "").replace("-", "").strip() if data.get("cep") else None,
+        "logradouro": data.get("logradouro"), "bairro": data.get("bairro"),
+        "cidade": data.get("municipio"), "estado": data.get("uf"),
+    }
+
+
+def consultar_cep(cep: str) -> dict | None:
+    """Resposta da ViaCEP para o CEP (8 dígitos); None se inexistente."""
+    data = _json(VIACEP, VIACEP.get(VIACEP_URL.format(cep), timeout=10), nao_encontrado=(400, 404))
+    return None if not isinstance(data, dict) or "erro" in data else data
+
+
+def consultar_ibge_municipio(nome: str, uf: str) -> str | None:
+    """Código IBGE do município 'nome' na UF; None se não encontrado."""
+    data = _json(IBGE, IBGE.get(IBGE_MUNICIPIOS_URL, params={"nome": nome}, timeout=10))
+    try:
+        match = next((m for m in data or []
+                      if m["microrregiao"]["mesorregiao"]["UF"]["sigla"] == uf), None)
+    except (KeyError, TypeError):
+        raise ProvedorIndisponivel("IBGE: formato de resposta inesperado")
+    return str(match["id"]) if match else None
+
+
+def consultar_em_paralelo(consulta, chaves) -> dict:
+    """Executa consulta(chave) para cada chave distinta; devolve {chave: resultado}."""
+    chaves = list(dict.fromkeys(c for c in chaves if c))
+    if not chaves:
+        return {}
+
+    def _protegida(chave):
+        try:
+            return consulta(chave)
+        except Exception as e:
+            log.warning("Falha consultando %s: %s", chave, e)
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(MAX_THREADS, len(chaves)), thread_name_prefix="enriquecimento") as pool:
+        return dict(zip(chaves, pool.map(_protegida, chaves)))
@@ -0,0 +1,180 @@
+"""
+Faturamento mensal materializado por emissor (collection 'faturamento_mensal').
+
+Cada documento soma as notas aceitas (tasks 'emit_nfse' com status 'accepted') de um emissor
+numa competência: {emitter_id, user_id, ano, mes, periodo (AAAAMM), total, notas}.
+Ele é mantido de forma incremental: quem muda o status de uma task de/para 'accepted'
+(transmissão, cancelamento, exclusão) chama registrar_mudanca_status com o documento
+anterior à mudança. O RBT12 vira uma leitura de 12 documentos por faixa de 'periodo'.
+
+reconstruir_faturamento recalcula tudo a partir de 'tasks' (carga inicial ou auditoria):
+
+    python -m backend.faturamento
+
+A reconstrução lê as tasks e depois grava os totais: um ajuste incremental feito nesse
+intervalo por outra réplica é sobrescrito. Por isso a API só a dispara sozinha com a collection
+vazia (carregar_faturamento_se_vazio, uma vez no startup); a auditoria de uma collection já
+carregada fica para a linha de comando (de preferência sem transmissões em andamento). Uma
+trava em 'travas' impede duas reconstruções ao mesmo tempo.
+"""
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+import socket
+
+STATUS_FATURADO = "accepted"
+
+# Campos da task que registrar_mudanca_status precisa (projeção para find_one_and_*)
+PROJECAO_FATURAMENTO = {"status": 1, "type": 1, "emitter_id": 1, "user_id": 1, "competencia": 1, "valor": 1}
+
+TRAVA_RECONSTRUCAO = "reconstruir_faturamento"
+# Trava de uma reconstrução que morreu no meio deixa de valer depois disso
+TRAVA_VALIDADE = timedelta(hours=1)
+
+
+def _competencia(task: dict):
+    """(ano, mes) da competência da task, aceitando string 'AAAA-MM[-DD]' ou datetime."""
+    comp = task.get("competencia")
+    if isinstance(comp, datetime):
+        return comp.year, comp.month
+    if isinstance(comp, str) and len(comp) >= 7:
+        try:
+            return int(comp[:4]), int(comp[5:7])
+        except ValueError:
+            return None
+    return None
+
+
+def _emitter_oid(valor):
+    return ObjectId(valor) if isinstance(valor, str) and ObjectId.is_valid(valor) else valor
+
+
+def _chave(emitter_oid, ano: int, mes: int) -> str:
+    return f"{emitter_oid}|{ano}|{mes:02d}"
+
+
+def ajustar_faturamento(db, task: dict, sinal: int):
+    """Soma (sinal=1) ou subtrai (sinal=-1) a task do mês da sua competência."""
+    if task.get("type", "emit_nfse") != "emit_nfse":
+        return
+    comp = _competencia(task)
+    if not comp or not task.get("emitter_id"):
+        return
+    ano, mes = comp
+    emitter_oid = _emitter_oid(task["emitter_id"])
+    valor = float(task.get("valor") or 0)
+    db.faturamento_mensal.update_one(
+        {"_id": _chave(emitter_oid, ano, mes)},
+        {
+            "$inc": {"total": sinal * valor, "notas": sinal},
+            "$set": {"updated_at": datetime.utcnow()},
+            "$setOnInsert": {"emitter_id": emitter_oid, "user_id": task.get("user_id"),
+                             "ano": ano, "mes": mes, "periodo": ano * 100 + mes},
+        },
+        upsert=True,
+    )
+
+
+def registrar_mudanca_status(db, task_antes: dict, status_novo: str):
+    """Atualiza o faturamento quando a task entra ou sai de 'accepted'."""
+    estava = task_antes.get("status") == STATUS_FATURADO
+    fica = status_novo == STATUS_FATURADO
+    if estava != fica:
+        ajustar_faturamento(db, task_antes, 1 if fica else -1)
+
+
+def faturamento_por_mes(db, emitter_id, inicio: tuple, fim: tuple) -> dict:
+    """{(ano, mes): total} do emissor entre as competências inicio e fim (inclusive)."""
+    cur = db.faturamento_mensal.find(
+        {"emitter_id": _emitter_oid(emitter_id),
+         "periodo": {"$gte": inicio[0] * 100 + inicio[1], "$lte": fim[0] * 100 + fim[1]}},
+        {"ano": 1, "mes": 1, "total": 1},
+    )
+    return {(d["ano"], d["mes"]): round(d.get("total") or 0.0, 2) for d in cur}
+
+
+def faturamento_por_emissor(db, emitter_ids: list, inicio: tuple, fim: tuple) -> dict:
+    """Como faturamento_por_mes, para vários emissores numa consulta: {emitter_id: {(ano, mes): total}}."""
+    cur = db.faturamento_mensal.find(
+        {"emitter_id": {"$in": [_emitter_oid(e) for e in emitter_ids]},
+         "periodo": {"$gte": inicio[0] * 100 + inicio[1], "$lte": fim[0] * 100 + fim[1]}},
+        {"emitter_id": 1, "ano": 1, "mes": 1, "total": 1},
+    )
+    out = {}
+    for d in cur:
+        out.setdefault(d["emitter_id"], {})[(d["ano"], d["mes"])] = round(d.get("total") or 0.0, 2)
+    return out
+
+
+def _adquirir_trava(db) -> bool:
+    agora = datetime.utcnow()
+    doc = {"_id": TRAVA_RECONSTRUCAO, "dono": socket.gethostname(), "desde": agora,
+           "expira_em": agora + TRAVA_VALIDADE}
+    try:
+        db.travas.insert_one(doc)
+        return True
+    except DuplicateKeyError:
+        # só toma a trava de uma reconstrução abandonada
+        return db.travas.find_one_and_replace(
+            {"_id": TRAVA_RECONSTRUCAO, "expira_em": {"$lt": agora}}, doc) is not None
+
+
+def reconstruir_faturamento(db, emitter_id=None) -> int:
+    """
+    Recalcula os meses a partir das tasks aceitas (todas ou de um emissor); retorna quantos
+    gravou. Levanta RuntimeError se outra reconstrução estiver em andamento.
+    """
+    if not _adquirir_trava(db):
+        raise RuntimeError("Já existe uma reconstrução do faturamento em andamento")
+    try:
+        return _reconstruir(db, emitter_id)
+    finally:
+        db.travas.delete_one({"_id": TRAVA_RECONSTRUCAO})
+
+
+def carregar_faturamento_se_vazio(db):
+    """
+    Carga inicial: reconstrói tudo se 'faturamento_mensal' estiver vazia. Devolve quantos meses
+    gravou, ou None se já havia dados ou outra réplica está reconstruindo (trava).
+    """
+    if db.faturamento_mensal.find_one({}, {"_id": 1}) is not None:
+        return None
+    try:
+        return reconstruir_faturamento(db)
+    except RuntimeError:
+        return None
+
+
+def _reconstruir(db, emitter_id=None) -> int:
+    filtro = {"status": STATUS_FATURADO, "type": "emit_nfse"}
+    if emitter_id is not None:
+        filtro["emitter_id"] = {"$in": [_emitter_oid(emitter_id), str(emitter_id)]}
+
+    somas = {}
+    for t in db.tasks.find(filtro, PROJECAO_FATURAMENTO):
+        comp = _competencia(t)
+        if not comp or not t.get("emitter_id"):
+            continue
+        emitter_oid = _emitter_oid(t["emitter_id"])
+        doc = somas.setdefault(_chave(emitter_oid, *comp), {
+            "emitter_id": emitter_oid, "user_id": t.get("user_id"),
+            "ano": comp[0], "mes": comp[1], "periodo": comp[0] * 100 + comp[1], "total": 0.0, "notas": 0,
+        })
+        doc["total"] += float(t.get("valor") or 0)
+        doc["notas"] += 1
+
+    # grava primeiro e só então remove os meses que sumiram: a collection nunca fica vazia no meio
+    agora = datetime.utcnow()
+    ops = [UpdateOne({"_id": k}, {"$set": {**v, "updated_at": agora}}, upsert=True) for k, v in somas.items()]
+    if ops:
+        db.faturamento_mensal.bulk_write(ops, ordered=False)
+    limpar = {} if emitter_id is None else {"emitter_id": _emitter_oid(emitter_id)}
+    db.faturamento_mensal.delete_many({**limpar, "_id": {"$nin": list(somas)}})
+    return len(ops)
+
+
+if __name__ == "__main__":
+    from db import db as _db
+
+    print(f"{reconstruir_faturamento(_db)} meses de faturamento reconstruídos.")
@@ -0,0 +1,190 @@
+"""
+Registro declarativo dos índices do MongoDB e diagnóstico dos planos de consulta.
+
+INDICES lista, por collection, os índices que as consultas quentes precisam; o main.py
+aplica o registro no startup (create_indexes é idempotente: índice igual já existente
+não é recriado). Índice novo entra aqui, com nome explícito.
+
+_consultas_quentes() reproduz os formatos reais de list_tasks, notas_preview, drafts_import
+e do scheduler. O diagnóstico roda explain() em cada uma e falha se alguma fizer COLLSCAN:
+
+    python -m backend.indices            # aplica os índices e verifica os planos
+    python -m backend.indices verificar  # só verifica
+"""
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import PyMongoError
+import logging
+import sys
+
+from backend.worker import filtro_sem_lease
+
+log = logging.getLogger(__name__)
+
+INDICES = {
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_unico", unique=True),
+    ],
+    "emitters": [
+        IndexModel([("user_id", ASCENDING), ("cnpj", ASCENDING)], name="user_cnpj"),
+    ],
+    "clients": [
+        IndexModel([("user_id", ASCENDING), ("cpf", ASCENDING)], name="user_cpf"),
+        IndexModel([("user_id", ASCENDING), ("cnpj", ASCENDING)], name="user_cnpj"),
+        IndexModel([("user_id", ASCENDING), ("nome", ASCENDING)], name="user_nome"),
+        IndexModel([("emissores_ids", ASCENDING), ("nao_identificado", ASCENDING)], name="emissor_nao_identificado"),
+    ],
+    "aliquotas": [
+        IndexModel([("emitter_id", ASCENDING), ("ano", DESCENDING), ("mes", DESCENDING), ("created_at", DESCENDING)],
+                   name="emitter_ano_mes"),
+    ],
+    "tasks": [
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING), ("competencia", ASCENDING)],
+                   name="user_status_competencia"),
+        IndexModel([("user_id", ASCENDING), ("emitter_id", ASCENDING), ("competencia", ASCENDING)],
+                   name="user_emitter_competencia"),
+        # keyset de list_tasks: (created_at, _id) decrescentes
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+                   name="user_created_at_id"),
+        # fila do scheduler: reivindica a task mais antiga de um status
+        IndexModel([("status", ASCENDING), ("_id", ASCENDING)], name="status_id"),
+    ],
+    "tasks_draft": [
+        IndexModel([("user_id", ASCENDING), ("emitter_id", ASCENDING), ("client_id", ASCENDING),
+                    ("competencia_month", ASCENDING), ("status", ASCENDING)], name="user_emitter_client_mes_status"),
+        IndexModel([("uniq_key", ASCENDING), ("user_id", ASCENDING), ("status", ASCENDING)],
+                   name="uniq_key_user_status"),
+        # drafts reservados por um job de emissão (routers/notas.py)
+        IndexModel([("job_id", ASCENDING), ("status", ASCENDING)], name="job_status", sparse=True),
+    ],
+    "emissoes": [
+        # um job ativo por conjunto de itens em /notas/confirmar (a chave some quando o job termina)
+        IndexModel([("chave_ativa", ASCENDING)], name="chave_ativa_unica", unique=True, sparse=True),
+    ],
+    "faturamento_mensal": [
+        IndexModel([("emitter_id", ASCENDING), ("periodo", ASCENDING)], name="emitter_periodo"),
+        IndexModel([("user_id", ASCENDING), ("periodo", ASCENDING)], name="user_periodo"),
+    ],
+    "recalculos_aliquota_itens": [
+        IndexModel([("recalculo_id", ASCENDING), ("status", ASCENDING)], name="recalculo_status"),
+    ],
+    "cache_consultas": [
+        # entradas somem sozinhas depois da janela de obsolescência (backend/cache_consultas.py)
+        IndexModel([("remover_em", ASCENDING)], name="remover_em_ttl", expireAfterSeconds=0),
+    ],
+    "dps_lacunas": [
+        IndexModel([("emitter_id", ASCENDING), ("serie", ASCENDING), ("numero", ASCENDING)],
+                   name="emitter_serie_numero"),
+    ],
+}
+
+
+def aplicar_indices(db) -> list:
+    """
+    Cria os índices do registro. Uma collection com índice conflitante (mesmo nome com
+    outra definição, duplicidade em índice único) é logada e não impede as demais.
+    Retorna a lista de falhas (collection, erro).
+    """
+    falhas = []
+    for colecao, modelos in INDICES.items():
+        try:
+            db[colecao].create_indexes(modelos)
+        except PyMongoError as e:
+            log.error("Falha criando índices de '%s': %s", colecao, e)
+            falhas.append((colecao, str(e)))
+    return falhas
+
+
+# ------------------------------------------------
+# Diagnóstico dos planos
+# ------------------------------------------------
+def _consultas_quentes():
+    """(nome, collection, filtro, sort) com os mesmos formatos usados no código."""
+    user_id, emitter_id, client_id = ObjectId(), str(ObjectId()), str(ObjectId())
+    competencia = {"$gte": "2025-01-01", "$lt": "2025-02-01"}
+    agora = datetime.utcnow()
+    return [
+        # routers/tasks.py
+        ("list_tasks", "tasks", {"user_id": user_id}, [("created_at", -1), ("_id", -1)]),
+        ("list_tasks (emissor/status/mês)", "tasks",
+         {"user_id": user_id, "emitter_id": {"$in": [ObjectId(emitter_id), emitter_id]}, "status": "accepted",
+          "competencia": competencia},
+         [("created_at", -1), ("_id", -1)]),
+        ("download_all_pdf (mês)", "tasks",
+         {"user_id": user_id, "status": "accepted", "competencia": competencia}, [("created_at", 1)]),
+        ("resumo (faturamento)", "faturamento_mensal", {"user_id": user_id, "periodo": 202501}, None),
+        # routers/aliquota.py
+        ("RBT12 (faturamento 13 meses)", "faturamento_mensal",
+         {"emitter_id": ObjectId(emitter_id), "periodo": {"$gte": 202401, "$lte": 202501}}, None),
+        # routers/notas.py
+        ("notas_preview (CNPJs)", "clients",
+         {"cnpj": {"$in": ["12345678000195"]}, "user_id": user_id, "ativo": {"$ne": False}}, None),
+        ("notas_preview (CPFs)", "clients",
+         {"cpf": {"$in": ["12345678909"]}, "user_id": user_id, "ativo": {"$ne": False}}, None),
+        ("notas_preview (não identificado)", "clients",
+         {"nao_identificado": True, "emissores_ids": emitter_id, "user_id": user_id}, None),
+        ("notas_preview (alíquota)", "aliquotas", {"emitter_id": ObjectId(emitter_id)},
+         [("ano", -1), ("mes", -1), ("created_at", -1)]),
+        ("notas_preview (upsert draft)", "tasks_draft",
+         {"uniq_key": f"{emitter_id}:{client_id}:2025-01", "user_id": user_id, "status": "pending"}, None),
+        # routers/drafts.py
+        ("drafts_import (draft existente)", "tasks_draft",
+         {"user_id": user_id, "emitter_id": emitter_id, "client_id": client_id,
+          "competencia_month": "2025-01", "status": "pending"}, [("updated_at", -1)]),
+        ("drafts_import (alíquota do mês)", "aliquotas",
+         {"emitter_id": ObjectId(emitter_id), "mes": 1, "ano": 2025}, None),
+        ("drafts_import (alíquota anterior)", "aliquotas",
+         {"emitter_id": ObjectId(emitter_id), "$or": [{"ano": {"$lt": 2025}}, {"ano": 2025, "mes": {"$lte": 1}}]},
+         [("ano", -1), ("mes", -1)]),
+        # main.py / backend/worker.py
+        ("scheduler (pendentes)", "tasks",
+         filtro_sem_lease({"status": {"$in": ["pending", "transmitting"]}}, agora), [("_id", 1)]),
+        ("scheduler (retry_dps)", "tasks", filtro_sem_lease({"status": "retry_dps"}, agora), [("_id", 1)]),
+        ("scheduler (PDFs pendentes)", "tasks",
+         {"status": "accepted",
+          "$or": [{"transmit.pdf_base64": None}, {"transmit.pdf_base64": ""},
+                  {"transmit.pdf_base64": {"$exists": False}}],
+          "transmit.pdf_ref": {"$exists": False},
+          "transmit.chave_acesso": {"$ne": None}}, None),
+        # routers/auth.py
+        ("login", "users", {"email": "usuario@exemplo.com"}, None),
+    ]
+
+
+def _estagios(plano: dict):
+    """Percorre a árvore do winningPlan devolvendo o nome de cada estágio."""
+    if not isinstance(plano, dict):
+        return
+    if "stage" in plano:
+        yield plano["stage"]
+    for chave in ("inputStage", "queryPlan"):
+        if chave in plano:
+            yield from _estagios(plano[chave])
+    for filho in plano.get("inputStages", []):
+        yield from _estagios(filho)
+
+
+def verificar_planos(db) -> list:
+    """Roda explain() nas consultas quentes; devolve [(nome, estágios)] das que fazem COLLSCAN."""
+    problemas = []
+    for nome, colecao, filtro, sort in _consultas_quentes():
+        cursor = db[colecao].find(filtro)
+        if sort:
+            cursor = cursor.sort(sort)
+        plano = cursor.explain()["queryPlanner"]["winningPlan"]
+        estagios = list(_estagios(plano))
+        status = "COLLSCAN" if "COLLSCAN" in estagios else "ok"
+        print(f"[INDICES] {status:8} {nome}: {' <- '.join(estagios)}")
+        if status != "ok":
+            problemas.append((nome, estagios))
+    return problemas
+
+
+if __name__ == "__main__":
+    from db import db as _db
+
+    if "verificar" not in sys.argv[1:]:
+        aplicar_indices(_db)
+    if verificar_planos(_db):
+        sys.exit(1)
@@ -0,0 +1,76 @@
+"""
+Logging da API com a escrita fora das threads de requisição e dos workers.
+
+Os loggers só enfileiram o registro (QueueHandler); um QueueListener numa thread própria
+formata e grava no arquivo rotativo (logs/nfse_api.log) e no console. Registros abaixo de
+LOG_LEVEL são descartados antes de qualquer formatação, então use o estilo
+log.debug("... %s", valor) (e isEnabledFor para trechos caros) nos caminhos quentes.
+
+Campos estruturados vão em extra= e são anexados ao fim da linha:
+
+    log.info("Task transmitida", extra={"task_id": ..., "emitter_id": ..., "duracao_ms": ...})
+    -> 15/01/2025 10:21:33 [INFO] backend.transmitter: Task transmitida | task_id=... duracao_ms=...
+
+Cada módulo usa o seu logger (logging.getLogger(__name__)); print() fica só para a saída
+dos scripts de linha de comando (python -m backend.<módulo>).
+"""
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import atexit
+import logging
+import os
+import queue
+
+LOG_DIR = os.getenv("LOG_DIR", "logs")
+LOG_FILE = os.path.join(LOG_DIR, "nfse_api.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+
+CAMPOS_ESTRUTURADOS = ("task_id", "emitter_id", "duracao_ms")
+
+_listener = None
+
+
+class _Formatador(logging.Formatter):
+    """Formato padrão + ' | campo=valor ...' para os campos estruturados presentes."""
+
+    def format(self, record):
+        msg = super().format(record)
+        campos = [f"{c}={getattr(record, c)}" for c in CAMPOS_ESTRUTURADOS if getattr(record, c, None) is not None]
+        return f"{msg} | {' '.join(campos)}" if campos else msg
+
+
+def configurar_logs():
+    """Instala a fila no logger raiz e inicia a thread de escrita (idempotente)."""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    formatador = _Formatador("%(asctime)s [%(levelname)s] %(name)s: %(message)s", datefmt="%d/%m/%Y %H:%M:%S")
+    arquivo = RotatingFileHandler(LOG_FILE, mode="a", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8")
+    console = logging.StreamHandler()
+    for h in (arquivo, console):
+        h.setFormatter(formatador)
+
+    fila = queue.SimpleQueue()
+    raiz = logging.getLogger()
+    for h in list(raiz.handlers):
+        raiz.removeHandler(h)
+    raiz.addHandler(QueueHandler(fila))
+    raiz.setLevel(LOG_LEVEL)
+    for nome in ("watchfiles.main", "apscheduler.scheduler", "apscheduler.executors.default"):
+        logging.getLogger(nome).setLevel(logging.WARNING)
+
+    _listener = QueueListener(fila, arquivo, console, respect_handler_level=True)
+    _listener.start()
+    atexit.register(parar_logs)
+    return _listener
+
+
+def parar_logs():
+    """Esvazia a fila e encerra a thread de escrita (chamado no encerramento do processo)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
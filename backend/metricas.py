@@ -0,0 +1,232 @@
+"""
+Métricas do pipeline de transmissão no formato de texto do Prometheus (GET /metrics).
+
+Registro mínimo em memória, sem dependência externa: contadores, gauges e histogramas com
+labels, protegidos por um lock. Observar custa um lock + uma busca de bucket; a exposição é
+montada só quando alguém lê o endpoint. Os valores são do processo: com vários workers do
+uvicorn, cada um expõe os seus (agregue por instância no Prometheus).
+
+O que é medido:
+  - latência de enviar_nfse_pkcs12, baixar_danfse_pdf e assinar_xml (histogramas);
+  - tasks transmitidas por status final;
+  - duração, resultado, atraso de início e execuções perdidas/puladas dos jobs do scheduler;
+  - backlog (tasks por status da fila, accepted sem PDF), lido do banco na hora da coleta com
+    cache de METRICAS_BACKLOG_SEGUNDOS;
+  - assinaturas feitas no pool de emissão entram pelo tempo devolvido por cada filho
+    (backend/emissao.py).
+"""
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+import functools
+import os
+import threading
+import time
+
+METRICAS_BACKLOG_SEGUNDOS = float(os.getenv("METRICAS_BACKLOG_SEGUNDOS", "15"))
+
+# Buckets (segundos): chamadas HTTP à SEFIN/ADN e jobs vão de dezenas de ms a minutos
+BUCKETS_HTTP = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60)
+BUCKETS_ASSINATURA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+BUCKETS_JOB = (0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800)
+
+# Só os status de fila: accepted/canceled crescem para sempre e contá-los a cada coleta custaria caro
+STATUS_BACKLOG = ("pending", "transmitting", "retry_dps", "error")
+
+_lock = threading.Lock()
+_registro = []  # métricas na ordem de criação (ordem da exposição)
+
+
+def _escapar(valor) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_txt(nomes: tuple, valores: tuple, extra: str = "") -> str:
+    pares = [f'{n}="{_escapar(v)}"' for n, v in zip(nomes, valores)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+def _num(v: float) -> str:
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+
+class _Metrica:
+    tipo = ""
+
+    def __init__(self, nome: str, ajuda: str, labels: tuple = ()):
+        self.nome, self.ajuda, self.labels = nome, ajuda, tuple(labels)
+        self._valores = {}
+        with _lock:
+            _registro.append(self)
+
+    def _chave(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, "") for n in self.labels)
+
+    def _linhas(self) -> list:
+        raise NotImplementedError
+
+    def exportar(self) -> str:
+        cab = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} {self.tipo}"]
+        return "\n".join(cab + self._linhas())
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def inc(self, valor: float = 1, **labels):
+        chave = self._chave(labels)
+        with _lock:
+            self._valores[chave] = self._valores.get(chave, 0) + valor
+
+    def _linhas(self):
+        return [f"{self.nome}{_labels_txt(self.labels, k)} {_num(v)}" for k, v in sorted(self._valores.items())]
+
+
+class Gauge(_Metrica):
+    tipo = "gauge"
+
+    def set(self, valor: float, **labels):
+        chave = self._chave(labels)
+        with _lock:
+            self._valores[chave] = valor
+
+    def _linhas(self):
+        return [f"{self.nome}{_labels_txt(self.labels, k)} {_num(v)}" for k, v in sorted(self._valores.items())]
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nome: str, ajuda: str, labels: tuple = (), buckets: tuple = BUCKETS_HTTP):
+        super().__init__(nome, ajuda, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observar(self, segundos: float, **labels):
+        chave = self._chave(labels)
+        i = bisect_left(self.buckets, segundos)
+        with _lock:
+            contagens, soma = self._valores.get(chave) or ([0] * (len(self.buckets) + 1), 0.0)
+            contagens[i] += 1
+            self._valores[chave] = (contagens, soma + segundos)
+
+    @contextmanager
+    def medir(self, **labels):
+        """Observa a duração do bloco; labels podem ser completados dentro dele (ex.: resultado)."""
+        inicio = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observar(time.perf_counter() - inicio, **labels)
+
+    def _linhas(self):
+        linhas = []
+        for chave, (contagens, soma) in sorted(self._valores.items()):
+            acumulado = 0
+            for limite, n in zip(self.buckets + (float("inf"),), contagens):
+                acumulado += n
+                le = 'le="%s"' % ("+Inf" if limite == float("inf") else _num(limite))
+                linhas.append(f"{self.nome}_bucket{_labels_txt(self.labels, chave, le)} {acumulado}")
+            linhas.append(f"{self.nome}_sum{_labels_txt(self.labels, chave)} {_num(soma)}")
+            linhas.append(f"{self.nome}_count{_labels_txt(self.labels, chave)} {acumulado}")
+        return linhas
+
+
+# ------------------------------------------------
+# Métricas do pipeline
+# ------------------------------------------------
+TRANSMISSAO_SEGUNDOS = Histograma(
+    "nfse_sefin_envio_segundos", "Latência do POST da DPS na SEFIN (enviar_nfse_pkcs12).", ("http_status",))
+DANFSE_SEGUNDOS = Histograma(
+    "nfse_danfse_download_segundos", "Latência do download do DANFSe no ADN (baixar_danfse_pdf).", ("resultado",))
+ASSINATURA_SEGUNDOS = Histograma(
+    "nfse_assinatura_segundos", "Tempo de assinatura de um XML (assinar_xml), por tag assinada.", ("tag",),
+    BUCKETS_ASSINATURA)
+TASKS_TRANSMITIDAS = Contador(
+    "nfse_tasks_transmitidas_total", "Tasks transmitidas pelo scheduler/envio manual, por status final.", ("status",))
+
+JOB_SEGUNDOS = Histograma("nfse_job_duracao_segundos", "Duração das execuções dos jobs do scheduler.", ("job",), BUCKETS_JOB)
+JOB_EXECUCOES = Contador("nfse_job_execucoes_total", "Execuções dos jobs do scheduler por resultado.", ("job", "resultado"))
+JOB_ATRASO = Gauge(
+    "nfse_job_atraso_segundos", "Atraso entre o horário agendado e o início da última execução do job.", ("job",))
+JOB_PERDIDOS = Contador(
+    "nfse_job_nao_executados_total",
+    "Execuções descartadas pelo scheduler (motivo: perdida ou instancia_em_andamento).", ("job", "motivo"))
+
+BACKLOG_TASKS = Gauge("nfse_tasks", "Tasks por status da fila (lido do banco na coleta).", ("status",))
+BACKLOG_PDF = Gauge("nfse_tasks_sem_pdf", "Tasks accepted sem DANFSe na última varredura do job de PDFs.")
+BACKLOG_IDADE = Gauge(
+    "nfse_fila_mais_antiga_segundos",
+    "Idade (desde a criação) da task mais antiga de cada status da fila (lido do banco na coleta).", ("status",))
+
+_backlog_lido_em = 0.0
+_backlog_lock = threading.Lock()
+
+
+def medir_job(nome: str):
+    """Decorator dos jobs do scheduler: duração e resultado (ok/erro) em JOB_SEGUNDOS/JOB_EXECUCOES."""
+    def decorar(fn):
+        @functools.wraps(fn)
+        def envolvido(*args, **kwargs):
+            resultado = "erro"
+            try:
+                with JOB_SEGUNDOS.medir(job=nome):
+                    retorno = fn(*args, **kwargs)
+                resultado = "ok"
+                return retorno
+            finally:
+                JOB_EXECUCOES.inc(job=nome, resultado=resultado)
+        return envolvido
+    return decorar
+
+
+def observar_scheduler(scheduler):
+    """Registra no APScheduler o atraso de início e as execuções perdidas/puladas de cada job."""
+
+    def _nome(event):
+        job = scheduler.get_job(event.job_id)
+        return job.name if job else event.job_id
+
+    def _ouvir(event):
+        if event.code == EVENT_JOB_SUBMITTED:
+            agendado = max(event.scheduled_run_times)
+            JOB_ATRASO.set(max(0.0, (datetime.now(agendado.tzinfo) - agendado).total_seconds()), job=_nome(event))
+        elif event.code == EVENT_JOB_MISSED:
+            JOB_PERDIDOS.inc(job=_nome(event), motivo="perdida")
+        elif event.code == EVENT_JOB_MAX_INSTANCES:
+            JOB_PERDIDOS.inc(job=_nome(event), motivo="instancia_em_andamento")
+
+    scheduler.add_listener(_ouvir, EVENT_JOB_SUBMITTED | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+
+
+def atualizar_backlog(db, forcar: bool = False):
+    """
+    Tasks por status da fila e idade da mais antiga, num único $group sobre o índice status_id,
+    no máximo uma vez por janela.
+    """
+    global _backlog_lido_em
+    with _backlog_lock:
+        if not forcar and time.monotonic() - _backlog_lido_em < METRICAS_BACKLOG_SEGUNDOS:
+            return
+        _backlog_lido_em = time.monotonic()
+
+    grupos = {g["_id"]: g for g in db.tasks.aggregate([
+        {"$match": {"status": {"$in": list(STATUS_BACKLOG)}}},
+        {"$group": {"_id": "$status", "total": {"$sum": 1}, "mais_antiga": {"$min": "$_id"}}},
+    ])}
+    agora = datetime.utcnow()
+    for status in STATUS_BACKLOG:
+        g = grupos.get(status) or {}
+        BACKLOG_TASKS.set(g.get("total", 0), status=status)
+        if status in ("pending", "retry_dps"):
+            mais_antiga = g.get("mais_antiga")
+            idade = (agora - mais_antiga.generation_time.replace(tzinfo=None)).total_seconds() if mais_antiga else 0
+            BACKLOG_IDADE.set(max(0.0, idade), status=status)
+
+
+def exportar() -> str:
+    """Todas as métricas no formato de texto do Prometheus (0.0.4)."""
+    with _lock:
+        return "\n".join(m.exportar() for m in _registro) + "\n"
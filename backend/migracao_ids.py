@@ -0,0 +1,37 @@
+"""
+Migração das referências das tasks de string para ObjectId.
+
+Tasks antigas guardam client_id, emitter_id e source.draft_id como string, o que obrigava
+list_tasks/export_xlsx a converter ($regexMatch + $toObjectId) cada documento antes do
+$lookup. As tasks novas já são gravadas com ObjectId; esta migração converte as antigas
+no próprio servidor (update em pipeline), sem trazer documentos para a aplicação.
+
+Enquanto houver tasks legadas, a leitura continua compatível: os filtros usam
+utils.filtro_ref (casa os dois formatos) e routers.tasks completa os $lookup que não
+casaram. Pode ser executada de novo a qualquer momento:
+
+    python -m backend.migracao_ids
+"""
+
+CAMPOS_REFERENCIA = ("client_id", "emitter_id", "source.draft_id")
+
+_HEX_OBJECT_ID = "^[0-9a-fA-F]{24}$"
+
+
+def migrar_referencias_tasks(db) -> dict:
+    """Converte as referências em string das tasks; retorna {campo: documentos alterados}."""
+    alterados = {}
+    for campo in CAMPOS_REFERENCIA:
+        res = db.tasks.update_many(
+            {campo: {"$type": "string", "$regex": _HEX_OBJECT_ID}},
+            [{"$set": {campo: {"$toObjectId": f"${campo}"}}}],
+        )
+        alterados[campo] = res.modified_count
+    return alterados
+
+
+if __name__ == "__main__":
+    from db import db as _db
+
+    for campo, total in migrar_referencias_tasks(_db).items():
+        print(f"{campo}: {total} tasks convertidas para ObjectId")
@@ -2,12 +2,14 @@ from lxml import etree as ET
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from utils import sanitize_document, to_float
+import logging
 import re
 import os
 
 NS_NFSE = "http://www.sped.fazenda.gov.br/nfse"
 RX_ID = re.compile(r"^DPS[0-9]{42}$")  # "DPS" + 42 dígitos
 TP_AMB = os.getenv("AMBIENTE_NFSE", "1")
+log = logging.getLogger(__name__)
 
 def _map_op_simp_nac(emitter: dict) -> str:
     """Mapa simples para opSimpNac:
@@ -87,7 +89,7 @@ def build_cancelamento_xml(
 
     # Validação de segurança
     if len(chave_acesso_nota) != 50:
-        print(f"ALERTA: Chave tem {len(chave_acesso_nota)} digitos. O esperado é 50.")
+        log.warning("Chave de acesso com %s dígitos no cancelamento; o esperado é 50", len(chave_acesso_nota))
 
     # Sequencial de 3 dígitos (usado na TAG, mas NÃO no ID)
     n_ped_reg = str(n_ped_reg).zfill(3)
@@ -131,6 +133,28 @@ def build_nfse_xml(
     pais_prestacao: str = "BRASIL",
     data_emissao: str | None = None,
 ) -> str:
+    root = build_nfse_tree(
+        emitter, client, service, numero_dps, serie_dps, competencia,
+        pais_prestacao=pais_prestacao, data_emissao=data_emissao,
+    )
+    return ET.tostring(root, pretty_print=True, encoding="utf-8", xml_declaration=True).decode("utf-8")
+
+
+def build_nfse_tree(
+    emitter: dict,
+    client: dict,
+    service: dict,
+    numero_dps: int,
+    serie_dps: str,
+    competencia: str,
+    pais_prestacao: str = "BRASIL",
+    data_emissao: str | None = None,
+) -> ET._Element:
+    """
+    Monta a DPS como árvore lxml (raiz <DPS>), pronta para ir direto ao assinar_xml
+    sem serializar/reparsear. A indentação é aplicada na própria árvore para que o XML
+    assinado fique idêntico ao gerado a partir da string pretty-printed.
+    """
 
     # --- cLocEmi: município do prestador ---
     cmun_emi = str(emitter.get("codigoIbge") or "").zfill(7)
@@ -311,4 +335,11 @@ def build_nfse_xml(
     else:
         ET.SubElement(totTrib, "indTotTrib").text = "0"
 
-    return ET.tostring(root, pretty_print=True, encoding="utf-8", xml_declaration=True).decode("utf-8")
+    # As tags são criadas sem namespace (o xmlns default só "aparece" ao serializar);
+    # qualifica todas para a árvore ficar igual à reparseada e ir direto para a assinatura.
+    for el in root.iter():
+        if "}" not in el.tag:
+            el.tag = f"{{{NS_NFSE}}}{el.tag}"
+
+    ET.indent(root)
+    return root
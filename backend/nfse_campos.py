@@ -0,0 +1,188 @@
+"""
+Campos estruturados da NFS-e, gravados na task como o subdocumento 'nfse_fields'.
+
+Relatórios e a exportação (GET /tasks/export) precisam de alíquota, valor, ISS retido,
+descrição, código e natureza do serviço e dos dados do tomador. Em vez de reabrir o XML a
+cada leitura, esses campos são extraídos uma vez, quando a task vira 'accepted' (do XML da
+NFS-e ou, na falta dele, do XML da DPS), e as leituras passam a ser só projeção:
+
+    {"aliquota": 6.0, "valor": 100.0, "iss_retido": False, "descricao": "...",
+     "cod_servico": "010101", "natureza": "...", "tomador_nome": "...", "tomador_doc": "...",
+     "tomador_end": "...", "tomador_cidade": "..."}
+
+Campo ausente no XML fica de fora do subdocumento. Tasks anteriores são preenchidas com:
+
+    python -m backend.nfse_campos
+"""
+from pymongo import UpdateOne
+from backend.blob_store import texto_campo
+import xml.etree.ElementTree as ET
+import logging
+import re
+
+CAMPO_NFSE = "nfse_fields"
+
+log = logging.getLogger(__name__)
+
+_NS_NFSE = "{http://www.sped.fazenda.gov.br/nfse}"
+
+# Tasks com algum XML (NFS-e ou DPS) e ainda sem o subdocumento
+FILTRO_SEM_CAMPOS = {CAMPO_NFSE: {"$exists": False}, "$or": [
+    {"transmit.xml_nfse": {"$nin": [None, ""]}},
+    {"transmit.xml_nfse_ref": {"$exists": True}},
+    {"response.xml": {"$nin": [None, ""]}},
+    {"response.xml_ref": {"$exists": True}},
+]}
+
+
+def _float(val):
+    if val is None or val == "":
+        return None
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return None
+
+
+def _tag_local(el) -> str | None:
+    """Nome local da tag no namespace da NFS-e; None para tags fora dele (comentários inclusive)."""
+    tag = el.tag
+    return tag[len(_NS_NFSE):] if isinstance(tag, str) and tag.startswith(_NS_NFSE) else None
+
+
+def _ler_xml(xml_content) -> dict:
+    """
+    Dados brutos (texto) da NFS-e numa única passada pelo XML.
+    Se o parse falhar ou faltar campo chave, usa Regex como fallback.
+    """
+    data = {}
+    if not xml_content:
+        return data
+
+    # 1. Tentativa Estruturada (ElementTree): primeira ocorrência de cada tag, em ordem de documento
+    try:
+        # Remove possíveis caracteres BOM ou sujeira antes do <
+        root = ET.fromstring(xml_content[xml_content.find("<"):])
+
+        achados = {}
+        primeira_aliq = None
+        for el in root.iter():
+            nome = _tag_local(el)
+            if nome and nome not in achados:
+                achados[nome] = el
+                if primeira_aliq is None and nome in ("pTotTribSN", "pAliq"):
+                    primeira_aliq = el
+
+        # Aliquota (leiaute ABRASF) tem prioridade; senão a primeira entre pTotTribSN/pAliq
+        aliq_tag = achados.get("Aliquota", primeira_aliq)
+        if aliq_tag is not None:
+            data['aliquota'] = aliq_tag.text
+
+        simples = {"vServ": "valor", "xDescServ": "descricao", "cTribNac": "cod_servico", "xTribNac": "natureza"}
+        for tag, campo in simples.items():
+            if tag in achados:
+                data[campo] = achados[tag].text
+
+        if "tpRetISSQN" in achados:
+            data['iss_retido'] = (achados["tpRetISSQN"].text == "1")
+
+        toma = achados.get("toma")
+        if toma is not None:
+            do_tomador = {}
+            for el in toma.iter():
+                do_tomador.setdefault(_tag_local(el), el)
+
+            if "xNome" in do_tomador:
+                data['tomador_nome'] = do_tomador["xNome"].text
+            doc = do_tomador.get("CNPJ")
+            if doc is None:
+                doc = do_tomador.get("CPF")
+            data['tomador_doc'] = doc.text if doc is not None else ""
+
+            end = do_tomador.get("end")
+            if end is not None:
+                do_end = {}
+                for el in end.iter():
+                    do_end.setdefault(_tag_local(el), el)
+                partes = [do_end[n].text if n in do_end else "" for n in ("xLgr", "nro", "xBairro")]
+                data['tomador_end'] = f"{partes[0]} {partes[1]} {partes[2]}".strip()
+                if "xMun" in do_end:
+                    data['tomador_cidade'] = do_end["xMun"].text
+
+    except Exception:
+        # Se der erro no parse estruturado, não faz nada e deixa o regex salvar
+        pass
+
+    # 2. Fallback Bruto (Regex) - "Salva-vidas"
+    if data.get('aliquota') is None:
+        match = re.search(r'<(?:pTotTribSN|pAliq|Aliquota)>([\d\.]+)</', xml_content)
+        if match:
+            data['aliquota'] = match.group(1)
+
+    if data.get('descricao') is None:
+        match = re.search(r'<xDescServ>(.*?)</xDescServ>', xml_content, re.DOTALL | re.IGNORECASE)
+        if match:
+            data['descricao'] = match.group(1)
+
+    if data.get('valor') is None:
+        match = re.search(r'<vServ>([\d\.]+)</', xml_content)
+        if match:
+            data['valor'] = match.group(1)
+
+    if data.get('iss_retido') is None:
+        if "<tpRetISSQN>1</tpRetISSQN>" in xml_content:
+            data['iss_retido'] = True
+        elif "<tpRetISSQN>2</tpRetISSQN>" in xml_content:
+            data['iss_retido'] = False
+
+    return data
+
+
+def extrair_campos_nfse(xml_content) -> dict:
+    """Subdocumento nfse_fields a partir do XML (NFS-e ou DPS); {} sem XML."""
+    data = _ler_xml(xml_content)
+    for campo in ("aliquota", "valor"):
+        if campo in data:
+            data[campo] = _float(data[campo])
+    return {k: v for k, v in data.items() if v is not None}
+
+
+def campos_da_task(db, task: dict) -> dict:
+    """nfse_fields da task a partir do XML guardado (inline ou no store)."""
+    xml = texto_campo(db, task.get("transmit"), "xml_nfse") or texto_campo(db, task.get("response"), "xml")
+    return extrair_campos_nfse(xml)
+
+
+def preencher_campos_nfse(db, lote: int = 200) -> int:
+    """
+    Grava nfse_fields nas tasks que ainda não têm e retorna quantas foram preenchidas.
+    Percorre por _id crescente; pode ser interrompida e executada de novo.
+    """
+    projecao = {"transmit.xml_nfse": 1, "transmit.xml_nfse_ref": 1, "response.xml": 1, "response.xml_ref": 1}
+    preenchidas = 0
+    ultimo = None
+    while True:
+        filtro = dict(FILTRO_SEM_CAMPOS)
+        if ultimo is not None:
+            filtro["_id"] = {"$gt": ultimo}
+        tasks = list(db.tasks.find(filtro, projecao).sort("_id", 1).limit(lote))
+        if not tasks:
+            return preenchidas
+        ultimo = tasks[-1]["_id"]
+
+        ops = []
+        for t in tasks:
+            try:
+                ops.append(UpdateOne({"_id": t["_id"], CAMPO_NFSE: {"$exists": False}},
+                                     {"$set": {CAMPO_NFSE: campos_da_task(db, t)}}))
+            except Exception as e:
+                log.warning("Falha extraindo nfse_fields da task %s: %s", t["_id"], e)
+        if ops:
+            preenchidas += db.tasks.bulk_write(ops, ordered=False).modified_count
+
+
+if __name__ == "__main__":
+    # python -m backend.nfse_campos  (na raiz do projeto)
+    from db import db as _db
+
+    print(f"{preencher_campos_nfse(_db)} tasks com nfse_fields preenchido.")
@@ -0,0 +1,79 @@
+"""
+Cache em memória do usuário autenticado (principal) resolvido a partir do JWT.
+
+Toda rota autenticada passa por get_current_user; sem cache, cada chamada (inclusive o
+polling do dashboard) faz um find_one em 'users'. Aqui o principal fica guardado por
+AUTH_CACHE_TTL_SEGUNDOS, chaveado pelo 'sub' do token (o e-mail), então os vários tokens
+do mesmo usuário dividem a entrada.
+
+A troca de senha invalida a entrada e revoga os tokens emitidos antes dela: o 'iat' do
+token é comparado com a última troca conhecida (a gravada em users.senha_alterada_em e,
+neste processo, a registrada por invalidar_principal).
+"""
+from calendar import timegm
+from collections import OrderedDict
+from datetime import datetime
+import os
+import threading
+import time
+
+AUTH_CACHE_TTL_SEGUNDOS = int(os.getenv("AUTH_CACHE_TTL_SEGUNDOS", "60"))
+AUTH_CACHE_MAX = int(os.getenv("AUTH_CACHE_MAX", "5000"))
+
+_cache = OrderedDict()  # sub -> (carregado_em, principal, senha_alterada_em)
+_senha_alterada = OrderedDict()  # sub -> datetime (UTC) da troca de senha feita neste processo
+_lock = threading.Lock()
+
+
+def _limitar(d: OrderedDict):
+    while len(d) > AUTH_CACHE_MAX:
+        d.popitem(last=False)
+
+
+def obter_principal(sub: str, emitido_em: int, carregar):
+    """
+    Principal do 'sub', carregando com carregar() -> (principal, senha_alterada_em) | None
+    só quando não há entrada válida. Devolve None se o usuário não existe ou se o token
+    (emitido_em, segundos UTC) é anterior à última troca de senha.
+    """
+    agora = time.monotonic()
+    with _lock:
+        entrada = _cache.get(sub)
+        if entrada and agora - entrada[0] < AUTH_CACHE_TTL_SEGUNDOS:
+            _cache.move_to_end(sub)
+        else:
+            entrada = None
+        trocada_aqui = _senha_alterada.get(sub)
+
+    if entrada is None:
+        carregado = carregar()
+        if carregado is None:
+            return None
+        entrada = (agora, *carregado)
+        with _lock:
+            _cache[sub] = entrada
+            _cache.move_to_end(sub)
+            _limitar(_cache)
+
+    _, principal, senha_alterada_em = entrada
+    for trocada in (senha_alterada_em, trocada_aqui):
+        if isinstance(trocada, datetime) and emitido_em < timegm(trocada.utctimetuple()):
+            return None
+    return principal
+
+
+def invalidar_principal(*subs: str, senha_alterada_em: datetime | None = None):
+    """
+    Remove os principais informados (ou todos, se nenhum for informado). Com
+    senha_alterada_em, os tokens desses usuários emitidos antes dela deixam de valer.
+    """
+    with _lock:
+        if not subs:
+            _cache.clear()
+            return
+        for s in subs:
+            _cache.pop(s, None)
+            if senha_alterada_em is not None:
+                _senha_alterada[s] = senha_alterada_em
+                _senha_alterada.move_to_end(s)
+        _limitar(_senha_alterada)
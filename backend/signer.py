@@ -1,80 +1,68 @@
 import base64
+import copy
 import hashlib
 from lxml import etree as ET
-from cryptography.hazmat.primitives.serialization import pkcs12, Encoding
+from cryptography.hazmat.primitives.serialization import Encoding
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
+from backend.cert_cache import carregar_certificado, CertificadoA1
+from backend.metricas import ASSINATURA_SEGUNDOS
 
 NS_NFSE = "http://www.sped.fazenda.gov.br/nfse"
 NS_DS = "http://www.w3.org/2000/09/xmldsig#"
 
 
-def assinar_xml(
-        xml_input: str | bytes,
-        pfx_path: str,
-        pfx_password: str,
-        tag_to_sign: str = "infDPS"
-) -> str:
+def _c14n(element) -> bytes:
     """
-    Assina a tag <infDPS> do XML da DPS (formato Enveloped),
-    conforme padrão NFS-e Nacional (Sefin Nacional),
-    mantendo estrutura igual ao XML que valida na SEFIN.
+    C14N inclusiva do elemento como raiz de documento próprio.
 
-    Modificado para aceitar 'tag_to_sign' (ex: "infDPS" ou "infPedReg").
+    Equivale ao antigo tostring -> fromstring -> c14n, mas sem serializar/reparsear:
+    a cópia leva junto as declarações de namespace herdadas. (A c14n direta de um
+    sub-elemento no libxml2 gera xmlns="" espúrios nos netos, por isso a cópia.)
     """
+    if element.getparent() is not None:
+        element = copy.deepcopy(element)
+        element.tail = None
+    return ET.tostring(element.getroottree(), method="c14n", exclusive=False, with_comments=False)
+
+
+def _carregar_raiz(xml_input):
+    """Aceita str, bytes, elemento ou ElementTree do lxml e devolve o elemento raiz."""
+    if isinstance(xml_input, ET._ElementTree):
+        return xml_input.getroot()
+    if isinstance(xml_input, ET._Element):
+        return xml_input
+    if isinstance(xml_input, bytes):
+        return ET.fromstring(xml_input)
+    return ET.fromstring(xml_input.encode("utf-8"))
 
-    # === 1) Carrega chave privada e certificado do PFX ===
-    with open(pfx_path, "rb") as f:
-        pfx_data = f.read()
-    private_key, certificate, additional_certs = pkcs12.load_key_and_certificates(
-        pfx_data, pfx_password.encode() if pfx_password else None
-    )
 
-    if private_key is None or certificate is None:
+def _cert_b64(certificado: CertificadoA1) -> str:
+    if certificado.private_key is None or certificado.certificate is None:
         raise ValueError("PFX inválido: sem chave privada ou certificado.")
+    return base64.b64encode(certificado.certificate.public_bytes(Encoding.DER)).decode()
 
-    cert_b64 = base64.b64encode(certificate.public_bytes(Encoding.DER)).decode()
-
-    # === 2) Carrega o XML ===
-    if isinstance(xml_input, bytes):
-        root = ET.fromstring(xml_input)
-    else:
-        root = ET.fromstring(xml_input.encode("utf-8"))
 
+def _assinar_raiz(root, private_key, cert_b64: str, tag_to_sign: str):
+    """Insere a <Signature> enveloped logo após a tag assinada (altera 'root' no lugar)."""
     ns_nfse = {"ns": NS_NFSE}
 
-    # === 3) Localiza o elemento <infDPS> ou <infPedReg> ===
-    # ### Usa a variável 'tag_to_sign'
+    # === 1) Localiza o elemento <infDPS> ou <infPedReg> ===
     target_element = root.find(f"ns:{tag_to_sign}", ns_nfse)
     if target_element is None:
-        # ### Erro dinâmico
         raise ValueError(f"Elemento <{tag_to_sign}> não encontrado.")
 
-        # ### Usa 'target_element'
     inf_id = target_element.get("Id")
     if not inf_id:
-        # ### Erro dinâmico
         raise ValueError(f"Atributo Id ausente em <{tag_to_sign}>.")
 
-        # === 4) Canonicaliza <infDPS> (ou target) e calcula o DigestValue ===
-    # ### Usa 'target_element'
-    target_bytes = ET.tostring(target_element, encoding="utf-8")
-    target_c14n = ET.tostring(
-        ET.fromstring(target_bytes),
-        method="c14n",
-        exclusive=False,
-        with_comments=False,
-    )
-
-    # ### Usa 'target_c14n'
-    digest = hashlib.sha1(target_c14n).digest()
+    # === 2) Canonicaliza <infDPS> (ou target) e calcula o DigestValue ===
+    digest = hashlib.sha1(_c14n(target_element)).digest()
     digest_b64 = base64.b64encode(digest).decode("utf-8")
 
-    # === 5) Monta a estrutura de assinatura ===
+    # === 3) Monta o SignedInfo como raiz própria (c14n direta, sem cópia) ===
     nsmap = {None: NS_DS}
-    Signature = ET.Element("{%s}Signature" % NS_DS, nsmap=nsmap)
-
-    SignedInfo = ET.SubElement(Signature, "{%s}SignedInfo" % NS_DS)
+    SignedInfo = ET.Element("{%s}SignedInfo" % NS_DS, nsmap=nsmap)
     ET.SubElement(
         SignedInfo,
         "{%s}CanonicalizationMethod" % NS_DS,
@@ -105,27 +93,71 @@ def assinar_xml(
     )
     ET.SubElement(Reference, "{%s}DigestValue" % NS_DS).text = digest_b64
 
-    # === 6) Canonicaliza SignedInfo e assina ===
-    signedinfo_bytes = ET.tostring(SignedInfo, encoding="utf-8")
-    signedinfo_c14n_element = ET.fromstring(signedinfo_bytes)
-    c14n_signed = ET.tostring(
-        signedinfo_c14n_element, method="c14n", exclusive=False, with_comments=False
-    )
-
+    # === 4) Canonicaliza SignedInfo e assina ===
+    c14n_signed = _c14n(SignedInfo)
     signature_raw = private_key.sign(c14n_signed, padding.PKCS1v15(), hashes.SHA1())
     signature_b64 = base64.b64encode(signature_raw).decode("utf-8")
 
-    # === 7) Insere SignatureValue e KeyInfo ===
+    # === 5) Monta <Signature> com SignatureValue e KeyInfo ===
+    Signature = ET.Element("{%s}Signature" % NS_DS, nsmap=nsmap)
+    Signature.append(SignedInfo)
     ET.SubElement(Signature, "{%s}SignatureValue" % NS_DS).text = signature_b64
 
     KeyInfo = ET.SubElement(Signature, "{%s}KeyInfo" % NS_DS)
     X509Data = ET.SubElement(KeyInfo, "{%s}X509Data" % NS_DS)
     ET.SubElement(X509Data, "{%s}X509Certificate" % NS_DS).text = cert_b64
 
-    # === 8) Adiciona <ds:Signature> após a tag assinada ===
-    # ### Usa 'target_element'
+    # === 6) Adiciona <ds:Signature> após a tag assinada ===
     target_element.addnext(Signature)
 
-    # === 9) Retorna XML final ===
+
+def _serializar(root) -> str:
     xml_signed = ET.tostring(root, pretty_print=False, encoding="utf-8", xml_declaration=True)
     return xml_signed.decode("utf-8")
+
+
+def assinar_xml(
+        xml_input,
+        pfx_path: str,
+        pfx_password: str,
+        tag_to_sign: str = "infDPS"
+) -> str:
+    """
+    Assina a tag <infDPS> do XML da DPS (formato Enveloped),
+    conforme padrão NFS-e Nacional (Sefin Nacional),
+    mantendo estrutura igual ao XML que valida na SEFIN.
+
+    Modificado para aceitar 'tag_to_sign' (ex: "infDPS" ou "infPedReg").
+    'xml_input' pode ser str/bytes ou a árvore lxml vinda de build_nfse_tree
+    (neste caso a assinatura é inserida na própria árvore, sem reparsear).
+    """
+    with ASSINATURA_SEGUNDOS.medir(tag=tag_to_sign):
+        return assinar_xml_sem_metrica(xml_input, pfx_path, pfx_password, tag_to_sign)
+
+
+def assinar_xml_sem_metrica(xml_input, pfx_path: str, pfx_password: str, tag_to_sign: str = "infDPS") -> str:
+    """
+    assinar_xml sem observar ASSINATURA_SEGUNDOS. Para os processos do pool de emissão: lá o
+    registro de métricas é do processo filho, então quem chama mede e devolve a duração.
+    """
+    certificado = carregar_certificado(pfx_path, pfx_password)
+    cert_b64 = _cert_b64(certificado)
+
+    root = _carregar_raiz(xml_input)
+    _assinar_raiz(root, certificado.private_key, cert_b64, tag_to_sign)
+    return _serializar(root)
+
+
+def assinar_lote(trees, cert: CertificadoA1, tag_to_sign: str = "infDPS") -> list[str]:
+    """
+    Assina várias DPS do mesmo emissor de uma vez (certificado já carregado via
+    backend.cert_cache.carregar_certificado). Devolve os XMLs assinados na mesma ordem;
+    se alguma falhar, a exceção sobe — quem precisa de erro por item usa assinar_xml.
+    """
+    cert_b64 = _cert_b64(cert)
+    assinados = []
+    for tree in trees:
+        root = _carregar_raiz(tree)
+        _assinar_raiz(root, cert.private_key, cert_b64, tag_to_sign)
+        assinados.append(_serializar(root))
+    return assinados
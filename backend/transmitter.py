@@ -1,42 +1,123 @@
+from collections import OrderedDict
 from lxml import etree as ET
-from requests_pkcs12 import post as pkcs12_post, get as pkcs12_get
+from requests_pkcs12 import Pkcs12Adapter
 from requests.exceptions import RequestException
+from backend.cert_cache import carregar_certificado, impressao_certificado
+from backend.metricas import DANFSE_SEGUNDOS, TRANSMISSAO_SEGUNDOS
 import base64
 import gzip
+import logging
 import os
+import requests
+import threading
 
 URL_PRODUCAO = os.getenv("URL_API_NACIONAL", "https://sefin.nfse.gov.br/SefinNacional/nfse")
 URL_DANFSE = os.getenv("URL_DANFSE", "https://adn.nfse.gov.br/danfse")
 
+# Sessões mTLS mantidas abertas (keep-alive) por certificado
+MAX_SESSOES = int(os.getenv("TRANSMISSAO_MAX_SESSOES", "64"))
+CONEXOES_POR_HOST = int(os.getenv("TRANSMISSAO_MAX_POR_EMISSOR", "4"))
+# Quantos caracteres do retorno bruto entram no log de DEBUG
+LOG_RESPOSTA_CARACTERES = int(os.getenv("LOG_RESPOSTA_CARACTERES", "1000"))
 
-def baixar_danfse_pdf(chave_acesso: str, pfx_path: str, pfx_password: str) -> str | None:
-    """Faz o download do DANFSe (PDF oficial) do portal ADN."""
-    url = f"{URL_DANFSE}/{chave_acesso}"
-    print(f"🔍 [DEBUG] Consultando DANFSe: {url}")
+log = logging.getLogger(__name__)
 
-    try:
-        resp = pkcs12_get(
-            url,
-            pkcs12_filename=pfx_path,
-            pkcs12_password=pfx_password,
-            timeout=30,
-            verify=True,
-        )
 
-        print("🔍 [DEBUG] HTTP STATUS (DANFSe):", resp.status_code)
+# ======================================================
+# 🔹 Pool de sessões mTLS (uma requests.Session por certificado)
+# ======================================================
+_sessoes = OrderedDict()  # caminho do PFX -> (impressão digital, Session)
+_sessoes_lock = threading.Lock()
 
-        if resp.status_code == 200 and resp.headers.get("Content-Type", "").startswith("application/pdf"):
-            pdf_b64 = base64.b64encode(resp.content).decode("ascii")
-            print("DANFSe PDF obtido com sucesso.")
-            return pdf_b64
 
-        if resp.status_code == 404:
-            print("DANFSe ainda não disponível (404).")
+def _sessao_mtls(pfx_path: str, pfx_password: str) -> requests.Session:
+    """
+    Devolve a sessão keep-alive do certificado, criando-a na primeira chamada.
+    O PKCS#12 é lido e o contexto SSL montado uma única vez; as chamadas seguintes do
+    mesmo emissor reaproveitam as conexões TLS já abertas com a SEFIN/ADN.
+    """
+    chave = os.path.abspath(pfx_path)
+    impressao = impressao_certificado(pfx_path, pfx_password)
+
+    with _sessoes_lock:
+        atual = _sessoes.get(chave)
+        if atual and atual[0] == impressao:
+            _sessoes.move_to_end(chave)
+            return atual[1]
+
+    # Decifrar o PKCS#12 e montar o contexto SSL fica fora do lock: o primeiro envio de um
+    # certificado novo/renovado não segura as transmissões dos outros emissores
+    sessao = requests.Session()
+    adapter = Pkcs12Adapter(
+        pkcs12_data=carregar_certificado(pfx_path, pfx_password).pfx_data,
+        pkcs12_password=pfx_password,
+        pool_connections=2,  # sefin + adn
+        pool_maxsize=CONEXOES_POR_HOST,
+    )
+    sessao.mount("https://", adapter)
+
+    with _sessoes_lock:
+        atual = _sessoes.get(chave)
+        if atual and atual[0] == impressao:
+            # outra thread montou a mesma sessão enquanto isso: fica a dela
+            _sessoes.move_to_end(chave)
+            descartadas, sessao = [sessao], atual[1]
+        else:
+            _sessoes[chave] = (impressao, sessao)
+            _sessoes.move_to_end(chave)
+            descartadas = [atual[1]] if atual else []
+            while len(_sessoes) > MAX_SESSOES:
+                _, (_, antiga) = _sessoes.popitem(last=False)
+                descartadas.append(antiga)
+
+    for antiga in descartadas:
+        antiga.close()
+    return sessao
+
+
+def invalidar_sessoes(*pfx_paths: str):
+    """Fecha as sessões dos certificados informados (ou todas, se nenhum for informado)."""
+    with _sessoes_lock:
+        if pfx_paths:
+            chaves = [os.path.abspath(p) for p in pfx_paths if p]
         else:
-            print("Erro DANFSe:", resp.text[:500])
+            chaves = list(_sessoes)
+        descartadas = [_sessoes.pop(c)[1] for c in chaves if c in _sessoes]
+
+    for sessao in descartadas:
+        sessao.close()
 
-    except Exception as e:
-        print("Erro ao consultar DANFSe:", e)
+
+def baixar_danfse_pdf(chave_acesso: str, pfx_path: str, pfx_password: str) -> str | None:
+    """Faz o download do DANFSe (PDF oficial) do portal ADN."""
+    url = f"{URL_DANFSE}/{chave_acesso}"
+    log.debug("Consultando DANFSe: %s", url)
+
+    with DANFSE_SEGUNDOS.medir(resultado="erro") as metrica:
+        try:
+            resp = _sessao_mtls(pfx_path, pfx_password).get(
+                url,
+                timeout=30,
+                verify=True,
+            )
+
+            log.debug("HTTP STATUS (DANFSe): %s", resp.status_code)
+
+            if resp.status_code == 200 and resp.headers.get("Content-Type", "").startswith("application/pdf"):
+                pdf_b64 = base64.b64encode(resp.content).decode("ascii")
+                metrica["resultado"] = "ok"
+                log.info("DANFSe PDF obtido com sucesso.")
+                return pdf_b64
+
+            if resp.status_code == 404:
+                metrica["resultado"] = "indisponivel"
+                log.info("DANFSe ainda não disponível (404).")
+            else:
+                metrica["resultado"] = f"http_{resp.status_code}"
+                log.warning("Erro DANFSe: HTTP %s %s", resp.status_code, resp.text[:500])
+
+        except Exception as e:
+            log.warning("Erro ao consultar DANFSe: %s", e)
 
     return None
 
@@ -45,20 +126,19 @@ def enviar_nfse_pkcs12(dps_b64: str, pfx_path: str, pfx_password: str):
     payload = {"dpsXmlGZipB64": dps_b64}
     headers = {"Content-Type": "application/json", "Accept": "application/json"}
 
-    resp = pkcs12_post(
-        URL_PRODUCAO,
-        json=payload,
-        headers=headers,
-        pkcs12_filename=pfx_path,
-        pkcs12_password=pfx_password,
-        timeout=30,
-        verify=True,
-    )
+    with TRANSMISSAO_SEGUNDOS.medir(http_status="erro") as metrica:
+        resp = _sessao_mtls(pfx_path, pfx_password).post(
+            URL_PRODUCAO,
+            json=payload,
+            headers=headers,
+            timeout=30,
+            verify=True,
+        )
+        metrica["http_status"] = str(resp.status_code)
 
     xml_resp = resp.text or ""
-    print("🔍 [DEBUG] HTTP STATUS:", resp.status_code)
-    print("🔍 [DEBUG] RAW RESPONSE:")
-    print(xml_resp[:1000])
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("HTTP STATUS: %s | RAW RESPONSE: %s", resp.status_code, xml_resp[:LOG_RESPOSTA_CARACTERES])
 
     pdf_base64 = None
     xml_nfse = None
@@ -82,7 +162,7 @@ def enviar_nfse_pkcs12(dps_b64: str, pfx_path: str, pfx_password: str):
             try:
                 xml_nfse = gzip.decompress(base64.b64decode(gz_b64)).decode("utf-8", errors="replace")
             except Exception as e:
-                print("Falha ao descompactar nfseXmlGZipB64:", e)
+                log.warning("Falha ao descompactar nfseXmlGZipB64: %s", e)
 
         return {
             "status": resp.status_code,
@@ -106,7 +186,7 @@ def enviar_nfse_pkcs12(dps_b64: str, pfx_path: str, pfx_password: str):
         if nfse_el is not None:
             xml_nfse = ET.tostring(nfse_el, encoding="utf-8").decode("utf-8")
     except Exception as e:
-        print(" Falha ao parsear resposta da NFS-e:", e)
+        log.warning("Falha ao parsear resposta da NFS-e: %s", e)
 
     return {
         "status": resp.status_code,
@@ -129,26 +209,23 @@ def enviar_cancelamento_pkcs12(chave_acesso: str, evento_b64_gzip: str, pfx_path
     payload = {"pedidoRegistroEventoXmlGZipB64": evento_b64_gzip}
     headers = {"Content-Type": "application/json", "Accept": "application/json"}
 
-    print(f"? [DEBUG] Enviando Cancelamento para: {url}")
-    print(f"? [DEBUG] Usando a chave 'pedidoRegistroEventoXmlGZipB64' para o payload.")
+    log.debug("Enviando Cancelamento para: %s", url)
 
     try:
-        resp = pkcs12_post(
+        resp = _sessao_mtls(pfx_path, pfx_password).post(
             url,
             json=payload,
             headers=headers,
-            pkcs12_filename=pfx_path,
-            pkcs12_password=pfx_password,
             timeout=30,
             verify=True,
         )
 
-        print("? [DEBUG] HTTP STATUS (Cancelamento):", resp.status_code)
-        print("? [DEBUG] RAW RESPONSE (Cancelamento):")
-        print(resp.text[:1000])
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("HTTP STATUS (Cancelamento): %s | RAW RESPONSE: %s",
+                      resp.status_code, resp.text[:LOG_RESPOSTA_CARACTERES])
 
         return resp
 
     except RequestException as e:
-        print(f"Erro ao enviar cancelamento: {e}")
+        log.error("Erro ao enviar cancelamento: %s", e)
         raise e
@@ -0,0 +1,184 @@
+"""
+Motor de transmissão concorrente.
+
+Consome a fila de tasks com um pool de threads, limitando a concorrência
+total e a concorrência por emissor (cada emissor usa o próprio certificado e
+a SEFIN não gosta de rajadas do mesmo CNPJ).
+
+Várias réplicas da API podem rodar o scheduler ao mesmo tempo: cada task é
+reservada com um lease (status 'transmitting' + dono + validade) antes do envio,
+renovado por heartbeat, e leases vencidos são reivindicados de novo.
+"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from bson import ObjectId
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from uuid import uuid4
+import logging
+import os
+import socket
+import threading
+
+MAX_WORKERS = int(os.getenv("TRANSMISSAO_MAX_WORKERS", "16"))
+MAX_POR_EMISSOR = int(os.getenv("TRANSMISSAO_MAX_POR_EMISSOR", "4"))
+
+# Lease: tempo que uma réplica pode segurar uma task sem renovar (heartbeat a cada 1/3)
+LEASE_SEGUNDOS = int(os.getenv("TRANSMISSAO_LEASE_SEGUNDOS", "120"))
+
+# Identifica este processo como dono dos leases
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+
+log = logging.getLogger(__name__)
+
+
+def drenar_fila(
+        reivindicar,
+        processar,
+        chave=lambda doc: doc.get("emitter_id"),
+        max_workers: int = MAX_WORKERS,
+        max_por_chave: int = MAX_POR_EMISSOR,
+) -> int:
+    """
+    Processa a fila até esvaziá-la e retorna quantos documentos foram despachados.
+
+    - reivindicar(chaves_saturadas): reserva atomicamente o próximo documento cuja chave
+      não esteja em chaves_saturadas e o devolve (ou None se não houver mais nada).
+      Só se reserva o que já pode ser despachado, para não segurar tasks que outra
+      réplica poderia estar transmitindo.
+    - processar(doc): roda numa thread do pool; exceções são logadas e não param a fila.
+    - chave(doc): agrupa os documentos (por padrão, o emissor) para o limite max_por_chave.
+    """
+    ativos = defaultdict(int)  # chave -> documentos em andamento
+    em_voo = {}  # future -> chave
+    despachados = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="transmissao") as pool:
+        while True:
+            # 1) Ocupa os slots livres
+            while len(em_voo) < max_workers:
+                saturadas = [k for k, n in ativos.items() if n >= max_por_chave]
+                doc = reivindicar(saturadas)
+                if doc is None:
+                    break
+                k = str(chave(doc))
+                em_voo[pool.submit(processar, doc)] = k
+                ativos[k] += 1
+                despachados += 1
+
+            if not em_voo:
+                # nada em andamento e nada mais a reivindicar
+                break
+
+            # 2) Aguarda ao menos uma conclusão para liberar slot
+            concluidos, _ = wait(em_voo, return_when=FIRST_COMPLETED)
+            for f in concluidos:
+                k = em_voo.pop(f)
+                ativos[k] -= 1
+                if not ativos[k]:
+                    del ativos[k]
+                exc = f.exception()
+                if exc is not None:
+                    log.error("Erro não tratado no worker de transmissão (%s): %s", k, exc, exc_info=exc)
+
+    return despachados
+
+
+# ======================================================
+# 🔹 Leases: reserva atômica de tasks entre réplicas
+# ======================================================
+def filtro_sem_lease(filtro: dict, agora: datetime) -> dict:
+    """Restringe 'filtro' às tasks livres: sem lease ou com lease vencido em 'agora'."""
+    return {
+        "$and": [
+            filtro,
+            {"$or": [{"lease": {"$exists": False}}, {"lease": None}, {"lease.expires_at": {"$lt": agora}}]},
+        ]
+    }
+
+
+def reivindicar_task(db, filtro: dict, novo_status: str | None = None, owner: str = WORKER_ID):
+    """
+    Reserva atomicamente (um único find_one_and_update) a task mais antiga que casar com
+    'filtro' e esteja livre (sem lease ou com lease vencido), gravando o lease
+    {owner, claimed_at, expires_at, status_anterior}. Retorna o documento reservado ou None.
+    """
+    agora = datetime.utcnow()
+    filtro_livre = filtro_sem_lease(filtro, agora)
+
+    # update em pipeline para guardar o status anterior na mesma operação
+    # (lease vencido de uma réplica que caiu volta a contar como 'pending')
+    update = {
+        "lease": {
+            "owner": owner,
+            "claimed_at": agora,
+            "expires_at": agora + timedelta(seconds=LEASE_SEGUNDOS),
+            "status_anterior": {"$cond": [{"$eq": ["$status", "transmitting"]}, "pending", "$status"]},
+        }
+    }
+    if novo_status:
+        update["status"] = novo_status
+
+    return db.tasks.find_one_and_update(
+        filtro_livre,
+        [{"$set": update}],
+        sort=[("_id", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def reivindicar_pendente(db, excluir_ids=(), excluir_emissores=(), owner: str = WORKER_ID):
+    """Reserva a próxima task 'pending' (ou 'transmitting' com lease vencido) para transmissão."""
+    filtro = {"status": {"$in": ["pending", "transmitting"]}}
+    if excluir_ids:
+        filtro["_id"] = {"$nin": list(excluir_ids)}
+    if excluir_emissores:
+        # emitter_id pode estar como ObjectId ou, em tasks legadas, como string
+        filtro["emitter_id"] = {"$nin": [v for e in excluir_emissores
+                                         for v in ((e, ObjectId(e)) if ObjectId.is_valid(e) else (e,))]}
+    return reivindicar_task(db, filtro, novo_status="transmitting", owner=owner)
+
+
+def finalizar_task(db, task_id, update: dict, owner: str = WORKER_ID) -> bool:
+    """
+    Aplica o update final ($set/...) somente se o lease ainda for deste worker, removendo-o.
+    Retorna False se o lease foi perdido (outra réplica reivindicou a task).
+    """
+    update = dict(update)
+    update.setdefault("$unset", {})["lease"] = ""
+    res = db.tasks.update_one({"_id": task_id, "lease.owner": owner}, update)
+    if res.matched_count == 0:
+        log.warning("Lease da task perdido antes da gravação; resultado descartado.", extra={"task_id": str(task_id)})
+        return False
+    return True
+
+
+def liberar_task(db, task: dict, owner: str = WORKER_ID) -> bool:
+    """Devolve a task reservada ao status anterior à reserva, sem outras alterações."""
+    status_anterior = (task.get("lease") or {}).get("status_anterior") or task.get("status")
+    return finalizar_task(db, task["_id"], {"$set": {"status": status_anterior}}, owner=owner)
+
+
+def manter_leases(db, ids: set, owner: str = WORKER_ID, intervalo: float | None = None) -> threading.Event:
+    """
+    Inicia uma thread de heartbeat que renova o lease das tasks em 'ids' (conjunto mutável,
+    mantido pelo chamador) até que o Event retornado seja sinalizado.
+    """
+    parar = threading.Event()
+    intervalo = intervalo or max(LEASE_SEGUNDOS / 3, 1)
+
+    def _loop():
+        while not parar.wait(intervalo):
+            atuais = list(ids)
+            if not atuais:
+                continue
+            try:
+                db.tasks.update_many(
+                    {"_id": {"$in": atuais}, "lease.owner": owner},
+                    {"$set": {"lease.expires_at": datetime.utcnow() + timedelta(seconds=LEASE_SEGUNDOS)}},
+                )
+            except Exception as e:
+                log.warning("Falha ao renovar leases: %s", e)
+
+    threading.Thread(target=_loop, name="lease-heartbeat", daemon=True).start()
+    return parar
@@ -0,0 +1,86 @@
+"""
+XLSX em memória constante para as exportações (GET /tasks/export).
+
+O xlsxwriter em modo constant_memory grava cada linha num arquivo temporário assim que
+a próxima começa, então só uma linha por aba fica em memória. As larguras das colunas são
+estimadas enquanto as linhas passam (o <cols> só é escrito no close) e o arquivo final,
+montado num temporário em disco, é repassado ao cliente em pedaços.
+"""
+from typing import Iterable, Iterator, Sequence, Tuple
+import re
+import tempfile
+import xlsxwriter
+
+PEDACO_BYTES = 64 * 1024
+LARGURA_MIN = 10
+LARGURA_MAX = 60
+
+FORMATO_CABECALHO = {"bold": True, "bg_color": "#DDDDDD", "border": 1, "align": "center"}
+
+
+class _Aba:
+    def __init__(self, ws, cabecalho: Sequence[str], formato_cabecalho):
+        self.ws = ws
+        self.proxima_linha = 1
+        self.larguras = [len(str(h)) for h in cabecalho]
+        ws.write_row(0, 0, cabecalho, formato_cabecalho)
+
+    def escrever(self, linha: Sequence, formatos: dict):
+        for col, valor in enumerate(linha):
+            self.ws.write(self.proxima_linha, col, valor, formatos.get(col))
+            tamanho = len(str(valor)) if valor is not None else 0
+            if tamanho > self.larguras[col]:
+                self.larguras[col] = tamanho
+        self.proxima_linha += 1
+
+    def ajustar_larguras(self):
+        for col, tamanho in enumerate(self.larguras):
+            self.ws.set_column(col, col, min(max(tamanho + 2, LARGURA_MIN), LARGURA_MAX))
+
+
+def nome_aba(nome: str | None) -> str:
+    """Nome de aba válido no Excel (sem \\ / * ? : [ ], até 30 caracteres)."""
+    return re.sub(r'[\\/*?:\[\]]', '', nome or "Sem Emissor")[:30] or "Sem Emissor"
+
+
+def gerar_xlsx(
+        cabecalho: Sequence[str],
+        linhas: Iterable[Tuple[str, Sequence]],
+        formatos_coluna: dict | None = None,
+        aba_vazia: str = "Sem Dados",
+) -> Iterator[bytes]:
+    """
+    Gera o XLSX em pedaços a partir de (nome da aba, valores), consumindo `linhas` sob demanda.
+    Cada aba recebe o cabeçalho na primeira linha; formatos_coluna é {índice: num_format}.
+    Pode ser passado direto para o StreamingResponse.
+    """
+    with tempfile.TemporaryFile() as destino:
+        wb = xlsxwriter.Workbook(destino, {"constant_memory": True, "strings_to_urls": False})
+        formato_cabecalho = wb.add_format(FORMATO_CABECALHO)
+        formatos = {col: wb.add_format({"num_format": f}) for col, f in (formatos_coluna or {}).items()}
+
+        abas = {}
+        usados = set()  # o Excel compara nomes de aba sem diferenciar maiúsculas
+        for nome, linha in linhas:
+            aba = abas.get(nome)
+            if aba is None:
+                titulo, n = nome, 1
+                while titulo.lower() in usados:
+                    titulo = f"{nome[:30 - len(str(n))]}{n}"
+                    n += 1
+                usados.add(titulo.lower())
+                aba = abas[nome] = _Aba(wb.add_worksheet(titulo), cabecalho, formato_cabecalho)
+            aba.escrever(linha, formatos)
+
+        if not abas:
+            wb.add_worksheet(aba_vazia)
+        for aba in abas.values():
+            aba.ajustar_larguras()
+        wb.close()
+
+        destino.seek(0)
+        while True:
+            pedaco = destino.read(PEDACO_BYTES)
+            if not pedaco:
+                return
+            yield pedaco
@@ -0,0 +1,60 @@
+"""
+ZIP em streaming para os downloads em lote (XML/DANFSe).
+
+O zipfile, quando o destino não aceita seek, grava cada entrada com data descriptor
+(CRC e tamanhos depois do conteúdo). Assim cada arquivo é comprimido e repassado ao
+cliente assim que é adicionado, e a memória fica limitada a um arquivo por vez,
+qualquer que seja o tamanho do mês.
+"""
+from itertools import islice
+from typing import Iterable, Iterator, Tuple, Union
+import zipfile
+
+ZIP_LOTE_TASKS = 200
+
+
+class _SaidaSemSeek:
+    """Destino só de escrita: acumula os bytes até o gerador drenar."""
+
+    def __init__(self):
+        self._partes = []
+
+    def write(self, dados) -> int:
+        self._partes.append(bytes(dados))
+        return len(dados)
+
+    def flush(self):
+        pass
+
+    def drenar(self) -> bytes:
+        dados = b"".join(self._partes)
+        self._partes.clear()
+        return dados
+
+
+def gerar_zip(arquivos: Iterable[Tuple[str, Union[bytes, str]]]) -> Iterator[bytes]:
+    """
+    Gera o ZIP em pedaços a partir de (nome, conteúdo), consumindo `arquivos` sob demanda.
+    Pode ser passado direto para o StreamingResponse.
+    """
+    saida = _SaidaSemSeek()
+    with zipfile.ZipFile(saida, "w", zipfile.ZIP_DEFLATED) as zf:
+        for nome, conteudo in arquivos:
+            zf.writestr(nome, conteudo)
+            pedaco = saida.drenar()
+            if pedaco:
+                yield pedaco
+    # diretório central, gravado no close()
+    pedaco = saida.drenar()
+    if pedaco:
+        yield pedaco
+
+
+def em_lotes(cursor, tamanho: int = ZIP_LOTE_TASKS) -> Iterator[list]:
+    """Lê o cursor em listas de até `tamanho` documentos."""
+    cursor = iter(cursor)
+    while True:
+        lote = list(islice(cursor, tamanho))
+        if not lote:
+            return
+        yield lote
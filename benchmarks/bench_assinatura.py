@@ -0,0 +1,118 @@
+"""
+Microbenchmark: assinaturas de DPS por segundo.
+
+Compara, para N DPS do mesmo emissor (certificado A1 RSA 2048 descartável):
+
+  - "legado":        build_nfse_xml (string pretty-printed) + assinatura antiga, que abria
+                     o PFX e decifrava o PKCS#12 a cada nota e fazia tostring/fromstring
+                     no infDPS, no SignedInfo e na raiz;
+  - "legado+cache":  o mesmo fluxo de strings, mas com o certificado já carregado;
+  - "lote":          build_nfse_tree + assinar_lote (árvore direto para a C14N).
+
+Todos produzem o mesmo XML assinado (conferido antes da medição).
+
+Uso (na raiz do projeto):
+    python benchmarks/bench_assinatura.py [N]
+"""
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.serialization import pkcs12, Encoding
+from lxml import etree as ET
+import base64
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_sessao_mtls import _preparar_certificados, SENHA_PFX
+from backend.cert_cache import carregar_certificado
+from backend.nfse_builder import build_nfse_xml, build_nfse_tree
+from backend.signer import assinar_lote, NS_NFSE, NS_DS
+
+EMISSOR = {
+    "cnpj": "12345678000195", "razaoSocial": "Emissor Benchmark", "codigoIbge": "3550308",
+    "regimeTributacao": "Simples Nacional", "inscricaoMunicipal": "123",
+}
+CLIENTE = {
+    "cnpj": "98765432000198", "nome": "Tomador Benchmark", "codigoIbge": "3550308", "cep": "01001000",
+    "logradouro": "Rua Teste", "numero": "1", "bairro": "Centro", "email": "tomador@exemplo.com",
+}
+SERVICO = {
+    "descricao": "Serviços de consultoria", "valor": 1500.0, "cTribNac": "010101",
+    "aliquota": 0.06, "municipioIbge": "3550308", "issRetido": False,
+}
+
+
+def _assinar_legado(xml: str, private_key, certificate) -> str:
+    """Cópia do fluxo antigo de assinar_xml (tostring/fromstring a cada etapa)."""
+    cert_b64 = base64.b64encode(certificate.public_bytes(Encoding.DER)).decode()
+    root = ET.fromstring(xml.encode("utf-8"))
+    target = root.find("ns:infDPS", {"ns": NS_NFSE})
+    target_c14n = ET.tostring(ET.fromstring(ET.tostring(target, encoding="utf-8")), method="c14n")
+    digest_b64 = base64.b64encode(hashlib.sha1(target_c14n).digest()).decode()
+
+    Signature = ET.Element("{%s}Signature" % NS_DS, nsmap={None: NS_DS})
+    SignedInfo = ET.SubElement(Signature, "{%s}SignedInfo" % NS_DS)
+    ET.SubElement(SignedInfo, "{%s}CanonicalizationMethod" % NS_DS,
+                  Algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315")
+    ET.SubElement(SignedInfo, "{%s}SignatureMethod" % NS_DS, Algorithm="http://www.w3.org/2000/09/xmldsig#rsa-sha1")
+    Reference = ET.SubElement(SignedInfo, "{%s}Reference" % NS_DS, URI=f"#{target.get('Id')}")
+    Transforms = ET.SubElement(Reference, "{%s}Transforms" % NS_DS)
+    ET.SubElement(Transforms, "{%s}Transform" % NS_DS,
+                  Algorithm="http://www.w3.org/2000/09/xmldsig#enveloped-signature")
+    ET.SubElement(Transforms, "{%s}Transform" % NS_DS, Algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315")
+    ET.SubElement(Reference, "{%s}DigestMethod" % NS_DS, Algorithm="http://www.w3.org/2000/09/xmldsig#sha1")
+    ET.SubElement(Reference, "{%s}DigestValue" % NS_DS).text = digest_b64
+
+    c14n_signed = ET.tostring(ET.fromstring(ET.tostring(SignedInfo, encoding="utf-8")), method="c14n")
+    signature_raw = private_key.sign(c14n_signed, padding.PKCS1v15(), hashes.SHA1())
+    ET.SubElement(Signature, "{%s}SignatureValue" % NS_DS).text = base64.b64encode(signature_raw).decode()
+    KeyInfo = ET.SubElement(Signature, "{%s}KeyInfo" % NS_DS)
+    X509Data = ET.SubElement(KeyInfo, "{%s}X509Data" % NS_DS)
+    ET.SubElement(X509Data, "{%s}X509Certificate" % NS_DS).text = cert_b64
+    target.addnext(Signature)
+    return ET.tostring(root, pretty_print=False, encoding="utf-8", xml_declaration=True).decode("utf-8")
+
+
+def _dps(i):
+    return (EMISSOR, CLIENTE, SERVICO, i + 1, "1", "2025-01-01")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    with tempfile.TemporaryDirectory() as pasta:
+        pfx = _preparar_certificados(pasta)["pfx"]
+        cert = carregar_certificado(pfx, SENHA_PFX)
+
+        def legado():
+            saida = []
+            for i in range(n):
+                with open(pfx, "rb") as f:
+                    key, certificate, _ = pkcs12.load_key_and_certificates(f.read(), SENHA_PFX.encode())
+                saida.append(_assinar_legado(build_nfse_xml(*_dps(i)), key, certificate))
+            return saida
+
+        def legado_cache():
+            return [_assinar_legado(build_nfse_xml(*_dps(i)), cert.private_key, cert.certificate) for i in range(n)]
+
+        def lote():
+            return assinar_lote([build_nfse_tree(*_dps(i)) for i in range(n)], cert)
+
+        assert legado_cache()[:3] == lote()[:3], "XML assinado divergente"
+
+        print(f"{n} DPS assinadas (RSA 2048, SHA1)")
+        base = None
+        for nome, fn in (("legado", legado), ("legado+cache", legado_cache), ("lote", lote)):
+            t0 = time.perf_counter()
+            fn()
+            dt = time.perf_counter() - t0
+            base = base or dt
+            print(f"{nome:<14} {n / dt:8.1f} assinaturas/s | {dt * 1000 / n:6.2f} ms/nota | {base / dt:4.1f}x")
+
+
+if __name__ == "__main__":
+    main()
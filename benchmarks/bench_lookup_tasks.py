@@ -0,0 +1,133 @@
+"""
+Benchmark: $lookup das tasks com ids em string x ids em ObjectId, numa collection de 200k tasks.
+
+Cadastra emissores, clientes e N tasks com client_id/emitter_id em string (formato legado) e mede:
+
+  - "string":   pipeline antigo de list_tasks ($regexMatch + $toObjectId por documento antes
+                de cada $lookup);
+  - "ObjectId": depois de backend.migracao_ids, o pipeline atual (routers.tasks.list_tasks),
+                com $lookup direto nos campos.
+
+Também mede o tempo da migração. Usa MONGO_URI (banco "nfse_benchmark", apagado ao final).
+
+Uso (na raiz do projeto):
+    python benchmarks/bench_lookup_tasks.py [N]
+"""
+from bson import ObjectId
+from datetime import datetime, timedelta
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo import MongoClient
+from backend.indices import aplicar_indices
+from backend.migracao_ids import migrar_referencias_tasks
+from models import UserInDB
+from routers import tasks as rotas_tasks
+
+
+def _id_obj(campo):
+    return {"$cond": {
+        "if": {"$and": [{"$ne": [f"${campo}", None]},
+                        {"$regexMatch": {"input": f"${campo}", "regex": "^[0-9a-fA-F]{24}$"}}]},
+        "then": {"$toObjectId": f"${campo}"},
+        "else": None,
+    }}
+
+
+def _pipeline_antigo(user_id):
+    """Cópia do início do pipeline antigo de list_tasks (até os $lookup)."""
+    return [
+        {"$match": {"user_id": user_id}},
+        {"$sort": {"created_at": -1}},
+        {"$addFields": {"client_id_obj": _id_obj("client_id"), "emitter_id_obj": _id_obj("emitter_id")}},
+        {"$lookup": {"from": "clients", "localField": "client_id_obj", "foreignField": "_id", "as": "cliente"}},
+        {"$unwind": {"path": "$cliente", "preserveNullAndEmptyArrays": True}},
+        {"$lookup": {"from": "emitters", "localField": "emitter_id_obj", "foreignField": "_id", "as": "emissor"}},
+        {"$unwind": {"path": "$emissor", "preserveNullAndEmptyArrays": True}},
+        {"$project": {"response.xml": 0}},
+    ]
+
+
+def _pipeline_novo(user_id):
+    return [
+        {"$match": {"user_id": user_id}},
+        {"$sort": {"created_at": -1}},
+        {"$lookup": {"from": "clients", "localField": "client_id", "foreignField": "_id", "as": "cliente"}},
+        {"$unwind": {"path": "$cliente", "preserveNullAndEmptyArrays": True}},
+        {"$lookup": {"from": "emitters", "localField": "emitter_id", "foreignField": "_id", "as": "emissor"}},
+        {"$unwind": {"path": "$emissor", "preserveNullAndEmptyArrays": True}},
+        {"$project": {"response.xml": 0}},
+    ]
+
+
+def _semear(db, n):
+    user_id = ObjectId()
+    emissores = db.emitters.insert_many(
+        [{"user_id": user_id, "razaoSocial": f"Emissor {i}", "cnpj": f"{i:014d}"} for i in range(20)]
+    ).inserted_ids
+    clientes = db.clients.insert_many(
+        [{"user_id": user_id, "nome": f"Cliente {i}", "cnpj": f"{i + 10 ** 12:014d}"} for i in range(5000)]
+    ).inserted_ids
+
+    rnd = random.Random(42)
+    base = datetime(2025, 1, 1)
+    lote = []
+    for i in range(n):
+        lote.append({
+            "user_id": user_id, "type": "emit_nfse", "status": "accepted",
+            "emitter_id": str(rnd.choice(emissores)), "client_id": str(rnd.choice(clientes)),
+            "valor": round(rnd.uniform(10, 5000), 2), "competencia": "2025-01-01",
+            "created_at": base + timedelta(seconds=i),
+            "response": {"valor": 1.0},
+        })
+        if len(lote) == 10_000:
+            db.tasks.insert_many(lote)
+            lote = []
+    if lote:
+        db.tasks.insert_many(lote)
+    return user_id
+
+
+def _medir(db, pipeline):
+    t0 = time.perf_counter()
+    total = sum(1 for _ in db.tasks.aggregate(pipeline, allowDiskUse=True))
+    return time.perf_counter() - t0, total
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+
+    client = MongoClient(os.getenv("MONGO_URI", "mongodb://localhost:27017"))
+    client.drop_database("nfse_benchmark")
+    db = client["nfse_benchmark"]
+    rotas_tasks.db = db
+
+    try:
+        aplicar_indices(db)
+        user_id = _semear(db, n)
+        print(f"{n} tasks semeadas")
+
+        t_antigo, total = _medir(db, _pipeline_antigo(user_id))
+        print(f"string        {t_antigo * 1000:9.1f} ms  ({total} documentos)")
+
+        t0 = time.perf_counter()
+        alterados = migrar_referencias_tasks(db)
+        print(f"migração      {(time.perf_counter() - t0) * 1000:9.1f} ms  {alterados}")
+
+        t_novo, total = _medir(db, _pipeline_novo(user_id))
+        print(f"ObjectId      {t_novo * 1000:9.1f} ms  ({total} documentos, {t_antigo / t_novo:.1f}x)")
+
+        usuario = UserInDB(_id=str(user_id), email="bench@exemplo.com", hashed_password="x")
+        t0 = time.perf_counter()
+        linhas = rotas_tasks.list_tasks(emitterId=None, status=None, mes=None, ano=None, current_user=usuario)
+        print(f"list_tasks    {(time.perf_counter() - t0) * 1000:9.1f} ms  ({len(linhas)} linhas)")
+    finally:
+        client.drop_database("nfse_benchmark")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Microbenchmark: parse_nfse_response sobre retornos reais da SEFIN.
+
+O corpus fica em benchmarks/respostas_sefin/ (NFS-e autorizada com assinaturas, JSON de
+sucesso com o XML compactado, DPS repetida, E999, erro de validação do gateway, erro de
+esquema em XML e uma página HTML de 502). Compara, para N repetições do corpus:
+
+  - "legado": json.loads por exceção + ~15 varreduras xpath(".//*[local-name()=...]");
+  - "atual":  utils.parse_nfse_response (formato pelo primeiro caractere, uma varredura).
+
+Os dois precisam devolver o mesmo dicionário para cada arquivo (conferido antes da medição).
+
+Uso (na raiz do projeto):
+    python benchmarks/bench_parse_resposta.py [N]
+"""
+from lxml import etree as ET
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import parse_nfse_response
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "respostas_sefin")
+
+
+def _parse_legado(raw: str) -> dict:
+    """Cópia do parse_nfse_response antigo."""
+    out = {
+        "success": False, "protocolo": None, "numero_nfse": None, "codigo": None,
+        "mensagem": None, "erros": [], "valor": None, "bruto": raw or "",
+    }
+    if not raw:
+        return out
+
+    try:
+        data = json.loads(raw)
+        get = lambda *keys: next((str(data.get(k)) for k in keys if data.get(k) not in (None, "")), None)
+        out["protocolo"] = get("protocolo", "numeroProtocolo", "nProtocolo", "protocoloEnvio")
+        out["numero_nfse"] = get("numeroNfse", "nNFSe", "nfse", "numeroNFSe")
+        out["codigo"] = get("codigo", "cod", "codigoRetorno", "status", "statusCode")
+        out["mensagem"] = get("mensagem", "message", "descricao", "detalhe")
+        out["valor"] = data.get("valor") or data.get("valorServico")
+        errs = data.get("erros") or data.get("errosValidacao") or data.get("errors") or []
+        if isinstance(errs, dict):
+            errs = [": ".join([k, str(v)]) for k, v in errs.items()]
+        elif isinstance(errs, list):
+            errs = [str(e.get("mensagem") or e.get("message") or e) for e in errs]
+        else:
+            errs = [str(errs)]
+        out["erros"] = [e for e in errs if e]
+        out["success"] = bool(out["numero_nfse"] or out["protocolo"]) and not out["erros"]
+        return out
+    except Exception:
+        pass
+
+    try:
+        root = ET.fromstring(raw.encode("utf-8") if isinstance(raw, str) else raw)
+        def x(tag): return root.xpath(f".//*[local-name()='{tag}']")
+        def text_first(nodes): return nodes[0].text.strip() if nodes and nodes[0].text else None
+
+        out["protocolo"] = text_first(x("protocolo")) or text_first(x("numeroProtocolo")) or text_first(x("nProtocolo"))
+        out["numero_nfse"] = text_first(x("numeroNfse")) or text_first(x("nNFSe")) or text_first(x("NumeroNFSe"))
+        out["codigo"] = text_first(x("codigo")) or text_first(x("codigoRetorno")) or text_first(x("status"))
+        out["mensagem"] = text_first(x("mensagem")) or text_first(x("descricao")) or text_first(x("message"))
+
+        val_node = x("valorServicos") or x("valorServico") or x("valor") or x("vServ")
+        if val_node:
+            try:
+                out["valor"] = float(val_node[0].text.strip().replace(",", "."))
+            except Exception:
+                pass
+
+        erros_nodes = x("erros") or x("Erros") or x("ListaErros")
+        erros = []
+        for en in erros_nodes:
+            msgs = en.xpath(".//*[local-name()='mensagem' or local-name()='descricao' or local-name()='message']/text()")
+            erros.extend([m.strip() for m in msgs if m and m.strip()])
+        if not erros:
+            for en in x("erro"):
+                t = (en.text or "").strip()
+                if t:
+                    erros.append(t)
+        out["erros"] = erros
+        out["success"] = bool(out["numero_nfse"] or out["protocolo"]) and not out["erros"]
+        return out
+    except Exception:
+        return out
+
+
+def _carregar_corpus() -> dict:
+    corpus = {}
+    for nome in sorted(os.listdir(CORPUS)):
+        with open(os.path.join(CORPUS, nome), encoding="utf-8") as f:
+            corpus[nome] = f.read()
+    return corpus
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    corpus = _carregar_corpus()
+
+    for nome, raw in corpus.items():
+        assert _parse_legado(raw) == parse_nfse_response(raw), f"Resultado divergente em {nome}"
+
+    print(f"{len(corpus)} respostas x {n} repetições")
+    for nome, raw in corpus.items():
+        base = None
+        linha = []
+        for rotulo, fn in (("legado", _parse_legado), ("atual", parse_nfse_response)):
+            t0 = time.perf_counter()
+            for _ in range(n):
+                fn(raw)
+            dt = time.perf_counter() - t0
+            base = base or dt
+            linha.append(f"{rotulo} {dt * 1e6 / n:8.1f} µs")
+        print(f"{nome:<24} {len(raw):>6} B | {' | '.join(linha)} | {base / dt:4.1f}x")
+
+
+if __name__ == "__main__":
+    main()
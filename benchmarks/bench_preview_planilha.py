@@ -0,0 +1,145 @@
+"""
+Benchmark: /notas/preview com uma planilha sintética de 10k linhas.
+
+Gera um XLSX com N linhas (CNPJs, CPFs, documentos desconhecidos, linhas sem documento,
+valores e descrições inválidos), cadastra os clientes num banco descartável e compara:
+
+  - "por linha": validação com df.iterrows() + um find_one por linha (fluxo antigo);
+  - "em lote":   routers.notas._resolver_linhas_preview (um $in por tipo de documento).
+
+Também mede o endpoint completo (leitura do XLSX + validação + gravação dos drafts).
+As duas validações precisam devolver exatamente as mesmas linhas/erros.
+
+Usa MONGO_URI (banco "nfse_benchmark", apagado ao final); com --mock usa mongomock.
+
+Uso (na raiz do projeto):
+    python benchmarks/bench_preview_planilha.py [N] [--mock]
+"""
+from bson import ObjectId
+import asyncio
+import io
+import os
+import random
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import UploadFile
+from pymongo import MongoClient
+from models import UserInDB
+from routers import notas
+from utils import sanitize_document, to_float, canonical_from_label
+
+
+def _resolver_por_linha(db, df, emitter_id, user_id):
+    """Cópia da validação antiga (iterrows + find_one por linha)."""
+    linhas = []
+    for idx, row in df.iterrows():
+        erros = []
+        doc_digits = sanitize_document(row.get("cpf_cnpj"))
+        cliente = None
+        if doc_digits:
+            if len(doc_digits) == 11:
+                cliente = db.clients.find_one({"cpf": doc_digits, "user_id": user_id, "ativo": {"$ne": False}})
+            elif len(doc_digits) == 14:
+                cliente = db.clients.find_one({"cnpj": doc_digits, "user_id": user_id, "ativo": {"$ne": False}})
+        if not cliente and not doc_digits:
+            cliente = db.clients.find_one({"nao_identificado": True, "emissores_ids": emitter_id, "user_id": user_id})
+        elif not cliente:
+            erros.append("Cliente não encontrado ou está inativo")
+        valor = to_float(row.get("valor"))
+        if not valor or valor <= 0:
+            erros.append("Valor inválido")
+        if not row.get("descricao"):
+            erros.append("Descrição obrigatória")
+        linhas.append({"index": idx + 2, "ok": len(erros) == 0, "erros": erros,
+                       "clienteId": str(cliente["_id"]) if cliente else None, **row.to_dict()})
+    return linhas
+
+
+def _semear(db, n):
+    user_id = ObjectId()
+    emitter_id = db.emitters.insert_one({"user_id": user_id, "cnpj": "12345678000195"}).inserted_id
+    db.aliquotas.insert_one({"emitter_id": emitter_id, "ano": 2025, "mes": 1, "aliquota": 0.06})
+    db.clients.insert_one({"nao_identificado": True, "emissores_ids": [str(emitter_id)], "user_id": user_id})
+
+    cnpjs = [f"{i:014d}" for i in range(10_000_000, 10_000_000 + n // 2)]
+    cpfs = [f"{i:011d}" for i in range(20_000_000, 20_000_000 + n // 2)]
+    db.clients.insert_many(
+        [{"cnpj": d, "nome": f"Empresa {d}", "codigoIbge": "3550308", "user_id": user_id} for d in cnpjs]
+        + [{"cpf": d, "nome": f"Pessoa {d}", "codigoIbge": "3304557", "user_id": user_id} for d in cpfs]
+    )
+    db.clients.create_index([("cnpj", 1), ("user_id", 1)])
+    db.clients.create_index([("cpf", 1), ("user_id", 1)])
+
+    rnd = random.Random(42)
+    linhas = []
+    for i in range(n):
+        sorteio = rnd.random()
+        if sorteio < 0.45:
+            d = rnd.choice(cnpjs)
+            doc = f"{d[:2]}.{d[2:5]}.{d[5:8]}/{d[8:12]}-{d[12:]}"
+        elif sorteio < 0.9:
+            doc = rnd.choice(cpfs)
+        elif sorteio < 0.95:
+            doc = f"{rnd.randrange(10 ** 13):014d}"  # não cadastrado
+        else:
+            doc = ""  # tomador não identificado
+        valor = "" if rnd.random() < 0.02 else f"{rnd.uniform(10, 5000):.2f}".replace(".", ",")
+        descricao = "" if rnd.random() < 0.02 else f"Serviço prestado {i}"
+        linhas.append({"CPF/CNPJ": doc, "Valor": valor, "Descrição do serviço": descricao, "Competência": "01/2025"})
+
+    buffer = io.BytesIO()
+    pd.DataFrame(linhas).to_excel(buffer, index=False)
+    return user_id, str(emitter_id), buffer.getvalue()
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    n = int(args[0]) if args else 10_000
+
+    if "--mock" in sys.argv:
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        client = MongoClient(os.getenv("MONGO_URI", "mongodb://localhost:27017"))
+    client.drop_database("nfse_benchmark")
+    db = client["nfse_benchmark"]
+    notas.db = db
+
+    try:
+        user_id, emitter_id, xlsx = _semear(db, n)
+        print(f"Planilha sintética: {n} linhas, {len(xlsx) / 1024:.0f} KiB")
+
+        df = pd.read_excel(io.BytesIO(xlsx), dtype=str)
+        df = df.rename(columns={c: canonical_from_label(c) for c in df.columns}).fillna("").reset_index(drop=True)
+
+        t0 = time.perf_counter()
+        antigas = _resolver_por_linha(db, df, emitter_id, user_id)
+        t_antigo = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        novas, _ = notas._resolver_linhas_preview(df, emitter_id, user_id)
+        t_novo = time.perf_counter() - t0
+
+        assert antigas == novas, "validação em lote divergiu da validação por linha"
+        print(f"por linha     {t_antigo * 1000:9.1f} ms")
+        print(f"em lote       {t_novo * 1000:9.1f} ms  ({t_antigo / t_novo:.1f}x)")
+
+        usuario = UserInDB(_id=str(user_id), email="bench@exemplo.com", hashed_password="x")
+        upload = UploadFile(file=io.BytesIO(xlsx), filename="bench.xlsx")
+        t0 = time.perf_counter()
+        resp = asyncio.run(notas.notas_preview(emitterId=emitter_id, competenciaDefault=None, file=upload,
+                                               persist="1", current_user=usuario))
+        print(f"endpoint      {(time.perf_counter() - t0) * 1000:9.1f} ms  "
+              f"({resp['validas']} válidas, {resp['invalidas']} inválidas, "
+              f"{db.tasks_draft.count_documents({})} drafts gravados)")
+    finally:
+        client.drop_database("nfse_benchmark")
+
+
+if __name__ == "__main__":
+    main()
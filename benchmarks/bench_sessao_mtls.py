@@ -0,0 +1,164 @@
+"""
+Benchmark: envio mTLS com sessão persistente x requests_pkcs12 por chamada.
+
+Sobe um servidor HTTPS local que exige certificado de cliente (simulando a SEFIN),
+gera uma CA, o certificado do servidor e um PFX de cliente descartáveis, e mede
+N envios sequenciais do mesmo emissor:
+
+  - "por chamada": requests_pkcs12.post(..., pkcs12_filename=...) (comportamento antigo:
+    relê o PFX, monta o contexto SSL e faz handshake completo a cada envio);
+  - "sessão":      backend.transmitter.enviar_nfse_pkcs12 (pool de sessões keep-alive).
+
+Uso (na raiz do projeto):
+    python benchmarks/bench_sessao_mtls.py [N]
+"""
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import pkcs12
+from cryptography.x509.oid import NameOID
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import contextlib
+import io
+import json
+import os
+import ssl
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SENHA_PFX = "benchmark"
+
+
+def _gerar_certificado(nome, emissor=None, chave_emissor=None, ca=False):
+    chave = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    sujeito = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, nome)])
+    agora = datetime.utcnow()
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(sujeito)
+        .issuer_name(emissor.subject if emissor else sujeito)
+        .public_key(chave.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(agora - timedelta(days=1))
+        .not_valid_after(agora + timedelta(days=1))
+        .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True)
+    )
+    if nome == "localhost":
+        builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName("localhost")]), critical=False)
+    cert = builder.sign(chave_emissor or chave, hashes.SHA256())
+    return chave, cert
+
+
+def _pem(chave=None, cert=None):
+    if cert is not None:
+        return cert.public_bytes(serialization.Encoding.PEM)
+    return chave.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()
+    )
+
+
+def _preparar_certificados(pasta):
+    ca_key, ca_cert = _gerar_certificado("CA Benchmark", ca=True)
+    srv_key, srv_cert = _gerar_certificado("localhost", ca_cert, ca_key)
+    cli_key, cli_cert = _gerar_certificado("Emissor Benchmark", ca_cert, ca_key)
+
+    arquivos = {
+        "ca": os.path.join(pasta, "ca.pem"),
+        "srv_cert": os.path.join(pasta, "srv.pem"),
+        "srv_key": os.path.join(pasta, "srv.key"),
+        "pfx": os.path.join(pasta, "cliente.pfx"),
+    }
+    with open(arquivos["ca"], "wb") as f:
+        f.write(_pem(cert=ca_cert))
+    with open(arquivos["srv_cert"], "wb") as f:
+        f.write(_pem(cert=srv_cert))
+    with open(arquivos["srv_key"], "wb") as f:
+        f.write(_pem(chave=srv_key))
+    with open(arquivos["pfx"], "wb") as f:
+        f.write(pkcs12.serialize_key_and_certificates(
+            b"cliente", cli_key, cli_cert, None,
+            serialization.BestAvailableEncryption(SENHA_PFX.encode())
+        ))
+    return arquivos
+
+
+class _SefinFalsa(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        corpo = json.dumps({"idDps": "DPS123", "chaveAcesso": "1" * 50}).encode()
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def log_message(self, *args):
+        pass
+
+
+def _subir_servidor(arquivos):
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(arquivos["srv_cert"], arquivos["srv_key"])
+    ctx.load_verify_locations(arquivos["ca"])
+    ctx.verify_mode = ssl.CERT_REQUIRED
+
+    servidor = ThreadingHTTPServer(("localhost", 0), _SefinFalsa)
+    servidor.socket = ctx.wrap_socket(servidor.socket, server_side=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+def _medir(nome, enviar, n):
+    tempos = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        enviar()
+        tempos.append((time.perf_counter() - t0) * 1000)
+    print(f"{nome:<14} total {sum(tempos):8.1f} ms | média {statistics.mean(tempos):6.2f} ms "
+          f"| mediana {statistics.median(tempos):6.2f} ms | p95 {sorted(tempos)[int(n * 0.95) - 1]:6.2f} ms")
+    return sum(tempos)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    with tempfile.TemporaryDirectory() as pasta:
+        arquivos = _preparar_certificados(pasta)
+        os.environ["REQUESTS_CA_BUNDLE"] = arquivos["ca"]
+        servidor = _subir_servidor(arquivos)
+        url = f"https://localhost:{servidor.server_address[1]}/SefinNacional/nfse"
+
+        from requests_pkcs12 import post as pkcs12_post
+        from backend import transmitter
+        transmitter.URL_PRODUCAO = url
+
+        payload = {"dpsXmlGZipB64": "H4sIAAAAAAAAA7OxL8hIBQBH6bZkBAAAAA=="}
+
+        def por_chamada():
+            pkcs12_post(url, json=payload, pkcs12_filename=arquivos["pfx"], pkcs12_password=SENHA_PFX,
+                        timeout=30, verify=True)
+
+        def sessao():
+            with contextlib.redirect_stdout(io.StringIO()):  # silencia os prints de debug
+                transmitter.enviar_nfse_pkcs12(payload["dpsXmlGZipB64"], arquivos["pfx"], SENHA_PFX)
+
+        print(f"{n} envios sequenciais do mesmo emissor para {url}")
+        antes = _medir("por chamada", por_chamada, n)
+        depois = _medir("sessão", sessao, n)
+        print(f"ganho: {antes / depois:.1f}x")
+
+        transmitter.invalidar_sessoes()
+        servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-import { useEffect, useState, useMemo, useRef, useCallback } from "react";
+import { useEffect, useState, useRef, useCallback } from "react";
 import {
   CircleCheck,
   CircleX,
@@ -13,6 +13,7 @@ import {
 } from "lucide-react";
 import {
   getTasks,
+  getEmitters,
   getResumo,
   getClientStats,
   downloadAllXml,
@@ -29,7 +30,13 @@ import {
 import "../styles/Dashboard.css";
 
 export default function Dashboard() {
-  const [tasks, setTasks] = useState([]);
+  const [tasks, setTasks] = useState([]); // só a página atual
+  const [totalTasks, setTotalTasks] = useState(0);
+  const [porStatus, setPorStatus] = useState({});
+  const [cursores, setCursores] = useState([null]); // cursores[i] = cursor da página i + 1
+  const [proximoCursor, setProximoCursor] = useState(null);
+  const [emissores, setEmissores] = useState([]);
+  const [buscaAplicada, setBuscaAplicada] = useState("");
   const [resumo, setResumo] = useState([]);
   const [mes, setMes] = useState(new Date().getMonth() + 1);
   const [ano, setAno] = useState(new Date().getFullYear());
@@ -68,20 +75,53 @@ export default function Dashboard() {
   const menuRef = useRef(null);
   const batchMenuRef = useRef(null);
 
+  // Cada busca recebe um número; só a mais recente pode gravar o resultado (uma troca de filtro
+  // dispara duas buscas, e a da página/cursor antigos pode terminar depois da nova)
+  const ultimaBuscaRef = useRef(0);
+
   const fetchData = useCallback(async () => {
+    const busca = ++ultimaBuscaRef.current;
     try {
       const [tasksRes, resumoRes, clientsStatsRes] = await Promise.all([
-        getTasks({ mes, ano }),
+        getTasks({
+          mes,
+          ano,
+          status: filtroStatus || undefined,
+          emitterId: filtroEmissor || undefined,
+          busca: buscaAplicada || undefined,
+          limit: itemsPerPage,
+          cursor: cursores[currentPage - 1] || undefined,
+        }),
         getResumo(mes, ano),
         getClientStats(),
       ]);
-      setTasks(tasksRes);
+      if (busca !== ultimaBuscaRef.current) return;
+      setTasks(tasksRes.items);
+      setTotalTasks(tasksRes.total);
+      setPorStatus(tasksRes.por_status || {});
+      setProximoCursor(tasksRes.next_cursor);
       setResumo(resumoRes);
       setClientStats(clientsStatsRes);
     } catch (err) {
       console.error("Erro ao carregar dados:", err);
     }
-  }, [mes, ano]);
+  }, [mes, ano, filtroStatus, filtroEmissor, buscaAplicada, itemsPerPage, cursores, currentPage]);
+
+  // Filtros mudaram: volta para a primeira página (os cursores antigos não valem mais)
+  useEffect(() => {
+    setCursores((prev) => (prev.length === 1 ? prev : [null]));
+    setCurrentPage(1);
+  }, [mes, ano, filtroStatus, filtroEmissor, buscaAplicada, itemsPerPage]);
+
+  // Busca no servidor só depois que o usuário para de digitar
+  useEffect(() => {
+    const id = setTimeout(() => setBuscaAplicada(searchTerm.trim()), 400);
+    return () => clearTimeout(id);
+  }, [searchTerm]);
+
+  useEffect(() => {
+    getEmitters().then(setEmissores).catch((err) => console.error("Erro ao carregar emissores:", err));
+  }, []);
 
   useEffect(() => {
     fetchData();
@@ -107,47 +147,21 @@ export default function Dashboard() {
     setSelectedTaskIds([]);
   }, [currentPage, itemsPerPage, filtroStatus]);
 
-  const notasPorStatus = tasks.reduce(
-    (acc, task) => {
-      const st = (task.status || "").toLowerCase();
-      if (st === "accepted") acc.sucesso++;
-      else if (st === "pending") acc.pending++;
-      else if (st === "error") acc.erro++;
-      else if (st === "canceled") acc.cancelado++;
-      return acc;
-    },
-    { sucesso: 0, pending: 0, erro: 0, cancelado: 0 }
-  );
-
-  const filteredTasks = useMemo(() => {
-      const term = searchTerm.toLowerCase().trim();
-      const cleanTerm = term.replace(/\D/g, "");
-
-      return tasks
-        .filter((t) => {
-          if (!term) return true;
-
-          const nome = (t.cliente_nome || "").toLowerCase();
-          const doc = (t.cliente_documento || "").toLowerCase();
-          const docDigits = doc.replace(/\D/g, "");
-
-          return (
-            nome.includes(term) ||
-            doc.includes(term) ||
-            (cleanTerm && docDigits.includes(cleanTerm))
-          );
-        })
-        .filter((t) => (filtroEmissor ? t.emissor_nome === filtroEmissor : true))
-        .filter((t) =>
-          filtroStatus ? (t.status || "").toLowerCase() === filtroStatus : true
-        );
-    }, [tasks, searchTerm, filtroEmissor, filtroStatus]);
+  const notasPorStatus = {
+    sucesso: porStatus.accepted || 0,
+    pending: porStatus.pending || 0,
+    erro: porStatus.error || 0,
+    cancelado: porStatus.canceled || 0,
+  };
 
-  const totalPages = Math.ceil(filteredTasks.length / itemsPerPage);
-  const startIndex = (currentPage - 1) * itemsPerPage;
-  const currentTasks = filteredTasks.slice(startIndex, startIndex + itemsPerPage);
+  const totalPages = Math.ceil(totalTasks / itemsPerPage);
+  const currentTasks = tasks;
 
-  const emissoresUnicos = [...new Set(tasks.map((t) => t.emissor_nome).filter(Boolean))];
+  const irParaProximaPagina = () => {
+    if (!proximoCursor) return;
+    setCursores((prev) => [...prev.slice(0, currentPage), proximoCursor]);
+    setCurrentPage((p) => p + 1);
+  };
 
   // Labels de Status
   const statusLabels = {
@@ -156,12 +170,13 @@ export default function Dashboard() {
     error: "Erro",
     canceled: "Cancelada",
     retry_dps: "Emitindo...",
+    transmitting: "Transmitindo...",
   };
 
   // --- Funções de Download (Lote) ---
 const handleDownloadFiltered = async () => {
     const hasSelection = selectedTaskIds.length > 0;
-    const hasItems = filteredTasks.length > 0;
+    const hasItems = totalTasks > 0;
 
     if (!hasSelection && !hasItems) {
       window.notify("Nenhuma nota encontrada ou selecionada.", "error");
@@ -178,7 +193,7 @@ const handleDownloadFiltered = async () => {
       "info"
     );
 
-    const emitterId = filtroEmissor ? filteredTasks[0]?.emitter_id : undefined;
+    const emitterId = filtroEmissor || undefined;
 
     // Se tiver seleção, envia os IDs. Se não, envia undefined (o backend usará mes/ano)
     const taskIdsToSend = hasSelection ? selectedTaskIds : undefined;
@@ -201,7 +216,7 @@ const handleDownloadFiltered = async () => {
 
   const handleDownloadFilteredPDF = async () => {
     const hasSelection = selectedTaskIds.length > 0;
-    const hasItems = filteredTasks.length > 0;
+    const hasItems = totalTasks > 0;
 
     if (!hasSelection && !hasItems) {
       window.notify("Nenhuma nota encontrada ou selecionada.", "error");
@@ -218,7 +233,7 @@ const handleDownloadFiltered = async () => {
       "info"
     );
 
-    const emitterId = filtroEmissor ? filteredTasks[0]?.emitter_id : undefined;
+    const emitterId = filtroEmissor || undefined;
     const taskIdsToSend = hasSelection ? selectedTaskIds : undefined;
 
     try {
@@ -586,7 +601,7 @@ const handleDownloadFiltered = async () => {
                 e.stopPropagation();
                 setOpenMenuId(openMenuId === "batch" ? null : "batch");
               }}
-              disabled={filteredTasks.length === 0}
+              disabled={totalTasks === 0}
             >
               <Download size={16}/> Baixar em lote
             </button>
@@ -614,16 +629,16 @@ const handleDownloadFiltered = async () => {
             placeholder="Buscar por nome ou CNPJ/CPF do cliente..."
             className="table-search-input"
             value={searchTerm}
-            onChange={(e) => { setSearchTerm(e.target.value); setCurrentPage(1); }}
+            onChange={(e) => setSearchTerm(e.target.value)}
           />
         </div>
         <select
           className="table-filter-select"
           value={filtroEmissor}
-          onChange={(e) => { setFiltroEmissor(e.target.value); setCurrentPage(1); }}
+          onChange={(e) => setFiltroEmissor(e.target.value)}
         >
           <option value="">Todos os Emissores</option>
-          {emissoresUnicos.map((emissor) => (<option key={emissor} value={emissor}>{emissor}</option>))}
+          {emissores.map((emissor) => (<option key={emissor._id} value={emissor._id}>{emissor.razaoSocial}</option>))}
         </select>
       </div>
 
@@ -672,7 +687,8 @@ const handleDownloadFiltered = async () => {
               // Verificações
               const isAccepted = status === "accepted";
               const isCanceled = status === "canceled";
-              const isRetry = status === "retry_dps"; // Detecta se é o retry
+              // Detecta se é o retry ou se a nota está em transmissão agora (mesmo visual)
+              const isRetry = status === "retry_dps" || status === "transmitting";
               const isSelected = selectedTaskIds.includes(t._id);
 
               // Se for retry, forçamos a cor de 'pending' (amarelo/azul) para não quebrar o CSS
@@ -817,18 +833,18 @@ const handleDownloadFiltered = async () => {
       </table>
 
       {/* Paginação */}
-      {filteredTasks.length > 0 && (
+      {totalTasks > 0 && (
         <div className="pagination-controls">
           <div>
             <label htmlFor="itemsPerPage">Itens por página: </label>
-            <select id="itemsPerPage" value={itemsPerPage} onChange={(e) => { setItemsPerPage(Number(e.target.value)); setCurrentPage(1); }}>
+            <select id="itemsPerPage" value={itemsPerPage} onChange={(e) => setItemsPerPage(Number(e.target.value))}>
               <option value={25}>25</option><option value={50}>50</option><option value={100}>100</option>
             </select>
           </div>
-          <span> Página {currentPage} de {totalPages || 1} ({filteredTasks.length} notas) </span>
+          <span> Página {currentPage} de {totalPages || 1} ({totalTasks} notas) </span>
           <div>
             <button onClick={() => setCurrentPage(p => Math.max(1, p - 1))} disabled={currentPage === 1}>Anterior</button>
-            <button onClick={() => setCurrentPage(p => Math.min(totalPages, p + 1))} disabled={currentPage === totalPages || totalPages === 0}>Próxima</button>
+            <button onClick={irParaProximaPagina} disabled={!proximoCursor}>Próxima</button>
           </div>
         </div>
       )}
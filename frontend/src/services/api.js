@@ -202,14 +202,32 @@ export async function notasPreview({ emitterId, file, competenciaDefault, persis
   return response.data;
 }
 
+// A geração (montagem + assinatura) roda em background no backend: o POST devolve um
+// job_id e aqui acompanhamos até terminar, devolvendo o mesmo { msg, task_ids, erros } de antes.
+// O backend marca como 'error' um job parado; o limite aqui só evita um polling sem fim.
+async function aguardarEmissao(jobId, intervaloMs = 2000, limiteMs = 30 * 60 * 1000) {
+  const limite = Date.now() + limiteMs;
+  while (Date.now() < limite) {
+    const { data } = await apiClient.get(`/notas/confirmar/status/${jobId}`);
+    if (data.status === 'finished') {
+      return { msg: data.msg, task_ids: data.task_ids || [], erros: data.erros || [] };
+    }
+    if (data.status === 'error') {
+      throw new Error(data.msg || 'Falha ao gerar XMLs.');
+    }
+    await new Promise((resolve) => setTimeout(resolve, intervaloMs));
+  }
+  throw new Error('Tempo esgotado aguardando a geração dos XMLs. Confira as notas criadas antes de gerar novamente.');
+}
+
 export async function notasConfirmar({ emitterId, items }) {
   const response = await apiClient.post('/notas/confirmar', { emitterId, items });
-  return response.data;
+  return aguardarEmissao(response.data.job_id);
 }
 
 export async function notasConfirmarFromDrafts({ emitterId, draftIds }) {
   const response = await apiClient.post('/notas/confirmar-from-drafts', { emitterId, draftIds });
-  return response.data;
+  return aguardarEmissao(response.data.job_id);
 }
 
 /* =======================
@@ -272,8 +290,12 @@ export async function draftsReconcile({ emitterId, preview_batch_id, keep_indice
 /* =======================
  * TASKS
  * ======================= */
-export async function getTasks({ emitterId, status, mes, ano } = {}) {
-  const response = await apiClient.get('/tasks', { params: { emitterId, status, mes, ano } });
+// Página de tasks: { items, next_cursor, total, por_status }.
+// Para a próxima página, repasse o next_cursor recebido como `cursor`.
+export async function getTasks({ emitterId, status, mes, ano, busca, limit, cursor, fields } = {}) {
+  const response = await apiClient.get('/tasks', {
+    params: { emitterId, status, mes, ano, busca, limit, cursor, fields },
+  });
   return response.data;
 }
 
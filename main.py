@@ -1,6 +1,6 @@
 import uvicorn
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Header
+from fastapi.responses import FileResponse, PlainTextResponse
 import tempfile
 from fastapi import Path
 from fastapi.middleware.cors import CORSMiddleware
@@ -9,16 +9,36 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from bson import ObjectId
 from db import db
 import pandas as pd
-import traceback
 import os
 import glob
 import logging
-import builtins
-from logging.handlers import RotatingFileHandler
+import time
 from datetime import datetime as dt
 from datetime import datetime
 from backend.signer import assinar_xml
-from backend.transmitter import baixar_danfse_pdf
+from backend.transmitter import baixar_danfse_pdf, invalidar_sessoes
+from backend.cert_cache import invalidar_certificado
+from backend.indices import aplicar_indices
+from backend.logs import configurar_logs
+from backend.metricas import (
+    BACKLOG_PDF,
+    TASKS_TRANSMITIDAS,
+    atualizar_backlog,
+    exportar as exportar_metricas,
+    medir_job,
+    observar_scheduler
+)
+from backend.blob_store import descarregar_resultado, guardar_pdf_base64, texto_campo
+from backend.faturamento import registrar_mudanca_status, carregar_faturamento_se_vazio
+from backend.nfse_campos import CAMPO_NFSE, extrair_campos_nfse
+from backend.worker import (
+    drenar_fila,
+    reivindicar_pendente,
+    reivindicar_task,
+    finalizar_task,
+    liberar_task,
+    manter_leases
+)
 from utils import (
     serialize_doc,
     extrair_validade_certificado,
@@ -26,7 +46,8 @@ from utils import (
     parse_nfse_response,
     substituir_dps_no_xml,
     is_dps_repetida,
-    next_dps,
+    next_dps_block,
+    registrar_dps_nao_usados,
     sanitize_document,
     remover_assinatura
 )
@@ -38,38 +59,14 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-# ==============================================================================
-# --- CONFIGURAÇÃO DE LOGS (COM REDIRECIONAMENTO DOS PRINTS) ---
-# ==============================================================================
-os.makedirs("logs", exist_ok=True)
-LOG_FILE = os.path.join("logs", "nfse_api.log")
-
-formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s", datefmt="%d/%m/%Y %H:%M:%S")
-file_handler = RotatingFileHandler(LOG_FILE, mode='a', maxBytes=5 * 1024 * 1024, backupCount=5, encoding="utf-8")
-file_handler.setFormatter(formatter)
-
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(formatter)
-
-logging.basicConfig(level=logging.INFO, handlers=[file_handler, console_handler])
-logging.getLogger("watchfiles.main").setLevel(logging.WARNING)
-logging.getLogger("apscheduler.scheduler").setLevel(logging.WARNING)
-logging.getLogger("apscheduler.executors.default").setLevel(logging.WARNING)
-
-
-def print_to_log(*args, **kwargs):
-    msg = " ".join(map(str, args))
-    logging.info(msg)
-    builtins._original_print(*args, **kwargs)
-
-
-if not hasattr(builtins, "_original_print"):
-    builtins._original_print = builtins.print
-    builtins.print = print_to_log
-# ==============================================================================
+# Logs: fila + thread de escrita (backend/logs.py)
+configurar_logs()
+log = logging.getLogger("nfse.transmissao")
 
 
 UPLOAD_DIR = "uploads/certificados"
+# Se definido, GET /metrics exige "Authorization: Bearer <METRICAS_TOKEN>"
+METRICAS_TOKEN = os.getenv("METRICAS_TOKEN")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 app = FastAPI(title="NFSe Nacional")
 
@@ -108,6 +105,10 @@ async def upload_certificate(emitter_id: str, file: UploadFile = File(...), senh
     with open(filepath, "wb") as buffer:
         buffer.write(await file.read())
 
+    # 🔹 certificado trocado: descarta o PFX decifrado em cache e as sessões mTLS do anterior
+    invalidar_certificado(emitter.get("certificado_path"), filepath)
+    invalidar_sessoes(emitter.get("certificado_path"), filepath)
+
     # 🔹 extrai validade real do certificado
     validade = extrair_validade_certificado(filepath, senha)
 
@@ -275,233 +276,327 @@ def download_template_notas():
 # ======================================================
 # 🔹 Função que transmite tasks pendentes automaticamente
 # ======================================================
-def process_pending_nfse():
-    """Busca tasks pendentes e transmite automaticamente via prefeitura."""
+def _transmitir_task(t, emissores_cache, devolvidas):
+    """
+    Transmite uma task já reservada (status 'transmitting' com lease deste worker) e grava
+    o resultado (roda numa thread do pool). Tasks que voltam para 'pending' nesta rodada
+    entram em 'devolvidas' para não serem reivindicadas de novo até a próxima.
+    """
+
+    def _devolver():
+        liberar_task(db, t)
+        devolvidas.add(t["_id"])
+
+    task_id = str(t["_id"])
+    emitter_id = t.get("emitter_id")
+    campos = {"task_id": task_id, "emitter_id": str(emitter_id) if emitter_id else None}
     try:
-        pendentes = list(db.tasks.find({"status": "pending"}).limit(5))
-        if not pendentes:
+        if not emitter_id:
+            log.warning("Task sem emitter_id, ignorando.", extra=campos)
+            _devolver()
             return
 
-        print(f"Encontradas {len(pendentes)} tasks pendentes")
-
-        for t in pendentes:
-            try:
-                task_id = str(t["_id"])
-                emitter_id = t.get("emitter_id")
-                if not emitter_id:
-                    print(f"Task {task_id} sem emitter_id, ignorando.")
-                    continue
+        # 🔹 Busca emissor e certificado (uma vez por emissor na rodada)
+        cache_key = (str(emitter_id), str(t["user_id"]))
+        if cache_key not in emissores_cache:
+            emissores_cache[cache_key] = db.emitters.find_one({"_id": ObjectId(emitter_id), "user_id": t["user_id"]})
+        emitter = emissores_cache[cache_key]
+        if not emitter:
+            log.warning("Emissor da task não encontrado.", extra=campos)
+            _devolver()
+            return
 
-                # 🔹 Busca emissor e certificado
-                emitter = db.emitters.find_one({"_id": ObjectId(emitter_id), "user_id": t["user_id"]})
-                if not emitter:
-                    print(f"Emissor da task {task_id} não encontrado.")
-                    continue
+        if not emitter.get("certificado_path"):
+            log.warning("Emissor sem certificado.", extra=campos)
+            _devolver()
+            return
 
-                if not emitter.get("certificado_path"):
-                    print(f"Emissor {emitter_id} sem certificado.")
-                    continue
+        xml_assinado = texto_campo(db, t.get("response"), "xml")
+        if not xml_assinado:
+            log.warning("Task sem XML assinado, ignorando.", extra=campos)
+            _devolver()
+            return
 
-                xml_assinado = (t.get("response") or {}).get("xml")
-                if not xml_assinado:
-                    print(f"Task {task_id} sem XML assinado, ignorando.")
-                    continue
+        # 🔹 Compacta XML e codifica em Base64 (como prefeitura exige)
+        dps_b64 = gerar_dpsXmlGZipB64(xml_assinado)
+        pfx_pwd = emitter.get("senha_certificado") or ""
+
+        log.debug("Enviando task para prefeitura...", extra=campos)
+        inicio = time.perf_counter()
+        resp = enviar_nfse_pkcs12(dps_b64, emitter["certificado_path"], pfx_pwd)
+        campos["duracao_ms"] = round((time.perf_counter() - inicio) * 1000)
+
+        raw_resp = resp.get("body", "")
+        status_code = resp.get("status", 0)
+        xml_nfse = resp.get("xml_nfse")
+        pdf_base64 = resp.get("pdf_base64")
+        id_dps = resp.get("id_dps")
+        chave_acesso = resp.get("chave_acesso")
+
+        receipt = parse_nfse_response(xml_nfse) if xml_nfse else parse_nfse_response(raw_resp)
+
+        if not receipt.get("numero_nfse") and chave_acesso:
+            receipt["numero_nfse"] = str(chave_acesso)
+
+        # 1. PEGAR OS ERROS E VERIFICAR O E999
+        erros_portal = receipt.get("erros", [])
+        # no seu banco o erro vem como uma string dentro da lista, o 'str(e)' garante a leitura
+        tem_erro_e999 = any("E999" in str(e) for e in erros_portal)
+
+        if status_code in (200, 201) and (xml_nfse or chave_acesso) and not receipt.get("erros"):
+            receipt["success"] = True
+
+        # 2. DECIDIR O STATUS (Agora incluindo o E999 como gatilho de Retry)
+        if is_dps_repetida(receipt) or tem_erro_e999:
+            new_status = "retry_dps"
+            log.warning("Task detectada como E999 ou Duplicada. Enviando para retry_dps.", extra=campos)
+        else:
+            new_status = "accepted" if (
+                    status_code in (200, 201)
+                    and (receipt.get("success") or xml_nfse or chave_acesso)
+            ) else "error"
+
+        update_set = {
+            "status": new_status,
+            "sent_at": datetime.utcnow(),
+            "transmit": {
+                "http_status": status_code,
+                "raw_response": raw_resp,
+                "receipt": receipt,
+                "xml_nfse": xml_nfse,
+                "pdf_base64": pdf_base64,
+                "id_dps": id_dps,
+                "chave_acesso": chave_acesso,
+            }
+        }
 
-                # 🔹 Compacta XML e codifica em Base64 (como prefeitura exige)
-                dps_b64 = gerar_dpsXmlGZipB64(xml_assinado)
-                pfx_pwd = emitter.get("senha_certificado") or ""
+        if new_status == "accepted":
+            update_set[CAMPO_NFSE] = extrair_campos_nfse(xml_nfse or xml_assinado)
 
-                print(f"Enviando task {task_id} para prefeitura...")
-                resp = enviar_nfse_pkcs12(dps_b64, emitter["certificado_path"], pfx_pwd)
+    except Exception as e:
+        erro_str = str(e)
+        log.exception("Erro ao processar task: %s", erro_str, extra=campos)
+
+        # 1. Pega o número atual de tentativas (se não existir, começa em 0)
+        tentativas_atuais = t.get("retry_count", 0)
+        MAX_TENTATIVAS = 5
+
+        # 2. Verifica se é erro de conexão
+        if "RemoteDisconnected" in erro_str or "Connection aborted" in erro_str or "ConnectionError" in erro_str:
+            if tentativas_atuais < MAX_TENTATIVAS:
+                log.warning("Queda de conexão. Tentativa %s/%s. Mantendo como pending.",
+                            tentativas_atuais + 1, MAX_TENTATIVAS, extra=campos)
+                finalizar_task(
+                    db, t["_id"],
+                    {"$set": {
+                        "status": "pending",
+                        "retry_count": tentativas_atuais + 1,
+                        "updated_at": datetime.utcnow()
+                    }}
+                )
+                devolvidas.add(t["_id"])
 
-                raw_resp = resp.get("body", "")
-                status_code = resp.get("status", 0)
-                xml_nfse = resp.get("xml_nfse")
-                pdf_base64 = resp.get("pdf_base64")
-                id_dps = resp.get("id_dps")
-                chave_acesso = resp.get("chave_acesso")
+            else:
+                log.error("Limite de tentativas excedido. Marcando como erro.", extra=campos)
+                finalizar_task(
+                    db, t["_id"],
+                    {"$set": {
+                        "status": "error",
+                        "error_at": datetime.utcnow(),
+                        "transmit": {
+                            "error": f"O Portal Nacional está instável. Tentamos enviar {MAX_TENTATIVAS} vezes sem sucesso."}
+                    }}
 
-                receipt = parse_nfse_response(xml_nfse) if xml_nfse else parse_nfse_response(raw_resp)
+                )
 
-                if not receipt.get("numero_nfse") and chave_acesso:
-                    receipt["numero_nfse"] = str(chave_acesso)
+        else:
+            # Se for outro tipo de erro (ex: erro de código, XML inválido), vai para error direto
+            finalizar_task(
+                db, t["_id"],
+                {"$set": {
+                    "status": "error",
+                    "error_at": datetime.utcnow(),
+                    "transmit": {"error": erro_str}
+                }}
+            )
 
-                # 1. PEGAR OS ERROS E VERIFICAR O E999
-                erros_portal = receipt.get("erros", [])
-                # no seu banco o erro vem como uma string dentro da lista, o 'str(e)' garante a leitura
-                tem_erro_e999 = any("E999" in str(e) for e in erros_portal)
+    else:
+        # Gravação fora do try do envio: a SEFIN já respondeu, e uma falha daqui em diante
+        # não pode rebaixar o resultado (uma nota autorizada) para 'error'
+        try:
+            if finalizar_task(db, t["_id"], descarregar_resultado(db, update_set, xml_assinado)):
+                registrar_mudanca_status(db, t, new_status)
+                TASKS_TRANSMITIDAS.inc(status=new_status)
+                log.info("Task atualizada para '%s' (HTTP %s)", new_status, status_code, extra=campos)
+        except Exception:
+            log.critical("Falha gravando o resultado '%s' (chave %s); a task volta para a fila quando o lease expirar",
+                         new_status, chave_acesso, extra=campos, exc_info=True)
 
-                if status_code in (200, 201) and (xml_nfse or chave_acesso) and not receipt.get("erros"):
-                    receipt["success"] = True
 
-                # 2. DECIDIR O STATUS (Agora incluindo o E999 como gatilho de Retry)
-                if is_dps_repetida(receipt) or tem_erro_e999:
-                    new_status = "retry_dps"
-                    print(f"?? Task {task_id} detectada como E999 ou Duplicada. Enviando para retry_dps.")
-                else:
-                    new_status = "accepted" if (
-                            status_code in (200, 201)
-                            and (receipt.get("success") or xml_nfse or chave_acesso)
-                    ) else "error"
-
-                update_set = {
-                    "status": new_status,
-                    "sent_at": datetime.utcnow(),
-                    "transmit": {
-                        "http_status": status_code,
-                        "raw_response": raw_resp,
-                        "receipt": receipt,
-                        "xml_nfse": xml_nfse,
-                        "pdf_base64": pdf_base64,
-                        "id_dps": id_dps,
-                        "chave_acesso": chave_acesso,
-                    }
-                }
-
-                db.tasks.update_one({"_id": ObjectId(task_id)}, {"$set": update_set})
-                print(f"Task {task_id} atualizada para '{new_status}'")
+@medir_job("process_pending_nfse")
+def process_pending_nfse():
+    """
+    Drena a fila de tasks pendentes com o pool de transmissão (backend/worker.py).
+    Cada task é reservada com lease antes do envio, então várias réplicas podem rodar
+    este job ao mesmo tempo sem transmitir a mesma DPS duas vezes. A concorrência é
+    limitada no total e por emissor; quedas de conexão voltam para a próxima rodada.
+    """
+    em_transmissao = set()
+    parar_heartbeat = manter_leases(db, em_transmissao)
+    try:
+        emissores_cache = {}
+        devolvidas = set()
 
+        def reivindicar(emissores_saturados):
+            t = reivindicar_pendente(db, excluir_ids=devolvidas, excluir_emissores=emissores_saturados)
+            if t:
+                em_transmissao.add(t["_id"])
+            return t
 
-            except Exception as e:
-                erro_str = str(e)
-                print(f"Erro ao processar task {t.get('_id')}: {erro_str}")
-                traceback.print_exc()
-
-                # 1. Pega o número atual de tentativas (se não existir, começa em 0)
-                tentativas_atuais = t.get("retry_count", 0)
-                MAX_TENTATIVAS = 5
-
-                # 2. Verifica se é erro de conexão
-                if "RemoteDisconnected" in erro_str or "Connection aborted" in erro_str or "ConnectionError" in erro_str:
-                    if tentativas_atuais < MAX_TENTATIVAS:
-                        print(
-                            f"Queda de conexão na task {t.get('_id')}. Tentativa {tentativas_atuais + 1}/{MAX_TENTATIVAS}. Mantendo como pending.")
-                        db.tasks.update_one(
-                            {"_id": t["_id"]},
-                            {"$set": {
-                                "status": "pending",
-                                "retry_count": tentativas_atuais + 1,
-                                "updated_at": datetime.utcnow()
-                            }}
-                        )
-
-                    else:
-                        print(f"Limite de tentativas excedido para a task {t.get('_id')}. Marcando como erro.")
-                        db.tasks.update_one(
-                            {"_id": t["_id"]},
-                            {"$set": {
-                                "status": "error",
-                                "error_at": datetime.utcnow(),
-                                "transmit": {
-                                    "error": f"O Portal Nacional está instável. Tentamos enviar {MAX_TENTATIVAS} vezes sem sucesso."}
-                            }}
-
-                        )
+        def processar(t):
+            try:
+                _transmitir_task(t, emissores_cache, devolvidas)
+            finally:
+                em_transmissao.discard(t["_id"])
 
-                else:
-                    # Se for outro tipo de erro (ex: erro de código, XML inválido), vai para error direto
-                    db.tasks.update_one(
-                        {"_id": t["_id"]},
-                        {"$set": {
-                            "status": "error",
-                            "error_at": datetime.utcnow(),
-                            "transmit": {"error": erro_str}
-                        }}
-                    )
+        total = drenar_fila(reivindicar, processar)
+        if total:
+            log.info("Rodada de transmissão concluída: %s tasks processadas", total)
 
     except Exception as e:
-        print("Erro geral no scheduler:", e)
-        traceback.print_exc()
+        log.exception("Erro geral no scheduler: %s", e)
+    finally:
+        parar_heartbeat.set()
 
 
+@medir_job("process_retry_dps")
 def process_retry_dps():
-    retry_tasks = list(db.tasks.find({"status": "retry_dps"}).limit(5))
+    # Reserva (lease) até 5 tasks sem mudar o status, para outra réplica não gerar
+    # um segundo número de DPS para a mesma nota.
+    retry_tasks = []
+    while len(retry_tasks) < 5:
+        t = reivindicar_task(db, {"status": "retry_dps"})
+        if not t:
+            break
+        retry_tasks.append(t)
     if not retry_tasks:
         return
 
-    print(f"?? Encontradas {len(retry_tasks)} tasks retry_dps para recálculo de DPS")
+    log.info("Encontradas %s tasks retry_dps para recálculo de DPS", len(retry_tasks))
 
+    # 1) Valida e agrupa por emissor (um bloco de números de DPS por emissor)
+    por_emissor = {}
     for t in retry_tasks:
+        campos = {"task_id": str(t["_id"]), "emitter_id": str(t.get("emitter_id"))}
         try:
             emitter = db.emitters.find_one({"_id": ObjectId(t["emitter_id"]), "user_id": t["user_id"]})
             if not emitter:
-                print("Emissor não encontrado")
+                log.warning("retry_dps: emissor não encontrado", extra=campos)
+                liberar_task(db, t)
                 continue
 
             response = t.get("response") or {}
 
-            # tenta pegar XML do response novo
-            xml_original = response.get("xml")
+            # tenta pegar XML do response novo (inline ou no store)
+            xml_original = texto_campo(db, response, "xml")
 
             # se não tiver (caso antigo), tenta pegar do campo legado 'response.xml'
             if not xml_original:
                 xml_original = t.get("response.xml")
 
             if not xml_original:
-                print(f"Task {t['_id']} sem XML original, ignorando retry.")
+                log.warning("retry_dps: task sem XML original, ignorando", extra=campos)
+                liberar_task(db, t)
                 continue
 
-            # 1) GERAR NOVO DPS
-            nova_serie = "00002"
-            dps = next_dps(db, t["emitter_id"], serie=nova_serie)
-
-            # 2) VARIÁVEIS QUE TAMBÉM FALTAVAM
-            emitter_cnpj = sanitize_document(emitter["cnpj"])
-            municipio = str(emitter.get("codigoIbge") or emitter.get("codigo_ibge") or "").zfill(7)
-
-            # 3) remover assinatura antiga
-            xml_sem_ass = remover_assinatura(xml_original)
+            por_emissor.setdefault(str(t["emitter_id"]), []).append((t, emitter, xml_original))
 
-            # 4) substituir DPS no XML com ID novo, série nova, nº novo
-            xml_novo = substituir_dps_no_xml(
-                xml_sem_ass,
-                nova_serie=dps["serie"],
-                novo_numero=dps["numero"],
-                emitter_cnpj=emitter_cnpj,
-                municipio_ibge=municipio
-            )
+        except Exception as e:
+            log.exception("Erro processando retry_dps: %s", e, extra=campos)
+            liberar_task(db, t)
 
-            # 5) gerar assinatura nova
-            xml_assinado = assinar_xml(
-                xml_novo,
-                pfx_path=emitter["certificado_path"],
-                pfx_password=emitter["senha_certificado"]
-            )
+    nova_serie = "00002"
+    for emitter_id, grupo in por_emissor.items():
+        # 2) GERAR NOVOS DPS (um único $inc para o grupo)
+        try:
+            numeros = next_dps_block(db, emitter_id, serie=nova_serie, n=len(grupo))
+        except Exception as e:
+            log.exception("Erro reservando DPS para retry_dps: %s", e, extra={"emitter_id": emitter_id})
+            for t, _, _ in grupo:
+                liberar_task(db, t)
+            continue
 
-            # 6) salvar alterações
-            # Mescla o response existente com o novo XML corrigido
-            response_atual = t.get("response", {})
+        for (t, emitter, xml_original), dps in zip(grupo, numeros):
+            campos = {"task_id": str(t["_id"]), "emitter_id": emitter_id}
+            try:
+                # 3) VARIÁVEIS QUE TAMBÉM FALTAVAM
+                emitter_cnpj = sanitize_document(emitter["cnpj"])
+                municipio = str(emitter.get("codigoIbge") or emitter.get("codigo_ibge") or "").zfill(7)
+
+                # 4) remover assinatura antiga
+                xml_sem_ass = remover_assinatura(xml_original)
+
+                # 5) substituir DPS no XML com ID novo, série nova, nº novo
+                xml_novo = substituir_dps_no_xml(
+                    xml_sem_ass,
+                    nova_serie=dps["serie"],
+                    novo_numero=dps["numero"],
+                    emitter_cnpj=emitter_cnpj,
+                    municipio_ibge=municipio
+                )
 
-            response_atual["xml"] = xml_assinado
-            response_atual["updated_at"] = datetime.utcnow()
+                # 6) gerar assinatura nova
+                xml_assinado = assinar_xml(
+                    xml_novo,
+                    pfx_path=emitter["certificado_path"],
+                    pfx_password=emitter["senha_certificado"]
+                )
 
-            db.tasks.update_one(
-                {"_id": t["_id"]},
-                {"$set": {
-                    "status": "pending",
-                    "response": response_atual,
-                    "dps": {
-                        "serie": dps["serie"],
-                        "numero": dps["numero"],
-                        "status": "ajustado"
-                    },
-                    "updated_at": datetime.utcnow()
-                }}
-            )
+                # 7) salvar alterações
+                # Mescla o response existente com o novo XML corrigido
+                response_atual = t.get("response", {})
+
+                response_atual["xml"] = xml_assinado
+                response_atual.pop("xml_ref", None)
+                response_atual["updated_at"] = datetime.utcnow()
+
+                gravada = finalizar_task(
+                    db, t["_id"],
+                    {"$set": {
+                        "status": "pending",
+                        "response": response_atual,
+                        "dps": {
+                            "serie": dps["serie"],
+                            "numero": dps["numero"],
+                            "status": "ajustado"
+                        },
+                        "updated_at": datetime.utcnow()
+                    }}
+                )
+                if not gravada:
+                    # lease perdido (outra réplica assumiu a task): o número novo já foi consumido
+                    log.warning("retry_dps: lease perdido; DPS %s/%s registrada como lacuna",
+                                dps["serie"], dps["numero"], extra=campos)
+                    registrar_dps_nao_usados(db, emitter_id, dps["serie"], [dps["numero"]],
+                                             motivo="Lease da task perdido no retry_dps")
+                    continue
 
-            print(f"? Task {t['_id']} corrigida e voltou para pending")
+                log.info("retry_dps: DPS %s/%s gerada; task voltou para pending", dps["serie"], dps["numero"],
+                         extra=campos)
 
-        except Exception as e:
-            print("Erro processando retry_dps:", e)
-            traceback.print_exc()
+            except Exception as e:
+                log.exception("Erro processando retry_dps: %s", e, extra=campos)
+                liberar_task(db, t)
+                registrar_dps_nao_usados(db, emitter_id, dps["serie"], [dps["numero"]], motivo=str(e))
 
 
+@medir_job("tarefa_recuperar_pdfs_pendentes")
 def tarefa_recuperar_pdfs_pendentes():
     """
     Busca notas que foram ACEITAS (Status 'accepted') mas que estão SEM PDF.
     Filtro abrangente: Null, Vazio ou Inexistente.
     """
-    print(f"[SCHEDULER PDF] Iniciando varredura de PDFs pendentes: {datetime.now()}")
+    log.debug("Iniciando varredura de PDFs pendentes")
 
     # Filtro mais robusto: aceita nulo ou string vazia
     filtro = {
@@ -511,12 +606,14 @@ def tarefa_recuperar_pdfs_pendentes():
             {"transmit.pdf_base64": ""},
             {"transmit.pdf_base64": {"$exists": False}}
         ],
+        "transmit.pdf_ref": {"$exists": False},
         "transmit.chave_acesso": {"$ne": None}
     }
 
     # Debug: Mostra quantos encontrou antes de processar
     total_pendentes = db.tasks.count_documents(filtro)
-    print(f"[SCHEDULER PDF] Notas encontradas no banco para processar: {total_pendentes}")
+    BACKLOG_PDF.set(total_pendentes)
+    log.debug("Notas aceitas sem DANFSe: %s", total_pendentes)
 
     if total_pendentes == 0:
         return
@@ -525,19 +622,19 @@ def tarefa_recuperar_pdfs_pendentes():
     count = 0
 
     for task in pendentes:
+        campos = {"task_id": str(task["_id"]), "emitter_id": str(task.get("emitter_id"))}
         try:
             chave = task.get("transmit", {}).get("chave_acesso")
             emitter_id = task.get("emitter_id")
-            task_id = str(task["_id"])
 
             if not chave:
-                print(f"  -> Pular task {task_id}: Sem chave de acesso.")
+                log.debug("DANFSe: task sem chave de acesso, pulando", extra=campos)
                 continue
 
             # Busca dados do emissor para o certificado
             emitter = db.emitters.find_one({"_id": ObjectId(emitter_id)})
             if not emitter:
-                print(f"  -> Pular task {task_id}: Emissor não encontrado.")
+                log.warning("DANFSe: emissor não encontrado, pulando", extra=campos)
                 continue
 
             # Caminho do certificado
@@ -550,10 +647,11 @@ def tarefa_recuperar_pdfs_pendentes():
                 if os.path.exists(pfx_path_fallback):
                     pfx_path = pfx_path_fallback
                 else:
-                    print(f"  -> ERRO: Certificado não encontrado no disco para emissor {emitter.get('razaoSocial')}: {pfx_path}")
+                    log.error("DANFSe: certificado não encontrado no disco para %s: %s",
+                              emitter.get("razaoSocial"), pfx_path, extra=campos)
                     continue
 
-            print(f"  -> Baixando PDF Task {task_id} (Chave: {chave})...")
+            log.debug("DANFSe: baixando (chave %s)", chave, extra=campos)
 
             # Tenta baixar
             pdf_b64 = baixar_danfse_pdf(chave, pfx_path, senha_cert)
@@ -562,26 +660,41 @@ def tarefa_recuperar_pdfs_pendentes():
                 # Salva no banco
                 db.tasks.update_one(
                     {"_id": task["_id"]},
-                    {"$set": {"transmit.pdf_base64": pdf_b64}}
+                    {"$set": {"transmit.pdf_ref": guardar_pdf_base64(db, pdf_b64)},
+                     "$unset": {"transmit.pdf_base64": ""}}
                 )
-                print(f"  -> SUCESSO! PDF salvo.")
+                log.info("DANFSe salvo", extra=campos)
                 count += 1
             else:
-                print(f"  -> Falha: Portal retornou 404/Erro ainda.")
+                log.info("DANFSe ainda indisponível no portal (404/erro)", extra=campos)
 
         except Exception as e:
-            print(f"  -> Erro ao processar task {task.get('_id')}: {e}")
+            log.exception("DANFSe: erro ao processar task: %s", e, extra=campos)
 
-    print(f"[SCHEDULER PDF] Finalizado. {count} PDFs recuperados nesta rodada.")
+    log.info("Varredura de PDFs finalizada: %s de %s recuperados nesta rodada", count, len(pendentes))
 
 
 # ======================================================
 # 🔹 Inicializa o scheduler no startup
 # ======================================================
+def tarefa_carga_faturamento():
+    """Carga inicial do faturamento materializado (só com a collection vazia; ver backend/faturamento.py)."""
+    try:
+        meses = carregar_faturamento_se_vazio(db)
+    except Exception:
+        log.exception("Falha na carga inicial de faturamento_mensal")
+        return
+    if meses is not None:
+        log.info(f"faturamento_mensal vazio: {meses} meses carregados a partir das tasks")
+
+
 def start_scheduler():
     scheduler = BackgroundScheduler()
-    # roda a cada 60 segundos
-    scheduler.add_job(process_pending_nfse, "interval", seconds=15)
+    # uma vez, logo ao subir: sem faturamento_mensal o RBT12, a alíquota e o /tasks/resumo leem 0
+    scheduler.add_job(tarefa_carga_faturamento, id="carga_faturamento")
+    # a cada 15s drena a fila de pendentes (uma rodada por vez; se a anterior ainda
+    # estiver drenando, a próxima é descartada)
+    scheduler.add_job(process_pending_nfse, "interval", seconds=15, max_instances=1, coalesce=True)
     scheduler.add_job(process_retry_dps, "interval", seconds=20)
     scheduler.add_job(tarefa_recuperar_pdfs_pendentes, "interval", minutes=2)
     scheduler.add_job(
@@ -600,12 +713,14 @@ def start_scheduler():
         id="recalculo_aliquota_mensal",
         replace_existing=True
     )
+    observar_scheduler(scheduler)
     scheduler.start()
-    print("🕒 Scheduler de transmissão iniciado (checa pendentes a cada 15s)")
+    log.info("Scheduler de transmissão iniciado (checa pendentes a cada 15s)")
 
 
 @app.on_event("startup")
 def startup_event():
+    aplicar_indices(db)
     start_scheduler()
 
 
@@ -616,5 +731,18 @@ def startup_event():
 def root():
     return {"msg": "API NFSe rodando com scheduler automático"}
 
+
+# ======================================================
+# 🔹 Métricas (formato Prometheus)
+# ======================================================
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics(authorization: str | None = Header(default=None)):
+    """Métricas do pipeline de transmissão (backend/metricas.py). Com METRICAS_TOKEN, exige Bearer."""
+    if METRICAS_TOKEN and authorization != f"Bearer {METRICAS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Não autorizado")
+    atualizar_backlog(db)
+    return PlainTextResponse(exportar_metricas(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 # run back -> uvicorn main:app --host 0.0.0.0 --port 6600
 # run  front -> cd frontend  npm run dev -- --host 0.0.0.0
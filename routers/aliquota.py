@@ -5,10 +5,21 @@ from fastapi.responses import JSONResponse
 from db import db
 from routers.auth import get_current_user
 from models import UserInDB
+from backend.faturamento import faturamento_por_mes, faturamento_por_emissor
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pymongo import UpdateOne
+import logging
+import os
 import re
+import time
 import pdfplumber
 
 router = APIRouter(prefix="/aliquota", tags=["Aliquota"])
+log = logging.getLogger(__name__)
+
+# Recálculo mensal: emissores por lote (3 leituras + 1 bulk_write por lote) e lotes em paralelo
+ALIQUOTA_LOTE = int(os.getenv("ALIQUOTA_LOTE", "200"))
+ALIQUOTA_MAX_WORKERS = int(os.getenv("ALIQUOTA_MAX_WORKERS", "8"))
 
 # ----------------- Tabela Anexo III -----------------
 TABELA_ANEXO_III = [
@@ -132,45 +143,21 @@ def extrair_dados_pgdas(pdf_file):
 # ----------------- CÁLCULO VIA BANCO (ENCADEADO) -----------------
 def get_faturamento_tasks(emitter_oid, mes, ano):
     """
-    Busca notas emitidas (db.tasks) de um mês específico.
-    Filtra pela DATA DE COMPETÊNCIA (ex: '2025-11-20').
+    Faturamento (notas aceitas) de um mês específico, pela DATA DE COMPETÊNCIA.
+    Lido da collection faturamento_mensal (mantida em backend/faturamento.py).
     """
-    start_str = f"{ano}-{mes:02d}-01"
-
-    if mes == 12:
-        end_str = f"{ano + 1}-01-01"
-    else:
-        end_str = f"{ano}-{mes + 1:02d}-01"
-
-    pipeline = [
-        {
-            "$match": {
-                "emitter_id": str(emitter_oid),
-                "competencia": {"$gte": start_str, "$lt": end_str},
-                "status": "accepted",
-                "type": "emit_nfse"
-            }
-        },
-        {"$group": {"_id": None, "total": {"$sum": "$valor"}}}
-    ]
-    result = list(db.tasks.aggregate(pipeline))
-    return result[0]["total"] if result else 0.0
+    return faturamento_por_mes(db, emitter_oid, (ano, mes), (ano, mes)).get((ano, mes), 0.0)
 
 
-def calcular_v1_automatico(emitter_oid, mes_comp, ano_comp):
+def _rbt12_automatico(historico: dict, faturamento: dict, mes_comp, ano_comp):
     """
-    Reconstrói o RBT12 somando os 12 meses anteriores.
-    Se faltar dado no histórico (ex: Mês 11 não tem PDF), busca no banco.
+    Reconstrói o RBT12 somando os 12 meses anteriores a partir do histórico (receitas_12m
+    do último registro) e do faturamento {(ano, mes): total}. Não acessa o banco.
     """
-    ultimo_registro = db.aliquotas.find_one(
-        {"emitter_id": emitter_oid},
-        sort=[("ano", -1), ("mes", -1)]
-    )
+    historico_acumulado = dict(historico or {})
 
-    historico_acumulado = ultimo_registro.get("receitas_12m", {}) if ultimo_registro else {}
-
-    # Busca faturamento do mês atual (pode ser 0 se for inicio de mês)
-    val_pa = get_faturamento_tasks(emitter_oid, mes_comp, ano_comp)
+    # Faturamento do mês atual (pode ser 0 se for inicio de mês)
+    val_pa = faturamento.get((ano_comp, mes_comp), 0.0)
     chave_pa = f"{mes_comp:02d}/{ano_comp}"
     historico_acumulado[chave_pa] = val_pa
 
@@ -183,9 +170,9 @@ def calcular_v1_automatico(emitter_oid, mes_comp, ano_comp):
 
         val = historico_acumulado.get(chave)
 
-        # SE NÃO TIVER NO HISTÓRICO, VAI NO BANCO (Ex: Busca Nov/25 nas Tasks)
+        # SE NÃO TIVER NO HISTÓRICO, VAI NO BANCO (Ex: Busca Nov/25 no faturamento_mensal)
         if val is None or val == 0:
-            val = get_faturamento_tasks(emitter_oid, m, y)
+            val = faturamento.get((y, m), 0.0)
             historico_acumulado[chave] = val
 
         rbt12_original += val
@@ -206,6 +193,49 @@ def calcular_v1_automatico(emitter_oid, mes_comp, ano_comp):
     }
 
 
+def _janela_rbt12(mes_comp, ano_comp):
+    """(inicio, fim) dos 13 meses usados no RBT12: os 12 anteriores + o atual."""
+    return (ano_comp - 1, mes_comp), (ano_comp, mes_comp)
+
+
+def calcular_v1_automatico(emitter_oid, mes_comp, ano_comp):
+    """
+    Reconstrói o RBT12 somando os 12 meses anteriores.
+    Se faltar dado no histórico (ex: Mês 11 não tem PDF), busca no banco.
+    """
+    ultimo_registro = db.aliquotas.find_one(
+        {"emitter_id": emitter_oid},
+        sort=[("ano", -1), ("mes", -1)]
+    )
+    historico = ultimo_registro.get("receitas_12m", {}) if ultimo_registro else {}
+
+    # Uma leitura por faixa traz os 13 meses do faturamento_mensal
+    faturamento = faturamento_por_mes(db, emitter_oid, *_janela_rbt12(mes_comp, ano_comp))
+    return _rbt12_automatico(historico, faturamento, mes_comp, ano_comp)
+
+
+def _aliquota_anexo_iii(V1):
+    """(aliquota_efetiva, aliquota_nominal, deducao) do Anexo III para o RBT12 V1."""
+    faixa_encontrada = None
+    for faixa in TABELA_ANEXO_III:
+        min_v, max_v, aliq_nominal, deducao_valor = faixa
+        if min_v <= V1 <= max_v:
+            faixa_encontrada = faixa
+            break
+
+    if not faixa_encontrada:
+        faixa_encontrada = TABELA_ANEXO_III[-1] if V1 > TABELA_ANEXO_III[-1][1] else (0, 0, 0, 0)
+
+    _, _, aliq_nominal, deducao = faixa_encontrada
+
+    aliquota_efetiva = 0.0
+    if V1 > 0 and aliq_nominal > 0:
+        V2 = V1 * aliq_nominal
+        V3 = V2 - deducao
+        aliquota_efetiva = round(V3 / V1, 6)
+    return aliquota_efetiva, aliq_nominal, deducao
+
+
 # ----------------- ROTA PRINCIPAL -----------------
 @router.post("/processar")
 async def processar_pgdas(emitterId: str = Form(...), file: UploadFile = File(None),
@@ -285,24 +315,7 @@ async def processar_pgdas(emitterId: str = Form(...), file: UploadFile = File(No
         }
 
     V1 = dados_finais["rbt12"]
-
-    faixa_encontrada = None
-    for faixa in TABELA_ANEXO_III:
-        min_v, max_v, aliq_nominal, deducao_valor = faixa
-        if min_v <= V1 <= max_v:
-            faixa_encontrada = faixa
-            break
-
-    if not faixa_encontrada:
-        faixa_encontrada = TABELA_ANEXO_III[-1] if V1 > TABELA_ANEXO_III[-1][1] else (0, 0, 0, 0)
-
-    _, _, aliq_nominal, deducao = faixa_encontrada
-
-    aliquota_efetiva = 0.0
-    if V1 > 0 and aliq_nominal > 0:
-        V2 = V1 * aliq_nominal
-        V3 = V2 - deducao
-        aliquota_efetiva = round(V3 / V1, 6)
+    aliquota_efetiva, aliq_nominal, deducao = _aliquota_anexo_iii(V1)
 
     # CORREÇÃO VISUAL RPA: Busca o mês anterior (Novembro) para exibir
     dt_ref_rpa = now.replace(day=1) - timedelta(days=1)
@@ -384,89 +397,167 @@ async def get_aliquota_atual(emitter_id: str, current_user: UserInDB = Depends(g
 
 
 # --- SCHEDULER ---
-def tarefa_recalcular_aliquotas_mensais():
-    print(f"[SCHEDULER] Iniciando recálculo mensal: {datetime.now()}")
-    emissores = list(db.emitters.find({"ativo": {"$ne": False}}))
-    count = 0
-    now = datetime.utcnow()
-
-    # Scheduler calcula a alíquota para o MÊS ATUAL (Vigência - Ex: Dezembro)
-    mes_target = now.month
-    ano_target = now.year
-
-    # Calcula data de referência do RPA (Mês anterior - Ex: Novembro)
-    dt_ref_rpa = now.replace(day=1) - timedelta(days=1)
+def _update_preservando_pdf(doc: dict) -> list:
+    """
+    Update em pipeline que grava doc, exceto quando o registro já veio do PGDAS (fonte
+    'pgdas_pdf'): a checagem é atômica, então um PDF enviado durante o recálculo não é sobrescrito.
+    """
+    eh_pdf = {"$eq": ["$fonte", "pgdas_pdf"]}
+    return [{"$set": {k: {"$cond": [eh_pdf, f"${k}", {"$literal": v}]} for k, v in doc.items()}}]
 
-    print(f"[SCHEDULER] Alvo do cálculo (Vigência): {mes_target}/{ano_target}")
 
+def _recalcular_lote(recalculo_id, emissores: list, mes_target, ano_target, now):
+    """
+    Recalcula um lote de emissores: 3 leituras para o lote inteiro (PDFs do mês, último
+    histórico, faturamento de 13 meses), cálculo em memória e gravação em bulk_write.
+    Registra cada emissor em recalculos_aliquota_itens com o seu status, e o lote uma vez em
+    recalculos_aliquota.lotes com a duração (leituras + cálculo + gravação das alíquotas), que é
+    onde o tempo de fato está.
+    """
+    t0 = time.perf_counter()
+    ids = [e["_id"] for e in emissores]
+
+    com_pdf = {a["emitter_id"] for a in db.aliquotas.find(
+        {"emitter_id": {"$in": ids}, "mes": mes_target, "ano": ano_target, "fonte": "pgdas_pdf"},
+        {"emitter_id": 1})}
+    historicos = {h["_id"]: h.get("receitas_12m") or {} for h in db.aliquotas.aggregate([
+        {"$match": {"emitter_id": {"$in": ids}}},
+        {"$sort": {"emitter_id": 1, "ano": -1, "mes": -1}},
+        {"$group": {"_id": "$emitter_id", "receitas_12m": {"$first": "$receitas_12m"}}},
+    ])}
+    faturamentos = faturamento_por_emissor(db, ids, *_janela_rbt12(mes_target, ano_target))
+
+    # RPA exibido: o do mês ANTERIOR (Ex: Novembro), que está dentro da janela de 13 meses
+    dt_ref_rpa = datetime(ano_target, mes_target, 1) - timedelta(days=1)
+
+    ops_aliquotas, itens = [], []
     for emissor in emissores:
+        emitter_oid = emissor["_id"]
+        item = {"recalculo_id": recalculo_id, "emitter_id": emitter_oid, "atualizado_em": now}
         try:
-            emitter_oid = emissor["_id"]
-            user_id = emissor.get("user_id")
-            if not user_id: continue
-
-            existente = db.aliquotas.find_one({
-                "emitter_id": emitter_oid,
-                "mes": mes_target,
-                "ano": ano_target
-            })
-            if existente and existente.get("fonte") == "pgdas_pdf":
-                continue
-
-            # Calcula usando dados do banco
-            dados = calcular_v1_automatico(emitter_oid, mes_target, ano_target)
-            V1 = dados["V1"]
-
-            # --- CORREÇÃO DE EXIBIÇÃO: Pega o RPA do Mês ANTERIOR para salvar ---
-            # Isso garante que a tabela mostre R$ 84k e não R$ 0,00
-            rpa_referencia = get_faturamento_tasks(emitter_oid, dt_ref_rpa.month, dt_ref_rpa.year)
-
-            faixa_encontrada = None
-            for faixa in TABELA_ANEXO_III:
-                min_v, max_v, aliq_nominal, deducao_valor = faixa
-                if min_v <= V1 <= max_v:
-                    faixa_encontrada = faixa
-                    break
-            if not faixa_encontrada:
-                faixa_encontrada = TABELA_ANEXO_III[-1] if V1 > TABELA_ANEXO_III[-1][1] else (0, 0, 0, 0)
-
-            _, _, aliq_nominal, deducao = faixa_encontrada
-            aliquota_efetiva = 0.0
-            if V1 > 0 and aliq_nominal > 0:
-                V2 = V1 * aliq_nominal
-                V3 = V2 - deducao
-                aliquota_efetiva = round(V3 / V1, 6)
-
-            doc = {
-                "user_id": user_id,
-                "emitter_id": emitter_oid,
-                "mes": dados["mes_pa"],  # Mês 12
-                "ano": dados["ano_pa"],
-                "rbt12": V1,
-                "rpa_mes": rpa_referencia,  # SALVA O RPA DE NOVEMBRO AQUI
-                "receitas_12m": dados["receitas_hist"],
-                "aliquota": aliquota_efetiva,
-                "aliquota_base": aliq_nominal,
-                "deducao": deducao,
-                "fonte": "scheduler_automatico",
-                "created_at": now,
-                "passo_a_passo": dados["passo_a_passo"]
-            }
+            if emitter_oid in com_pdf:
+                item["status"] = "ignorado"
+            else:
+                faturamento = faturamentos.get(emitter_oid, {})
+                dados = _rbt12_automatico(historicos.get(emitter_oid), faturamento, mes_target, ano_target)
+                V1 = dados["V1"]
+                aliquota_efetiva, aliq_nominal, deducao = _aliquota_anexo_iii(V1)
+
+                doc = {
+                    "user_id": emissor["user_id"],
+                    "emitter_id": emitter_oid,
+                    "mes": dados["mes_pa"],  # Mês 12
+                    "ano": dados["ano_pa"],
+                    "rbt12": V1,
+                    "rpa_mes": faturamento.get((dt_ref_rpa.year, dt_ref_rpa.month), 0.0),  # RPA DE NOVEMBRO
+                    "receitas_12m": dados["receitas_hist"],
+                    "aliquota": aliquota_efetiva,
+                    "aliquota_base": aliq_nominal,
+                    "deducao": deducao,
+                    "fonte": "scheduler_automatico",
+                    "created_at": now,
+                    "passo_a_passo": dados["passo_a_passo"]
+                }
+                ops_aliquotas.append(UpdateOne(
+                    {"emitter_id": emitter_oid, "mes": dados["mes_pa"], "ano": dados["ano_pa"]},
+                    _update_preservando_pdf(doc),
+                    upsert=True
+                ))
+                item["status"] = "ok"
+        except Exception as e:
+            log.warning("Recálculo %s: erro no emissor %s: %s", recalculo_id, emissor.get("razaoSocial"), e,
+                        extra={"emitter_id": str(emitter_oid)})
+            item.update(status="erro", erro=str(e))
+        itens.append(item)
+
+    if ops_aliquotas:
+        db.aliquotas.bulk_write(ops_aliquotas, ordered=False)
+    duracao_ms = round((time.perf_counter() - t0) * 1000, 3)
+    # o item só é gravado depois da alíquota: um lote interrompido é refeito inteiro na retomada
+    db.recalculos_aliquota_itens.bulk_write([
+        UpdateOne({"_id": f"{recalculo_id}|{i['emitter_id']}"}, {"$set": i}, upsert=True) for i in itens
+    ], ordered=False)
+    db.recalculos_aliquota.update_one(
+        {"_id": recalculo_id},
+        {"$inc": {"processados": len(itens)},
+         "$push": {"lotes": {"emissores": len(emissores), "duracao_ms": duracao_ms}}}
+    )
+    return itens
 
-            db.aliquotas.update_one(
-                {"emitter_id": emitter_oid, "mes": dados["mes_pa"], "ano": dados["ano_pa"]},
-                {"$set": doc},
-                upsert=True
-            )
-            count += 1
 
-        except Exception as e:
-            print(f"[SCHEDULER] Erro emissor {emissor.get('razao_social')}: {e}")
+def tarefa_recalcular_aliquotas_mensais(referencia: datetime | None = None):
+    """
+    Recalcula a alíquota do mês de vigência (mês de 'referencia', padrão: agora) para
+    todos os emissores ativos, em lotes processados por um pool de threads.
+
+    O andamento fica em recalculos_aliquota (um documento por mês, _id 'AAAA-MM') e em
+    recalculos_aliquota_itens (um por emissor, com status); a duração de cada lote fica em
+    recalculos_aliquota.lotes. Rodar de novo
+    para o mesmo mês retoma: só entram emissores sem item 'ok'/'ignorado'.
+    Registros com fonte 'pgdas_pdf' nunca são sobrescritos.
+    """
+    now = datetime.utcnow()
+    referencia = referencia or now
+
+    # Scheduler calcula a alíquota para o MÊS ATUAL (Vigência - Ex: Dezembro)
+    mes_target = referencia.month
+    ano_target = referencia.year
+    recalculo_id = f"{ano_target}-{mes_target:02d}"
+
+    log.info("Recálculo mensal de alíquotas %s (vigência %s/%s) iniciado", recalculo_id, mes_target, ano_target)
+
+    concluidos = set(db.recalculos_aliquota_itens.distinct(
+        "emitter_id", {"recalculo_id": recalculo_id, "status": {"$in": ["ok", "ignorado"]}}
+    ))
+    emissores = [
+        e for e in db.emitters.find({"ativo": {"$ne": False}}, {"user_id": 1, "razaoSocial": 1})
+        if e.get("user_id") and e["_id"] not in concluidos
+    ]
+
+    db.recalculos_aliquota.update_one(
+        {"_id": recalculo_id},
+        {"$set": {"status": "running", "mes": mes_target, "ano": ano_target, "execucao_iniciada_em": now,
+                  "pendentes": len(emissores), "processados": 0, "lotes": []},
+         "$setOnInsert": {"iniciado_em": now},
+         "$inc": {"execucoes": 1}},
+        upsert=True
+    )
+    if concluidos:
+        log.info("Recálculo %s retomado: %s emissores já concluídos, %s pendentes",
+                 recalculo_id, len(concluidos), len(emissores))
+
+    lotes = [emissores[i:i + ALIQUOTA_LOTE] for i in range(0, len(emissores), ALIQUOTA_LOTE)]
+    t0 = time.perf_counter()
+    itens = []
+    with ThreadPoolExecutor(max_workers=ALIQUOTA_MAX_WORKERS, thread_name_prefix="aliquota") as pool:
+        futuros = [pool.submit(_recalcular_lote, recalculo_id, lote, mes_target, ano_target, now) for lote in lotes]
+        for f in as_completed(futuros):
+            try:
+                itens.extend(f.result())
+            except Exception as e:
+                # lote sem item gravado: fica pendente para a próxima execução
+                log.exception("Recálculo %s: falha num lote: %s", recalculo_id, e)
+
+    por_status = {s["_id"]: s["total"] for s in db.recalculos_aliquota_itens.aggregate([
+        {"$match": {"recalculo_id": recalculo_id}},
+        {"$group": {"_id": "$status", "total": {"$sum": 1}}},
+    ])}
+    faltando = len(emissores) - sum(1 for i in itens if i["status"] != "erro")
+    db.recalculos_aliquota.update_one(
+        {"_id": recalculo_id},
+        {"$set": {"status": "concluido" if faltando == 0 else "incompleto",
+                  "finalizado_em": datetime.utcnow(),
+                  "duracao_segundos": round(time.perf_counter() - t0, 3),
+                  "por_status": por_status}}
+    )
 
-    print(f"[SCHEDULER] Finalizado. {count} calculados.")
+    count = sum(1 for i in itens if i["status"] == "ok")
+    log.info("Recálculo %s finalizado: %s calculados, %s pendentes", recalculo_id, count, faltando,
+             extra={"duracao_ms": round((time.perf_counter() - t0) * 1000, 3)})
 
 
 #   CASO A ALIQUOTA NAO TENHA RODADO :
 #    python
 #   from routers.aliquota import tarefa_recalcular_aliquotas_mensais
 #   tarefa_recalcular_aliquotas_mensais()
+#   (rodar de novo no mesmo mês retoma só os emissores que faltaram; ver recalculos_aliquota)
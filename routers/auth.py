@@ -5,7 +5,9 @@ from datetime import datetime, timedelta
 from db import db
 from models import User, UserCreate, UserInDB, Token
 from utils import verify_password, get_password_hash, serialize_doc
+from backend.principal_cache import obter_principal, invalidar_principal
 from dotenv import load_dotenv
+import logging
 import os
 
 # --- NOVAS IMPORTAÇÕES PARA EMAIL (GMAIL) ---
@@ -20,6 +22,8 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24h
 RESET_TOKEN_EXPIRE_MINUTES = 30  # Token de reset dura 30 min
+# Com 1, o principal é montado pelas claims do token (uid/sub/name) sem consultar 'users'
+AUTH_PRINCIPAL_DO_TOKEN = os.getenv("AUTH_PRINCIPAL_DO_TOKEN", "0") == "1"
 
 # Configurações do Gmail (Coloque isso no seu .env)
 EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS")
@@ -30,6 +34,7 @@ if not SECRET_KEY:
     raise RuntimeError("SECRET_KEY não definida no ambiente!")
 
 router = APIRouter(prefix="/auth", tags=["Authentication"])
+log = logging.getLogger(__name__)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 
 
@@ -37,8 +42,9 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 
 def create_access_token(data: dict):
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    agora = datetime.utcnow()
+    expire = agora + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    to_encode.update({"exp": expire, "iat": agora})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
@@ -97,16 +103,36 @@ def send_reset_email(to_email: str, token: str):
         server.sendmail(EMAIL_ADDRESS, to_email, text)
         server.quit()
 
-        print(f"? Email enviado com sucesso para {to_email}")
+        log.info("Email enviado para %s", to_email)
         return True
 
     except Exception as e:
-        print(f"? Erro ao enviar email via Gmail: {e}")
+        log.error("Erro ao enviar email via Gmail para %s: %s", to_email, e)
         return False
 
 
 # --- Endpoints (Mantidos iguais) ---
 
+def _emitido_em(payload: dict) -> int:
+    """'iat' do token; tokens antigos (sem iat) contam a partir do exp - validade."""
+    if payload.get("iat") is not None:
+        return int(payload["iat"])
+    return int(payload.get("exp") or 0) - ACCESS_TOKEN_EXPIRE_MINUTES * 60
+
+
+def _carregar_principal(email: str, payload: dict):
+    """(UserInDB, senha_alterada_em) do usuário do token, ou None se ele não existe."""
+    if AUTH_PRINCIPAL_DO_TOKEN and payload.get("uid"):
+        principal = UserInDB.parse_obj({"_id": payload["uid"], "email": email,
+                                        "name": payload.get("name"), "hashed_password": ""})
+        return principal, None
+
+    user_data = db.users.find_one({"email": email})
+    if user_data is None:
+        return None
+    return UserInDB.parse_obj(serialize_doc(user_data)), user_data.get("senha_alterada_em")
+
+
 async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserInDB:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -120,11 +146,11 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserInDB:
         if email is None:
             raise credentials_exception
 
-        user_data = db.users.find_one({"email": email})
-        if user_data is None:
+        principal = obter_principal(email, _emitido_em(payload), lambda: _carregar_principal(email, payload))
+        if principal is None:
             raise credentials_exception
 
-        return UserInDB.parse_obj(serialize_doc(user_data))
+        return principal
     except JWTError:
         raise credentials_exception
 
@@ -159,7 +185,9 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Email ou senha incorretos",
         )
-    access_token = create_access_token(data={"sub": user_data["email"]})
+    access_token = create_access_token(data={
+        "sub": user_data["email"], "uid": str(user_data["_id"]), "name": user_data.get("name"),
+    })
     return {"access_token": access_token, "token_type": "bearer"}
 
 
@@ -199,6 +227,9 @@ async def reset_password(token: str = Body(...), new_password: str = Body(...)):
         raise HTTPException(status_code=404, detail="Usuário não encontrado")
 
     hashed_password = get_password_hash(new_password)
-    db.users.update_one({"email": email}, {"$set": {"hashed_password": hashed_password}})
+    agora = datetime.utcnow()
+    db.users.update_one({"email": email}, {"$set": {"hashed_password": hashed_password, "senha_alterada_em": agora}})
+    # Sessões abertas com a senha antiga deixam de valer
+    invalidar_principal(email, senha_alterada_em=agora)
 
     return {"msg": "Senha alterada com sucesso."}
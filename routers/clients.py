@@ -1,22 +1,27 @@
 from fastapi import APIRouter, HTTPException, UploadFile, File, BackgroundTasks, Depends, Query
 from bson import ObjectId
+from pymongo.errors import BulkWriteError
 import pandas as pd
-import requests
 from db import db
 from models import ClientCreate, ClientUpdate, UserInDB
 from routers.auth import get_current_user
 from utils import sanitize_document, serialize_doc, identificar_documento
-import time
+from backend.enriquecimento import consultar_cnpj, consultar_cep, consultar_ibge_municipio, consultar_em_paralelo
+from backend import cache_consultas
 from datetime import datetime, timedelta
+import logging
 import tempfile
 import os
 
 router = APIRouter(prefix="/clients", tags=["Clients"])
+log = logging.getLogger(__name__)
 
-RECEITAWS_URL = "https://www.receitaws.com.br/v1/cnpj/{}"
-# AJUSTE: 21 segundos garante < 3 req/min com margem de segurança
-THROTTLE_SECONDS = 21
 DAYS_BETWEEN_UPDATES = 30
+# Atualização diária: clientes consultados (em paralelo) antes de cada rodada de gravações
+LOTE_ATUALIZACAO = 50
+# Importação: linhas da planilha por pedaço (enriquecer + insert_many + progresso do job). Pequeno
+# de propósito: com a ReceitaWS a 3 consultas/min, 25 CNPJs sem cache já levam ~8 minutos
+IMPORT_LOTE_INSERCAO = int(os.getenv("IMPORT_LOTE_INSERCAO", "25"))
 
 
 def _fill_if_empty(target: dict, key: str, value):
@@ -27,43 +32,29 @@ def _fill_if_empty(target: dict, key: str, value):
         target[key] = value
 
 
-def _enrich_from_receitaws(cnpj: str) -> dict:
+def _enrich_from_receitaws(cnpj: str, permitir_obsoleto: bool = True) -> dict:
     """
-    Consulta a ReceitaWS. Retorna um dict com os dados ou None em caso de erro/rate-limit.
+    Consulta a ReceitaWS pelo cache de consultas (backend/cache_consultas.py), respeitando o
+    orçamento compartilhado de backend/enriquecimento.py.
+    Retorna um dict com os dados ou None se não encontrado / API indisponível.
     """
-    url = RECEITAWS_URL.format(cnpj)
-    try:
-        resp = requests.get(url, timeout=15)
+    return cache_consultas.consultar(db, "cnpj", cnpj, consultar_cnpj, permitir_obsoleto)
 
-        # AJUSTE: Tratamento explícito do 429 (Rate Limit)
-        if resp.status_code == 429:
-            print(f"?? [AVISO] Rate Limit atingido para {cnpj}. Pulando...")
-            return None
 
-        if resp.status_code != 200:
-            return None
+def _consultar_cep(cep: str) -> dict | None:
+    """Resposta da ViaCEP (via cache) ou None."""
+    return cache_consultas.consultar(db, "cep", cep, consultar_cep)
 
-        try:
-            data = resp.json()
-        except Exception:
-            print("?? [ERRO] Falha ao converter JSON da ReceitaWS")
-            return None
-
-        # AJUSTE: Se a API retornar ERROR, não retornamos dict vazio, retornamos None
-        if isinstance(data, dict) and data.get("status") == "ERROR":
-            return None
-
-        # Sucesso
-        return {
-            "nome": data.get("nome"), "email": data.get("email"),
-            "cep": (data.get("cep") or "").replace("-", "").strip() if data.get("cep") else None,
-            "logradouro": data.get("logradouro"), "bairro": data.get("bairro"),
-            "cidade": data.get("municipio"), "estado": data.get("uf"),
-        }
 
-    except Exception as e:
-        print(f"?? [EXCEPTION] Erro ao consultar ReceitaWS: {e}")
-        return None
+def _endereco_por_cep(cep: str) -> dict | None:
+    """ViaCEP do CEP; se vier sem código IBGE, completa pelo nome do município no IBGE."""
+    resp = _consultar_cep(cep)
+    if resp and not str(resp.get("ibge") or "").strip() and resp.get("localidade") and resp.get("uf"):
+        cidade, uf = resp["localidade"], resp["uf"]
+        ibge = cache_consultas.consultar(db, "ibge", f"{uf}:{cidade}",
+                                         lambda _: consultar_ibge_municipio(cidade, uf))
+        resp = {**resp, "ibge": ibge or ""}  # cópia: o dict do cache é compartilhado
+    return resp
 
 
 # ---------------- CRUD SEGURO ---------------- #
@@ -131,27 +122,23 @@ def create_client(client: ClientCreate, current_user: UserInDB = Depends(get_cur
                 for key, value in data_api.items():
                     _fill_if_empty(data, key, value)
         except Exception as e:
-            print(f"Falha ReceitaWS no create: {e}")
+            log.warning("Falha ReceitaWS no create do CNPJ %s: %s", data["cnpj"], e)
 
     cep = sanitize_document(data.get("cep", "") or "")
     if cep and len(cep) == 8:
-        try:
-            resp = requests.get(f"https://viacep.com.br/ws/{cep}/json/").json()
-            if "erro" not in resp:
-                data.update({
-                    "logradouro": resp.get("logradouro"),
-                    "bairro": resp.get("bairro"),
-                    "cidade": resp.get("localidade"),
-                    "estado": resp.get("uf"),
-                })
+        resp = _consultar_cep(cep)
+        if resp:
+            data.update({
+                "logradouro": resp.get("logradouro"),
+                "bairro": resp.get("bairro"),
+                "cidade": resp.get("localidade"),
+                "estado": resp.get("uf"),
+            })
 
             # ? SÓ cria IBGE se o front NÃO enviou o campo
             if "codigoIbge" not in raw_payload:
                 data["codigoIbge"] = sanitize_document(str(resp.get("ibge") or ""))
 
-        except Exception:
-            pass
-
     data["ativo"] = True
     data["created_at"] = datetime.utcnow()
     data["updated_at"] = datetime.utcnow()
@@ -216,21 +203,17 @@ def update_client(client_id: str, client: ClientUpdate, current_user: UserInDB =
 
     cep = data.get("cep", "")
     if cep and len(cep) == 8:
-        try:
-            resp = requests.get(f"https://viacep.com.br/ws/{cep}/json/").json()
-            if "erro" not in resp:
-                data.update({
-                    "logradouro": resp.get("logradouro"),
-                    "bairro": resp.get("bairro"),
-                    "cidade": resp.get("localidade"),
-                    "estado": resp.get("uf"),
-                })
+        resp = _consultar_cep(cep)
+        if resp:
+            data.update({
+                "logradouro": resp.get("logradouro"),
+                "bairro": resp.get("bairro"),
+                "cidade": resp.get("localidade"),
+                "estado": resp.get("uf"),
+            })
             if "codigoIbge" not in raw_payload:
                 data["codigoIbge"] = sanitize_document(str(resp.get("ibge") or ""))
 
-        except Exception:
-            pass
-
 
     unset_fields = {}
     # Garante limpeza final
@@ -320,7 +303,140 @@ async def import_clients(
     return {"msg": "Importação iniciada", "job_id": str(job_id_obj)}
 
 
+COLUNAS_IMPORT = {
+    "doc": "documento (CNPJ/CPF)",
+    "nome": "nome (obrigatório se CPF)",
+    "cep": "cep (obrigatório se CPF)",
+    "numero": "numero (obrigatório)",
+    "emissores": "emissores_cnpjs (separar múltiplos por vírgula)",
+}
+
+
+def _normalizar_planilha_import(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Normaliza a planilha de clientes em colunas (doc, cep, nome, numero, emissores, tipo) e
+    marca em 'erro' as regras que não dependem do banco nem das APIs, na mesma ordem da
+    validação linha a linha. Tudo vetorizado.
+    """
+    col = {k: df[v].astype(str).str.strip() for k, v in COLUNAS_IMPORT.items()}
+
+    doc = col["doc"].str.replace(r"\D", "", regex=True)
+    tam = doc.str.len()
+    doc = doc.mask(tam.between(1, 11), doc.str.zfill(11)).mask(tam.between(12, 14), doc.str.zfill(14))
+    cep = col["cep"].str.replace(r"\D", "", regex=True)
+    cep = cep.mask(cep.str.len().between(1, 7), cep.str.zfill(8))
+
+    out = pd.DataFrame({
+        "doc": doc, "cep": cep, "nome": col["nome"], "numero": col["numero"], "emissores": col["emissores"],
+        "tipo": tam.map(lambda n: "cpf" if 1 <= n <= 11 else ("cnpj" if 12 <= n <= 14 else "")),
+        "erro": "",
+    })
+
+    regras = [
+        (tam > 14, "Documento com " + tam.astype(str) + " dígitos inválido: " + col["doc"]),
+        (tam == 0, "Documento obrigatório não informado"),
+        ((out["tipo"] == "cpf") & (out["nome"] == ""), "Nome obrigatório para CPF"),
+        ((out["tipo"] == "cpf") & (out["cep"] == ""), "CEP obrigatório para CPF"),
+        (out["numero"] == "", "Número do logradouro é obrigatório"),
+    ]
+    for mascara, mensagem in regras:
+        out["erro"] = out["erro"].mask((out["erro"] == "") & mascara, mensagem)
+    return out
+
+
+ERRO_DUPLICADO_IMPORT = "Cliente com este documento já existe para este usuário"
+
+
+def _marcar_duplicados_import(linhas: pd.DataFrame, user_id: ObjectId):
+    """
+    Marca como duplicadas as linhas cujo documento já existe para o usuário (um $in por tipo).
+    Repetições dentro da própria planilha são tratadas na gravação, na ordem das linhas.
+    """
+    validas = linhas["erro"] == ""
+    existentes = pd.Series(False, index=linhas.index)
+    for tipo in ("cpf", "cnpj"):
+        alvo = validas & (linhas["tipo"] == tipo)
+        docs = linhas.loc[alvo, "doc"].unique().tolist()
+        if docs:
+            ja = set(db.clients.distinct(tipo, {"user_id": user_id, tipo: {"$in": docs}}))
+            existentes |= alvo & linhas["doc"].isin(ja)
+    linhas["erro"] = linhas["erro"].mask(validas & existentes, ERRO_DUPLICADO_IMPORT)
+
+
+def _montar_clientes_import(df: pd.DataFrame, validas: pd.DataFrame, user_id: ObjectId, emissor_por_cnpj: dict,
+                            aceitos: set, erros: list) -> list:
+    """
+    Enriquece (CNPJ e CEP em paralelo) e monta os clientes de um pedaço de linhas válidas.
+    'aceitos' guarda os documentos já aceitos na planilha: uma repetição só é recusada se a
+    ocorrência anterior foi aceita (como na validação linha a linha). Devolve [(linha, payload)].
+    """
+    dados_cnpj = consultar_em_paralelo(_enrich_from_receitaws, validas.loc[validas["tipo"] == "cnpj", "doc"])
+    ceps = {cep or sanitize_document((dados_cnpj.get(doc) or {}).get("cep") or "")
+            for doc, cep in zip(validas["doc"], validas["cep"])}
+    enderecos = consultar_em_paralelo(_endereco_por_cep, (c for c in ceps if len(c) == 8))
+
+    agora = datetime.utcnow()
+    pendentes = []
+    for i, l in zip(validas.index, validas.to_dict("records")):
+        if l["doc"] in aceitos:
+            erros.append({"linha": int(i) + 2, "documento": df.at[i, COLUNAS_IMPORT["doc"]],
+                          "erro": ERRO_DUPLICADO_IMPORT})
+            continue
+
+        payload = {
+            "user_id": user_id,
+            "nome": l["nome"],
+            "documento": l["doc"],
+            "email": None,
+            "cep": l["cep"],
+            "numero": l["numero"],
+            l["tipo"]: l["doc"],
+        }
+
+        emissores_ids = [emissor_por_cnpj[c] for c in
+                         (sanitize_document(x.strip()) for x in l["emissores"].split(",") if x.strip())
+                         if c in emissor_por_cnpj]
+        if emissores_ids:
+            payload["emissores_ids"] = emissores_ids
+
+        # Enriquecimento automático: só preenche se a API devolveu dados
+        data_api = dados_cnpj.get(l["doc"]) if l["tipo"] == "cnpj" else None
+        if data_api:
+            for key, value in data_api.items():
+                _fill_if_empty(payload, key, value)
+
+        # ViaCEP
+        resp = enderecos.get(sanitize_document(payload.get("cep") or ""))
+        if resp:
+            payload.update({
+                "logradouro": payload.get("logradouro") or resp.get("logradouro"),
+                "bairro": payload.get("bairro") or resp.get("bairro"),
+                "cidade": payload.get("cidade") or resp.get("localidade"),
+                "estado": payload.get("estado") or resp.get("uf"),
+                "codigoIbge": payload.get("codigoIbge") or str(resp.get("ibge") or "").strip(),
+            })
+
+        if not payload.get("nome"):
+            erros.append({"linha": int(i) + 2, "documento": df.at[i, COLUNAS_IMPORT["doc"]],
+                          "erro": "Nome não informado e API externa não conseguiu preencher"})
+            continue
+
+        payload["ativo"] = True
+        payload["created_at"] = agora
+        payload["updated_at"] = agora
+        aceitos.add(l["doc"])
+        pendentes.append((i, payload))
+    return pendentes
+
+
 def process_import_file(job_id_str: str, path: str, user_id_str: str):
+    """
+    Importação em lote: normalização e validação vetorizadas e documentos já cadastrados
+    resolvidos com um $in por tipo. Depois, pedaço a pedaço (IMPORT_LOTE_INSERCAO linhas):
+    enriquecimento em paralelo das linhas válidas, insert_many e progresso no job em 'imports'.
+    Se o processo cair no meio, o que já foi gravado fica (e é recusado como duplicado numa
+    nova importação da mesma planilha).
+    """
     job_id = ObjectId(job_id_str)
     user_id = ObjectId(user_id_str)
 
@@ -331,149 +447,58 @@ def process_import_file(job_id_str: str, path: str, user_id_str: str):
             df = pd.read_csv(path, dtype=str, keep_default_na=False)
 
         df.columns = [c.strip() for c in df.columns]
-        colunas_oficiais = [
-            "documento (CNPJ/CPF)", "nome (obrigatório se CPF)",
-            "cep (obrigatório se CPF)", "numero (obrigatório)",
-            "emissores_cnpjs (separar múltiplos por vírgula)",
-        ]
+        colunas_oficiais = list(COLUNAS_IMPORT.values())
         if set(df.columns) != set(colunas_oficiais):
             raise ValueError(f"Planilha inválida. Esperado: {colunas_oficiais}, recebido: {list(df.columns)}")
 
-        df = df.fillna("")
-        inserted, skipped, erros = 0, 0, []
-
-        emissores = list(db.emitters.find({}, {"_id": 1, "cnpj": 1}))
-
-        for idx, row in df.iterrows():
-            try:
-                doc_raw = (row.get("documento (CNPJ/CPF)") or "").strip()
-                nome_raw = (row.get("nome (obrigatório se CPF)") or "").strip()
-                cep_raw = (row.get("cep (obrigatório se CPF)") or "").strip()
-                numero_raw = (row.get("numero (obrigatório)") or "").strip()
-                emissores_raw = (row.get("emissores_cnpjs (separar múltiplos por vírgula)") or "").strip()
-
-                doc = sanitize_document(doc_raw)
-                cep = sanitize_document(cep_raw)
-
-                if 1 <= len(doc) <= 11:
-                    doc = doc.zfill(11)
-                elif 12 <= len(doc) <= 14:
-                    doc = doc.zfill(14)
-                elif doc:
-                    raise ValueError(f"Documento com {len(doc)} dígitos inválido: {doc_raw}")
-
-                if 0 < len(cep) < 8:
-                    cep = cep.zfill(8)
-
-                payload = {
-                    "user_id": user_id,
-                    "nome": nome_raw,
-                    "documento": doc,
-                    "email": None,
-                    "cep": cep,
-                    "numero": numero_raw or None,
-                }
-
-                if payload.get("documento"):
-                    tipo, numero = identificar_documento(payload["documento"])
-                    payload[tipo] = numero
-
-                filtro_dup = {"user_id": user_id}
-                if payload.get("cpf"):
-                    filtro_dup["cpf"] = payload.get("cpf")
-                if payload.get("cnpj"):
-                    filtro_dup["cnpj"] = payload.get("cnpj")
-
-                if len(filtro_dup) > 1 and db.clients.find_one(filtro_dup):
-                    raise ValueError("Cliente com este documento já existe para este usuário")
-
-                emissores_ids = []
-                if emissores_raw:
-                    for cnpj_text in [x.strip() for x in emissores_raw.split(",") if x.strip()]:
-                        cnpj_limpo = sanitize_document(cnpj_text)
-                        match = next((e["_id"] for e in emissores if sanitize_document(e["cnpj"]) == cnpj_limpo), None)
-                        if match:
-                            emissores_ids.append(str(match))
-                if emissores_ids:
-                    payload["emissores_ids"] = emissores_ids
-
-                # Enriquecimento automático
-                if payload.get("cnpj"):
-                    time.sleep(THROTTLE_SECONDS)
-                    data_api = _enrich_from_receitaws(payload["cnpj"])
-                    # AJUSTE: Só preenche se data_api não for None
-                    if data_api:
-                        for key, value in data_api.items():
-                            _fill_if_empty(payload, key, value)
-
-                # ViaCEP
-                cep_clean = sanitize_document(payload.get("cep") or "")
-                if cep_clean and len(cep_clean) == 8:
-                    try:
-                        resp = requests.get(f"https://viacep.com.br/ws/{cep_clean}/json/", timeout=10).json()
-                        if "erro" not in resp:
-                            ibge_code = str(resp.get("ibge") or "").strip()
-                            if not ibge_code and resp.get("localidade") and resp.get("uf"):
-                                try:
-                                    lookup = requests.get(
-                                        f"https://servicodados.ibge.gov.br/api/v1/localidades/municipios?nome={resp['localidade']}",
-                                        timeout=10
-                                    ).json()
-                                    match = next((m for m in lookup if
-                                                  m["microrregiao"]["mesorregiao"]["UF"]["sigla"] == resp["uf"]), None)
-                                    if match:
-                                        ibge_code = str(match["id"])
-                                except Exception:
-                                    pass
-
-                            payload.update({
-                                "logradouro": payload.get("logradouro") or resp.get("logradouro"),
-                                "bairro": payload.get("bairro") or resp.get("bairro"),
-                                "cidade": payload.get("cidade") or resp.get("localidade"),
-                                "estado": payload.get("estado") or resp.get("uf"),
-                                "codigoIbge": payload.get("codigoIbge") or ibge_code,
-                            })
-
-                    except Exception as e:
-                        print(f"Erro ao consultar ViaCEP {cep_clean}: {e}")
-
-                if not payload.get("documento"):
-                    raise ValueError("Documento obrigatório não informado")
-                if payload.get("cpf") and not payload.get("nome"):
-                    raise ValueError("Nome obrigatório para CPF")
-                if payload.get("cpf") and not payload.get("cep"):
-                    raise ValueError("CEP obrigatório para CPF")
-                if not payload.get("numero"):
-                    raise ValueError("Número do logradouro é obrigatório")
-                if not payload.get("nome"):
-                    raise ValueError("Nome não informado e API externa não conseguiu preencher")
-
-                payload["ativo"] = True
-                payload["created_at"] = datetime.utcnow()
-                payload["updated_at"] = datetime.utcnow()
-
-                db.clients.insert_one(payload)
-                inserted += 1
-
-            except Exception as e:
-                skipped += 1
-                erros.append({
-                    "linha": int(idx) + 2,
-                    "documento": row.get("documento (CNPJ/CPF)") or "",
-                    "erro": str(e)
-                })
-
+        df = df.fillna("").reset_index(drop=True)
+        total = len(df)
+        db.imports.update_one({"_id": job_id}, {"$set": {"status": "running", "total": total, "processed": 0}})
+
+        linhas = _normalizar_planilha_import(df)
+        _marcar_duplicados_import(linhas, user_id)
+
+        # CNPJ do emissor -> id, montado uma vez
+        emissor_por_cnpj = {}
+        for e in db.emitters.find({}, {"_id": 1, "cnpj": 1}):
+            emissor_por_cnpj.setdefault(sanitize_document(e.get("cnpj") or ""), str(e["_id"]))
+
+        erros, aceitos = [], set()
+        inserted = 0
+        for inicio in range(0, total, IMPORT_LOTE_INSERCAO):
+            lote = linhas.iloc[inicio:inicio + IMPORT_LOTE_INSERCAO]
+            erros.extend({"linha": int(i) + 2, "documento": df.at[i, COLUNAS_IMPORT["doc"]], "erro": e}
+                         for i, e in lote.loc[lote["erro"] != "", "erro"].items())
+
+            pendentes = _montar_clientes_import(df, lote[lote["erro"] == ""], user_id, emissor_por_cnpj,
+                                                aceitos, erros)
+            if pendentes:
+                try:
+                    inserted += len(db.clients.insert_many([p for _, p in pendentes], ordered=False).inserted_ids)
+                except BulkWriteError as bwe:
+                    falhas = {w["index"]: w.get("errmsg") for w in bwe.details.get("writeErrors", [])}
+                    inserted += len(pendentes) - len(falhas)
+                    for pos, msg in falhas.items():
+                        i = pendentes[pos][0]
+                        erros.append({"linha": int(i) + 2, "documento": df.at[i, COLUNAS_IMPORT["doc"]],
+                                      "erro": msg})
+
+            processadas = inicio + len(lote)
             db.imports.update_one(
                 {"_id": job_id},
-                {"$set": {
-                    "inserted": inserted,
-                    "skipped": skipped,
-                    "errors": erros,
-                    "status": "running"
-                }}
+                {"$set": {"inserted": inserted, "skipped": processadas - inserted, "processed": processadas,
+                          "errors": sorted(erros, key=lambda e: e["linha"])}}
             )
 
-        db.imports.update_one({"_id": job_id}, {"$set": {"status": "finished", "finished_at": datetime.utcnow()}})
+        erros.sort(key=lambda e: e["linha"])
+        db.imports.update_one({"_id": job_id}, {"$set": {
+            "inserted": inserted,
+            "skipped": total - inserted,
+            "processed": total,
+            "errors": erros,
+            "status": "finished",
+            "finished_at": datetime.utcnow(),
+        }})
 
     except Exception as e:
         db.imports.update_one(
@@ -524,20 +549,31 @@ def atualizar_dados_clientes():
 
     clientes = list(db.clients.find(query))
     total = len(clientes)
-    print(f"Clientes a verificar: {total}")
+    log.info("Atualização cadastral: %s clientes a verificar", total)
 
     count_atualizados = 0
     count_sem_alteracao = 0
     count_ignorados = 0
 
+    # As consultas de cada lote rodam em paralelo, limitadas pelo orçamento da ReceitaWS;
+    # um CNPJ repetido (mesmo cliente em vários usuários) é consultado uma vez só
+    dados_por_cnpj = {}
+
     for i, cli in enumerate(clientes, start=1):
+        if (i - 1) % LOTE_ATUALIZACAO == 0:
+            lote = clientes[i - 1:i - 1 + LOTE_ATUALIZACAO]
+            # dado novo: entradas vencidas no cache são consultadas de novo, as válidas não
+            dados_por_cnpj.update(consultar_em_paralelo(
+                lambda cnpj: _enrich_from_receitaws(cnpj, permitir_obsoleto=False),
+                (c.get("cnpj") for c in lote if c.get("cnpj") not in dados_por_cnpj)
+            ))
+
         cnpj = cli.get("cnpj")
-        data_api = _enrich_from_receitaws(cnpj)
+        data_api = dados_por_cnpj.get(cnpj)
 
         if not data_api:
-            print(f"[{i}/{total}] CNPJ {cnpj} ignorado (Erro/Limit API).")
+            log.info("[%s/%s] CNPJ %s ignorado (erro/limite da API)", i, total, cnpj)
             count_ignorados += 1
-            time.sleep(THROTTLE_SECONDS)
             continue
 
         try:
@@ -572,30 +608,23 @@ def atualizar_dados_clientes():
                     {"$set": update_fields}
                 )
                 count_atualizados += 1
-                print(f"[{i}/{total}] Atualizado: {cli.get('nome', '-')} | Mudanças: {campos_atualizados}")
+                log.info("[%s/%s] Atualizado: %s | mudanças: %s", i, total, cli.get("nome", "-"), campos_atualizados)
             else:
                 db.clients.update_one(
                     {"_id": cli["_id"]},
                     {"$set": {"updated_at": datetime.utcnow(), "atualizado_recente": False}}
                 )
                 count_sem_alteracao += 1
-                print(f"[{i}/{total}] Sem alterações: {cnpj}")
+                log.debug("[%s/%s] Sem alterações: %s", i, total, cnpj)
 
         except Exception as e:
-            print(f"Erro ao processar atualização CNPJ {cnpj}: {e}")
+            log.exception("Erro ao processar atualização do CNPJ %s: %s", cnpj, e)
             count_ignorados += 1
 
-        if i < total:
-            time.sleep(THROTTLE_SECONDS)
-
     fim = datetime.utcnow()
     duracao_min = (fim - inicio).total_seconds() / 60
-    print("------------ RESUMO ------------")
-    print(f"Duração: {duracao_min:.2f} min")
-    print(f"Atualizados: {count_atualizados}")
-    print(f"Sem alteração: {count_sem_alteracao}")
-    print(f"Ignorados: {count_ignorados}")
-    print("--------------------------------")
+    log.info("Atualização cadastral concluída em %.2f min: %s atualizados, %s sem alteração, %s ignorados",
+             duracao_min, count_atualizados, count_sem_alteracao, count_ignorados)
 
 
 @router.get("/stats")
@@ -1,22 +1,66 @@
 from fastapi import APIRouter, HTTPException, Body, Depends
 from typing import Optional, Dict, Any
+from bisect import bisect_right
+from collections import defaultdict
 from bson import ObjectId
 from datetime import datetime
+from pymongo import UpdateOne
 from db import db
 from models import NotaPreviewItemIn, TaskDraftUpdate, UserInDB
 from utils import serialize_doc
 from routers.auth import get_current_user
+import logging
 import re
 
 router = APIRouter(prefix="/notas/drafts", tags=["Drafts"])
+log = logging.getLogger(__name__)
 
 
 def _proj(d):
     return serialize_doc(d)
 
 
+def _competencia_month(s: Optional[str]) -> Optional[str]:
+    if not s: return None
+    s = str(s).strip()
+    # Aceita YYYY-MM-DD ou YYYY-MM
+    m = re.match(r"^(\d{4}-\d{2})", s)
+    return m.group(1) if m else None
+
+
+class _IndiceAliquotas:
+    """
+    Histórico de alíquotas do emissor carregado uma vez e indexado por mês.
+    Mesma regra da consulta por item: a alíquota EXATA do mês; se não houver, a última
+    disponível ANTERIOR ou IGUAL ao mês (nunca a de um mês posterior).
+    """
+
+    def __init__(self, emitter_oid: ObjectId):
+        self.exatas = {}
+        for a in db.aliquotas.find({"emitter_id": emitter_oid}, {"ano": 1, "mes": 1, "aliquota": 1}):
+            if a.get("ano") is not None and a.get("mes") is not None:
+                self.exatas.setdefault((a["ano"], a["mes"]), float(a.get("aliquota") or 0))
+        self.periodos = sorted(self.exatas)
+
+    def do_mes(self, comp_month: str) -> float:
+        try:
+            ano, mes = map(int, comp_month.split('-'))
+        except (AttributeError, ValueError):
+            return 0.0
+        if (ano, mes) in self.exatas:
+            return self.exatas[(ano, mes)]
+        pos = bisect_right(self.periodos, (ano, mes))
+        return self.exatas[self.periodos[pos - 1]] if pos else 0.0
+
+
 @router.post("/import")
 def drafts_import(payload: Dict[str, Any] = Body(...), current_user: UserInDB = Depends(get_current_user)):
+    """
+    Importa os itens da prévia como rascunhos. Os clientes vêm numa consulta $in, as alíquotas
+    do emissor num índice em memória e os rascunhos pendentes do mesmo cliente/mês numa única
+    leitura; a sequência de upserts (mesma ordem e regras do processamento item a item) é
+    aplicada num único bulk_write.
+    """
     user_id = ObjectId(current_user.id)
     emitterId = payload.get("emitterId")
     items = payload.get("items") or []
@@ -28,59 +72,10 @@ def drafts_import(payload: Dict[str, Any] = Body(...), current_user: UserInDB =
     if not db.emitters.find_one(emitter_query):
         raise HTTPException(status_code=404, detail="Emissor não encontrado ou não pertence ao seu usuário")
 
-    # --- REMOVIDO: A busca global da alíquota aqui estava errada ---
-
     created, updated, skipped, draft_ids = 0, 0, 0, []
 
-    # Cache local para não consultar o banco mil vezes no mesmo loop
-    # Chave: "2025-11", Valor: 0.1162 (float)
-    rates_cache = {}
-
-    def _competencia_month(s: Optional[str]) -> Optional[str]:
-        if not s: return None
-        s = str(s).strip()
-        # Aceita YYYY-MM-DD ou YYYY-MM
-        m = re.match(r"^(\d{4}-\d{2})", s)
-        return m.group(1) if m else None
-
-    # Função auxiliar para buscar alíquota correta por mês
-    def get_rate_for_month(comp_str):
-        if not comp_str: return 0.0
-        if comp_str in rates_cache:
-            return rates_cache[comp_str]
-
-        try:
-            ano, mes = map(int, comp_str.split('-'))
-            # Busca EXATA para aquele mês/ano
-            doc = db.aliquotas.find_one({
-                "emitter_id": ObjectId(emitterId),
-                "mes": mes,
-                "ano": ano
-            })
-
-            if doc:
-                val = float(doc.get("aliquota") or 0)
-            else:
-                # FALLBACK: Se não achar a do mês específico, pega a última disponível ANTERIOR ou IGUAL a data
-                # Isso evita pegar alíquota de Dezembro para nota de Novembro
-                # Mas o ideal é ter a alíquota exata.
-                fallback = db.aliquotas.find_one(
-                    {
-                        "emitter_id": ObjectId(emitterId),
-                        "$or": [
-                            {"ano": {"$lt": ano}},
-                            {"ano": ano, "mes": {"$lte": mes}}
-                        ]
-                    },
-                    sort=[("ano", -1), ("mes", -1)]
-                )
-                val = float(fallback.get("aliquota") or 0) if fallback else 0.0
-
-            rates_cache[comp_str] = val
-            return val
-        except:
-            return 0.0
-
+    # --- 1) Validação dos itens (sem banco) ---
+    validos = []  # (raw, cleaned, item, force_new, comp_month)
     for raw in items:
         try:
             force_new = bool(raw.get("force_new") or raw.get("duplicate_confirmed"))
@@ -89,97 +84,107 @@ def drafts_import(payload: Dict[str, Any] = Body(...), current_user: UserInDB =
             cleaned.pop("duplicate_confirmed", None)
 
             item = NotaPreviewItemIn(**cleaned)
-            if not item.ok:
+            comp_month = _competencia_month(item.competencia)
+            if not item.ok or not ObjectId.is_valid(item.clienteId) or not comp_month:
                 skipped += 1
                 continue
+            validos.append((raw, cleaned, item, force_new, comp_month))
+        except Exception as e:
+            log.warning("Erro ao importar draft: %s", e)
+            skipped += 1
 
-            cliente = db.clients.find_one({
-                "_id": ObjectId(item.clienteId),
-                "user_id": user_id,
-                "ativo": {"$ne": False}
-            })
-            if not cliente:
-                skipped += 1
-                continue
+    # --- 2) Pré-carga: clientes, alíquotas e rascunhos pendentes dos pares cliente/mês ---
+    client_ids = list({v[2].clienteId for v in validos})
+    clientes_ativos = {str(c["_id"]) for c in db.clients.find(
+        {"_id": {"$in": [ObjectId(c) for c in client_ids]}, "user_id": user_id, "ativo": {"$ne": False}},
+        {"_id": 1}
+    )} if client_ids else set()
+
+    aliquotas = _IndiceAliquotas(ObjectId(emitterId))
+
+    # (client_id, competencia_month) -> rascunhos pendentes, do menos para o mais recente
+    grupos = defaultdict(list)
+    if client_ids:
+        for d in db.tasks_draft.find(
+                {"user_id": user_id, "emitter_id": emitterId, "client_id": {"$in": client_ids},
+                 "competencia_month": {"$in": list({v[4] for v in validos})}, "status": "pending"},
+                {"client_id": 1, "competencia_month": 1, "duplicate_group_id": 1, "seq": 1, "updated_at": 1}
+        ).sort("updated_at", 1):
+            grupos[(d["client_id"], d["competencia_month"])].append(d)
+
+    # --- 3) Mesmas regras do processamento item a item, sobre o estado em memória ---
+    ops = []
+    for raw, cleaned, item, force_new, comp_month in validos:
+        if item.clienteId not in clientes_ativos:
+            skipped += 1
+            continue
 
-            comp_month = _competencia_month(item.competencia)
-            if not comp_month:
-                skipped += 1
-                continue
+        # --- BUSCA ALIQUOTA ---
+        aliquota_item = aliquotas.do_mes(comp_month)
+        # TRAVA DE SEGURANÇA: Se não tiver alíquota, bloqueia a criação/importação do item
+        if aliquota_item <= 0:
+            log.warning("Erro ao importar draft: não foi encontrada alíquota (PGDAS) para a competência %s", comp_month)
+            skipped += 1
+            continue
 
-            # --- BUSCA ALIQUOTA ---
-            aliquota_item = get_rate_for_month(comp_month)
-            # -------------------------------------------------------------------------------
-            # TRAVA DE SEGURANÇA: Se não tiver alíquota, bloqueia a criação/importação
-
-            if aliquota_item <= 0:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"ERRO: Não foi encontrada alíquota (PGDAS) para a competência {comp_month}. "
-                           f"Por favor, vá em 'Alíquotas' e faça o upload do PGDAS correspondente antes de emitir a nota."
-                )
-
-            uniq_key = f"{emitterId}:{item.clienteId}:{comp_month}"
-
-            doc = {
-                "user_id": user_id,
-                "status": "pending",
-                "emitter_id": emitterId,
-                "client_id": item.clienteId,
-                "cpf_cnpj": item.cpf_cnpj,
-                "cliente_nome": item.cliente_nome,
-                "descricao": item.descricao,
-                "valor": float(item.valor),
-                "competencia": item.competencia,
-                "competencia_month": comp_month,
-                "uniq_key": uniq_key,
-                "cod_servico": item.cod_servico,
-                "aliquota": aliquota_item,  # Usa a alíquota correta do mês
-                "municipio_ibge": item.municipio_ibge,
-                "pais_prestacao": item.pais_prestacao,
-                "iss_retido": item.iss_retido,
-                "dataEmissao": item.dataEmissao,
-                "duplicate_confirmed": force_new,
-                "updated_at": datetime.utcnow(),
-                "origem": cleaned.get("origem") or raw.get("origem"),
-            }
-
-            find_query = {
-                "user_id": user_id,
-                "emitter_id": emitterId,
-                "client_id": item.clienteId,
-                "competencia_month": comp_month,
-                "status": "pending"
-            }
+        uniq_key = f"{emitterId}:{item.clienteId}:{comp_month}"
+        agora = datetime.utcnow()
 
+        doc = {
+            "user_id": user_id,
+            "status": "pending",
+            "emitter_id": emitterId,
+            "client_id": item.clienteId,
+            "cpf_cnpj": item.cpf_cnpj,
+            "cliente_nome": item.cliente_nome,
+            "descricao": item.descricao,
+            "valor": float(item.valor),
+            "competencia": item.competencia,
+            "competencia_month": comp_month,
+            "uniq_key": uniq_key,
+            "cod_servico": item.cod_servico,
+            "aliquota": aliquota_item,  # Usa a alíquota correta do mês
+            "municipio_ibge": item.municipio_ibge,
+            "pais_prestacao": item.pais_prestacao,
+            "iss_retido": item.iss_retido,
+            "dataEmissao": item.dataEmissao,
+            "duplicate_confirmed": force_new,
+            "updated_at": agora,
+            "origem": cleaned.get("origem") or raw.get("origem"),
+        }
+
+        grupo = grupos[(item.clienteId, comp_month)]
+        existing = grupo[-1] if grupo else None
+
+        if force_new or not existing:
             if force_new:
-                existing_group = list(db.tasks_draft.find(find_query))
-                group_id = existing_group[0].get("duplicate_group_id") if existing_group else uniq_key
-                next_seq = (max([e.get("seq", 0) for e in existing_group]) if existing_group else 0) + 1
+                group_id = grupo[0].get("duplicate_group_id") if grupo else uniq_key
+                next_seq = (max([e.get("seq", 0) for e in grupo]) if grupo else 0) + 1
                 doc["uniq_key"] = f"{uniq_key}:{next_seq}"
-                doc.update({"duplicate_group_id": group_id, "seq": next_seq, "created_at": datetime.utcnow()})
-                res = db.tasks_draft.insert_one(doc)
-                draft_ids.append(str(res.inserted_id))
-                created += 1
             else:
-                existing = db.tasks_draft.find_one(find_query, sort=[("updated_at", -1)])
-                if existing:
-                    if existing.get("duplicate_group_id"): doc["duplicate_group_id"] = existing["duplicate_group_id"]
-                    if existing.get("seq"): doc["seq"] = existing["seq"]
-                    update_query = {"_id": existing["_id"], "user_id": user_id}
-                    db.tasks_draft.update_one(update_query, {"$set": doc})
-                    draft_ids.append(str(existing["_id"]))
-                    updated += 1
-                else:
-                    doc.update({"duplicate_group_id": uniq_key, "seq": 1, "created_at": datetime.utcnow()})
-                    res = db.tasks_draft.insert_one(doc)
-                    draft_ids.append(str(res.inserted_id))
-                    created += 1
-        except Exception as e:
-            import traceback
-            print(f"!!! ERRO AO IMPORTAR DRAFT: {e}")
-            traceback.print_exc()
-            skipped += 1
+                group_id, next_seq = uniq_key, 1
+            doc.update({"duplicate_group_id": group_id, "seq": next_seq})
+
+            novo_id = ObjectId()
+            ops.append(UpdateOne(
+                {"uniq_key": doc["uniq_key"], "user_id": user_id, "status": "pending"},
+                {"$set": doc, "$setOnInsert": {"_id": novo_id, "created_at": agora}},
+                upsert=True
+            ))
+            grupo.append({"_id": novo_id, "duplicate_group_id": group_id, "seq": next_seq, "updated_at": agora})
+            draft_ids.append(str(novo_id))
+            created += 1
+        else:
+            if existing.get("duplicate_group_id"): doc["duplicate_group_id"] = existing["duplicate_group_id"]
+            if existing.get("seq"): doc["seq"] = existing["seq"]
+            ops.append(UpdateOne({"_id": existing["_id"], "user_id": user_id}, {"$set": doc}))
+            existing["updated_at"] = agora  # continua sendo o mais recente do grupo
+            draft_ids.append(str(existing["_id"]))
+            updated += 1
+
+    if ops:
+        # ordered: um item que atualiza o rascunho criado por outro do mesmo lote vem depois dele
+        db.tasks_draft.bulk_write(ops, ordered=True)
 
     return {"msg": f"{created} rascunhos criados, {updated} atualizados, {skipped} ignorados", "draft_ids": draft_ids}
 
@@ -327,7 +332,6 @@ def drafts_reconcile(payload: Dict[str, Any] = Body(...), current_user: UserInDB
     kept = list(db.tasks_draft.find(kept_q))
 
     # agrupa por (client_id, competencia_month)
-    from collections import defaultdict
     groups = defaultdict(list)
     for d in kept:
         key = (d.get("client_id"), d.get("competencia_month"))
@@ -6,6 +6,8 @@ from db import db
 from models import EmitterUpdate, UserInDB
 from utils import sanitize_document, serialize_doc, extrair_validade_certificado, encrypt_data
 from routers.auth import get_current_user
+from backend.transmitter import invalidar_sessoes
+from backend.cert_cache import invalidar_certificado
 
 UPLOAD_DIR = "uploads/certificados"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
@@ -69,6 +71,10 @@ def create_emitter(
     with open(filepath, "wb") as buffer:
         buffer.write(file_content)
 
+    # --- Descarta certificado em cache e sessões mTLS antigas que usavam o mesmo arquivo ---
+    invalidar_certificado(filepath)
+    invalidar_sessoes(filepath)
+
     # --- Extrair validade diretamente com a senha pura ---
     validade = extrair_validade_certificado(filepath, senhaCertificado)
 
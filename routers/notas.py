@@ -1,27 +1,45 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Body, Depends, Path
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Body, Depends, Path, BackgroundTasks
 from typing import Optional, Dict, Any, Tuple, List
 from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta
+import hashlib
+import json
 import logging
+import os
 import re
 import io
+import traceback
 from pydantic import BaseModel, Field
 from db import db
 from models import UserInDB
 from routers.auth import get_current_user
 from utils import (
     to_float,
-    next_dps,
+    next_dps_block,
+    registrar_dps_nao_usados,
     canonical_from_label,
     gerar_dpsXmlGZipB64,
     parse_nfse_response,
     sanitize_document,
-    is_dps_repetida
+    serialize_doc,
+    is_dps_repetida,
+    id_ref
 )
 from backend.transmitter import enviar_nfse_pkcs12, enviar_cancelamento_pkcs12
-from backend.nfse_builder import build_nfse_xml, build_cancelamento_xml
+from backend.nfse_builder import build_cancelamento_xml
 from backend.signer import assinar_xml
+from backend.worker import reivindicar_task, finalizar_task, liberar_task
+from backend.faturamento import registrar_mudanca_status, PROJECAO_FATURAMENTO
+from backend.nfse_campos import CAMPO_NFSE, extrair_campos_nfse
+from backend.metricas import TASKS_TRANSMITIDAS
+from backend.emissao import montar_e_assinar
+from backend.blob_store import descarregar_resultado, texto_campo
+
+# Job de emissão sem atualização há mais que isso é dado como interrompido (ex.: restart da API)
+EMISSAO_JOB_EXPIRA_SEGUNDOS = int(os.getenv("EMISSAO_JOB_EXPIRA_SEGUNDOS", "600"))
 
 router = APIRouter(prefix="/notas", tags=["Notas"])
 log = logging.getLogger("uvicorn.error")
@@ -153,7 +171,9 @@ def _processar_cancelamento_task(task_id: str, justificativa: str, c_motivo: str
                 "canceled_at": datetime.utcnow(),
                 "cancel_event": {"sent_at": datetime.utcnow(), "http_status": http_status, "response": json_resp}
             }
-            db.tasks.update_one(task_query, {"$set": update_set})
+            res = db.tasks.update_one({**task_query, "status": "accepted"}, {"$set": update_set})
+            if res.modified_count:
+                registrar_mudanca_status(db, task, "canceled")
 
             msg_sucesso = (json_resp.get("retornoEvento") or [{}])[0].get("xMotivo", "Cancelamento registrado")
             return (True, msg_sucesso, json_resp)
@@ -164,14 +184,324 @@ def _processar_cancelamento_task(task_id: str, justificativa: str, c_motivo: str
     except Exception as e:
         log.error(f"[Cancelamento] Falha Crítica {task_id}: {e}", exc_info=True)
         # Garante que o DB não fique em estado inconsistente se a falha for local
-        db.tasks.update_one(task_query, {"$set": {"status": "error", "error_at": datetime.utcnow(),
-                                                  "transmit.error": f"Falha no cancelamento: {e}"}})
+        antes = db.tasks.find_one_and_update(
+            task_query,
+            {"$set": {"status": "error", "error_at": datetime.utcnow(),
+                      "transmit.error": f"Falha no cancelamento: {e}"}},
+            projection=PROJECAO_FATURAMENTO,
+        )
+        if antes:
+            registrar_mudanca_status(db, antes, "error")
         return (False, f"Exceção no backend: {e}", None)
 
 
+# --- Emissão em lote (job em background) ---
+def _criar_job_emissao(user_id: ObjectId, emitter_id: str, origem: str, total: int,
+                       job_id: ObjectId | None = None, chave: str | None = None) -> ObjectId:
+    """
+    Registra o job em 'emissoes'. Com chave, o índice único de 'chave_ativa' impede um segundo
+    job com os mesmos itens enquanto este não terminar (DuplicateKeyError para quem chama).
+    """
+    job_id = job_id or ObjectId()
+    agora = datetime.utcnow()
+    db.emissoes.insert_one({
+        "_id": job_id,
+        "user_id": user_id,
+        "emitter_id": emitter_id,
+        "origem": origem,
+        "status": "pending", "total": total, "created": 0, "task_ids": [], "erros": [], "msg": None,
+        "started_at": agora, "updated_at": agora, "finished_at": None,
+        **({"chave_ativa": chave} if chave else {}),
+    })
+    return job_id
+
+
+def _reservar_drafts(job_id: ObjectId, drafts: list) -> list:
+    """
+    Passa os drafts de 'pending' para 'emitting' em nome do job, numa única operação, e devolve
+    só os que este job conseguiu reservar (outro clique/POST repetido não pega os mesmos).
+    """
+    ids = [d["_id"] for d in drafts]
+    db.tasks_draft.update_many(
+        {"_id": {"$in": ids}, "status": "pending"},
+        {"$set": {"status": "emitting", "job_id": job_id, "updated_at": datetime.utcnow()}}
+    )
+    reservados = {d["_id"] for d in db.tasks_draft.find({"_id": {"$in": ids}, "job_id": job_id,
+                                                         "status": "emitting"}, {"_id": 1})}
+    return [d for d in drafts if d["_id"] in reservados]
+
+
+def _liberar_drafts(job_id: ObjectId):
+    """Devolve para 'pending' os drafts do job que não viraram task."""
+    db.tasks_draft.update_many(
+        {"job_id": job_id, "status": "emitting"},
+        {"$set": {"status": "pending", "updated_at": datetime.utcnow()}, "$unset": {"job_id": ""}}
+    )
+
+
+def _encerrar_job(job_id: ObjectId, campos: dict, filtro: dict | None = None) -> bool:
+    """Grava o estado final do job, solta a chave de idempotência e libera os drafts restantes."""
+    res = db.emissoes.update_one(
+        {"_id": job_id, **(filtro or {})},
+        {"$set": {**campos, "finished_at": datetime.utcnow(), "updated_at": datetime.utcnow()},
+         "$unset": {"chave_ativa": ""}}
+    )
+    if res.matched_count:
+        _liberar_drafts(job_id)
+    return bool(res.matched_count)
+
+
+def _expirar_job_se_parado(job: dict) -> dict:
+    """
+    O job roda como BackgroundTask do processo da API: se ele morrer (restart, OOM), o documento
+    ficaria 'running' para sempre. Sem atualização há EMISSAO_JOB_EXPIRA_SEGUNDOS, vira 'error'.
+    """
+    if job.get("status") not in ("pending", "running"):
+        return job
+    visto_em = job.get("updated_at") or job.get("started_at")
+    if visto_em and datetime.utcnow() - visto_em < timedelta(seconds=EMISSAO_JOB_EXPIRA_SEGUNDOS):
+        return job
+    msg = "Geração interrompida (job sem atualização). Confira as notas criadas e gere novamente as restantes."
+    if _encerrar_job(job["_id"], {"status": "error", "msg": msg}, {"status": job["status"], "updated_at": job.get("updated_at")}):
+        log.warning(f"Job de emissão {job['_id']} expirado (última atualização em {visto_em})")
+    return db.emissoes.find_one({"_id": job["_id"]}) or job
+
+
+def _preparar_drafts(drafts: list, emitter_id: str, user_id: ObjectId, aliquota_atual: float, erros: list) -> list:
+    """Resolve os clientes de todos os drafts numa única consulta e monta os itens de emissão."""
+    client_ids = {d.get("client_id") for d in drafts if d.get("client_id")}
+    chaves = [ObjectId(c) if ObjectId.is_valid(c) else c for c in client_ids]
+    clientes = {str(c["_id"]): c for c in db.clients.find({"_id": {"$in": chaves}, "user_id": user_id})}
+
+    anonimo = None
+    preparados = []
+    for d in drafts:
+        try:
+            client_id = d.get("client_id")
+            if not client_id:
+                raise ValueError("Draft sem client_id")
+
+            client = clientes.get(str(client_id))
+            if not client:
+                # tenta localizar o "tomador não identificado"
+                if anonimo is None:
+                    anonimo = db.clients.find_one({
+                        "nao_identificado": True,
+                        "emissores_ids": emitter_id,
+                        "user_id": user_id
+                    }) or {}
+                client = anonimo
+            if not client:
+                raise ValueError("Cliente não encontrado")
+
+            # --- ? CTN fallback ---
+            ctn6 = _ctn_to_6digits(d.get("cod_servico")) or "010101"
+
+            competencia_raw = d.get("competencia") or d.get("dataEmissao")
+            competencia_formatada, _ = _normalize_competencia(competencia_raw, fallback_today=True)
+            valor = float(d.get("valor") or 0)
+
+            preparados.append({
+                "ref": {"draft_id": str(d["_id"])},
+                "draft_id": d["_id"],
+                "client": client,
+                "service": {
+                    "descricao": d["descricao"],
+                    "valor": valor,
+                    "cTribNac": ctn6,
+                    "aliquota": aliquota_atual,
+                    "municipioIbge": d.get("municipio_ibge"),
+                    "issRetido": d.get("iss_retido"),
+                },
+                "competencia": competencia_formatada,
+                "data_emissao": d.get("dataEmissao"),
+                "task": {
+                    "client_id": str(client["_id"]),
+                    "valor": valor,
+                    "competencia": competencia_formatada,
+                    "source": {"kind": "draft", "draft_id": d["_id"]},
+                },
+            })
+        except Exception as e:
+            log.error(f"Erro ao gerar task do draft {d.get('_id')}: {e}")
+            erros.append({"draft_id": str(d.get("_id")), "erro": str(e)})
+    return preparados
+
+
+def _preparar_itens(items: list, user_id: ObjectId, erros: list) -> list:
+    """Itens da prévia (/notas/confirmar): clientes resolvidos numa única consulta."""
+    oids = [ObjectId(it["clienteId"]) for it in items if ObjectId.is_valid(str(it.get("clienteId")))]
+    clientes = {str(c["_id"]): c for c in db.clients.find({"_id": {"$in": oids}, "user_id": user_id})}
+
+    preparados = []
+    for it in items:
+        try:
+            if not it.get("ok"): raise ValueError("Linha inválida na prévia")
+
+            client = clientes.get(str(ObjectId(it["clienteId"])))
+            if not client:
+                raise ValueError("Cliente não encontrado ou não pertence ao seu usuário")
+
+            preparados.append({
+                "ref": {"index": it.get("index")},
+                "client": client,
+                "service": {
+                    "descricao": it["descricao"], "valor": float(it["valor"]), "cTribNac": it["cod_servico"],
+                    "aliquota": it["aliquota"], "municipioIbge": it.get("municipio_ibge"),
+                    "issRetido": it.get("iss_retido"),
+                },
+                "competencia": it["competencia"],
+                "data_emissao": it.get("dataEmissao"),
+                "task": {"client_id": it["clienteId"], "valor": float(it["valor"]), "competencia": it["competencia"]},
+            })
+        except Exception as e:
+            erros.append({"index": it.get("index"), "erro": str(e)})
+    return preparados
+
+
+def _emitir_preparados(job_id: ObjectId, emitter: dict, user_id: ObjectId, preparados: list, serie: str,
+                       erros: list) -> Tuple[int, list]:
+    """
+    Reserva os números de DPS (um bloco só), manda montagem + assinatura para o pool de processos e grava
+    as tasks (insert_many) e os drafts consumidos (bulk_write) a cada pedaço concluído.
+    """
+    emitter_id = str(emitter["_id"])
+
+    # 1) Números de DPS: um único bloco contíguo para o lote inteiro
+    numerados, bloco = [], []
+    try:
+        bloco = next_dps_block(db, emitter_id, serie=serie, n=len(preparados))
+        for p, dps in zip(preparados, bloco):
+            p["dps"] = dps
+            numerados.append(p)
+    except Exception as e:
+        erros.extend({**p["ref"], "erro": str(e)} for p in preparados)
+
+    itens_cpu = [{
+        "client": p["client"], "service": p["service"],
+        "numero_dps": p["dps"]["numero"], "serie_dps": p["dps"]["serie"],
+        "competencia": p["competencia"], "data_emissao": p["data_emissao"],
+    } for p in numerados]
+
+    task_ids = []
+    consumidos = set()  # (serie, numero) do bloco que já viraram task ou lacuna registrada
+
+    # 2) Gravação por pedaço, conforme o pool devolve
+    def _gravar(inicio: int, resultados: list):
+        # Job já dado como expirado: não grava nada (os drafts dele podem ter voltado a 'pending')
+        vivo = db.emissoes.update_one({"_id": job_id, "status": "running"},
+                                      {"$set": {"updated_at": datetime.utcnow()}})
+        if not vivo.matched_count:
+            raise RuntimeError("Job de emissão expirado durante a geração")
+
+        tasks, origem, perdidos = [], [], []
+        for p, (ok, saida) in zip(numerados[inicio:inicio + len(resultados)], resultados):
+            if not ok:
+                erros.append({**p["ref"], "erro": saida})
+                perdidos.append((p["dps"]["serie"], p["dps"]["numero"], saida))
+                continue
+            tasks.append({
+                "user_id": user_id,
+                "type": "emit_nfse",
+                "emitter_id": ObjectId(emitter_id),
+                "client_id": id_ref(p["task"]["client_id"]),
+                "valor": p["task"]["valor"],
+                "status": "pending",
+                "created_at": datetime.utcnow(),
+                "dps": {"serie": p["dps"]["serie"], "numero": p["dps"]["numero"], "status": "reservado"},
+                "competencia": p["task"]["competencia"],
+                "response": {"xml": saida, "valor": p["task"]["valor"]},
+                **({"source": p["task"]["source"]} if p["task"].get("source") else {}),
+            })
+            origem.append(p)
+
+        if tasks:
+            res = db.tasks.insert_many(tasks, ordered=True)
+            ids = [str(i) for i in res.inserted_ids]
+            task_ids.extend(ids)
+            consumidos.update((p["dps"]["serie"], p["dps"]["numero"]) for p in origem)
+
+            # --- ? Marca os drafts como consumidos ---
+            agora = datetime.utcnow()
+            consumos = [
+                UpdateOne({"_id": p["draft_id"]},
+                          {"$set": {"status": "consumed", "consumed_at": agora, "task_id": tid},
+                           "$unset": {"job_id": ""}})
+                for p, tid in zip(origem, ids) if p.get("draft_id")
+            ]
+            if consumos:
+                db.tasks_draft.bulk_write(consumos, ordered=False)
+
+        # Números reservados que não viraram task ficam registrados como lacuna (um insert por série)
+        por_serie = {}
+        for serie_dps, numero, motivo in perdidos:
+            por_serie.setdefault(serie_dps, {})[numero] = motivo
+        for serie_dps, motivos in por_serie.items():
+            registrar_dps_nao_usados(db, emitter_id, serie_dps, list(motivos), motivos=motivos)
+            consumidos.update((serie_dps, numero) for numero in motivos)
+
+        db.emissoes.update_one(
+            {"_id": job_id},
+            {"$set": {"status": "running", "created": len(task_ids), "task_ids": task_ids, "erros": erros,
+                      "updated_at": datetime.utcnow()}}
+        )
+
+    try:
+        montar_e_assinar(emitter, itens_cpu, ao_concluir_pedaco=_gravar)
+    finally:
+        # Abortou no meio (job expirado, pool quebrado, erro do Mongo): o resto do bloco reservado
+        # que não virou task nem lacuna (pedaços não gravados, pedaço que falhou no meio) vira lacuna
+        por_serie = {}
+        for dps in bloco:
+            if (dps["serie"], dps["numero"]) not in consumidos:
+                por_serie.setdefault(dps["serie"], []).append(dps["numero"])
+        for serie_dps, numeros in por_serie.items():
+            try:
+                registrar_dps_nao_usados(db, emitter_id, serie_dps, numeros, motivo="job abortado")
+            except Exception:
+                log.exception(f"Falha ao registrar lacunas de DPS do job {job_id}")
+    return len(task_ids), task_ids
+
+
+def processar_emissao(job_id_str: str, emitter_id: str, user_id_str: str, origem: str, dados: list,
+                      aliquota_atual: float = 0.0):
+    """Job em background de /notas/confirmar-from-drafts (origem 'drafts') e /notas/confirmar ('itens')."""
+    job_id = ObjectId(job_id_str)
+    user_id = ObjectId(user_id_str)
+    erros = []
+
+    try:
+        db.emissoes.update_one({"_id": job_id}, {"$set": {"status": "running", "updated_at": datetime.utcnow()}})
+        emitter = db.emitters.find_one({"_id": ObjectId(emitter_id), "user_id": user_id})
+
+        if origem == "drafts":
+            preparados = _preparar_drafts(dados, emitter_id, user_id, aliquota_atual, erros)
+            serie = "1"
+        else:
+            preparados = _preparar_itens(dados, user_id, erros)
+            serie = "U"
+
+        created, task_ids = _emitir_preparados(job_id, emitter, user_id, preparados, serie, erros)
+
+        if created == 1:
+            msg = "1 solicitação criada com sucesso"
+        else:
+            msg = f"{created} solicitações criadas com sucesso"
+
+        # drafts que falharam (cliente, DPS, assinatura) voltam para 'pending'
+        _encerrar_job(job_id, {"status": "finished", "msg": msg, "created": created, "task_ids": task_ids,
+                               "erros": erros})
+
+    except Exception as e:
+        log.error(f"Erro no job de emissão {job_id_str}: {e}")
+        log.error(traceback.format_exc())
+        _encerrar_job(job_id, {"status": "error", "msg": f"Falha ao gerar XMLs: {e}",
+                               "erros": erros + [{"erro": str(e)}]})
+
+
 # --- Endpoints de Emissão  ---
 @router.post("/confirmar-from-drafts")
-def notas_confirmar_from_drafts(payload: Dict[str, Any] = Body(...),
+def notas_confirmar_from_drafts(background_tasks: BackgroundTasks, payload: Dict[str, Any] = Body(...),
                                 current_user: UserInDB = Depends(get_current_user)):
     user_id = ObjectId(current_user.id)
     emitter_id = payload.get("emitterId")
@@ -218,95 +548,85 @@ def notas_confirmar_from_drafts(payload: Dict[str, Any] = Body(...),
 
     if not drafts_to_emit: raise HTTPException(status_code=404, detail="Nenhum rascunho 'pending' encontrado")
 
-    created, task_ids, erros = 0, [], []
-    for d in drafts_to_emit:
-        try:
-            client_id = d.get("client_id")
-            if not client_id:
-                raise ValueError("Draft sem client_id")
+    # Reserva atômica antes de agendar: um segundo clique não emite os mesmos drafts de novo
+    job_id = ObjectId()
+    drafts_to_emit = _reservar_drafts(job_id, drafts_to_emit)
+    if not drafts_to_emit:
+        raise HTTPException(status_code=409, detail="Os rascunhos selecionados já estão em emissão")
 
-            # --- ? Busca o cliente, aceitando string ou ObjectId ---
-            try:
-                client = db.clients.find_one({"_id": ObjectId(client_id), "user_id": user_id})
-            except Exception:
-                client = db.clients.find_one({"_id": client_id, "user_id": user_id})
-
-            if not client:
-                # tenta localizar o "tomador não identificado"
-                client = db.clients.find_one({
-                    "nao_identificado": True,
-                    "emissores_ids": emitter_id,
-                    "user_id": user_id
-                })
-            if not client:
-                raise ValueError("Cliente não encontrado")
-
-            # --- ? CTN fallback ---
-            ctn6 = _ctn_to_6digits(d.get("cod_servico")) or "010101"
-
-            # --- ? Dados do serviço ---
-            service_data = {
-                "descricao": d["descricao"],
-                "valor": float(d.get("valor") or 0),
-                "cTribNac": ctn6,
-                "aliquota": aliquota_atual,
-                "municipioIbge": d.get("municipio_ibge"),
-                "issRetido": d.get("iss_retido"),
-            }
+    # A montagem/assinatura roda em background (pool de processos); o front acompanha pelo job
+    try:
+        _criar_job_emissao(user_id, emitter_id, "drafts", len(drafts_to_emit), job_id=job_id)
+    except Exception:
+        _liberar_drafts(job_id)
+        raise
+    background_tasks.add_task(processar_emissao, str(job_id), emitter_id, current_user.id, "drafts",
+                              drafts_to_emit, aliquota_atual)
+    return {"msg": "Geração iniciada", "job_id": str(job_id), "total": len(drafts_to_emit)}
 
-            # --- ? Gera o XML e assina ---
-            dps = next_dps(db, emitter_id, serie="1")
-            competencia_raw = d.get("competencia") or d.get("dataEmissao")
-            competencia_formatada, _ = _normalize_competencia(competencia_raw, fallback_today=True)
-            xml = build_nfse_xml(
-                emitter, client, service_data,
-                numero_dps=dps["numero"], serie_dps=dps["serie"],
-                competencia=competencia_formatada,
-                data_emissao=d.get("dataEmissao")
-            )
 
-            pfx_pwd = emitter.get("senha_certificado") or ""
-            xml_signed = assinar_xml(xml, pfx_path=emitter["certificado_path"], pfx_password=pfx_pwd)
+def _valor_invalido(valor) -> bool:
+    return not valor or valor <= 0
 
-            # --- ? Cria a task ---
-            task = {
-                "user_id": user_id,
-                "type": "emit_nfse",
-                "emitter_id": emitter_id,
-                "client_id": str(client["_id"]),
-                "valor": float(d.get("valor") or 0),
-                "status": "pending",
-                "created_at": datetime.utcnow(),
-                "dps": {"serie": dps["serie"], "numero": dps["numero"], "status": "reservado"},
-                "competencia": competencia_formatada,
-                "response": {"xml": xml_signed, "valor": float(d.get("valor") or 0)},
-                "source": {"kind": "draft", "draft_id": str(d["_id"])},
-            }
 
-            res = db.tasks.insert_one(task)
-            task_id = str(res.inserted_id)
-            task_ids.append(task_id)
-            created += 1
+def _resolver_linhas_preview(df: pd.DataFrame, emitter_id: str, user_id: ObjectId) -> Tuple[list, dict]:
+    """
+    Valida as linhas da prévia e resolve os clientes em lote: uma consulta $in para CPFs,
+    outra para CNPJs (e o tomador não identificado só se alguma linha vier sem documento).
+    Devolve as linhas (mesmo formato/erros da validação linha a linha) e {clienteId: cliente}.
+    """
+    docs = df["cpf_cnpj"].map(sanitize_document)
+    tamanhos = docs.fillna("").map(len)
+    sem_descricao = ~df["descricao"].astype(bool)
+
+    # --- Clientes: uma ida ao banco por tipo de documento ---
+    clientes_por_doc = {}
+    for campo, tamanho in (("cpf", 11), ("cnpj", 14)):
+        alvo = docs[tamanhos == tamanho].unique().tolist()
+        if not alvo:
+            continue
+        cursor = db.clients.find({campo: {"$in": alvo}, "user_id": user_id, "ativo": {"$ne": False}})
+        for c in cursor:
+            # mantém o primeiro encontrado, como o find_one fazia
+            clientes_por_doc.setdefault(c.get(campo), c)
+
+    anonimo = None
+    if (~docs.astype(bool)).any():
+        anonimo = db.clients.find_one({"nao_identificado": True, "emissores_ids": emitter_id, "user_id": user_id})
+
+    # to_float direto no map: devolver None faria o pandas converter a coluna para NaN
+    valor_invalido = df["valor"].map(lambda v: _valor_invalido(to_float(v)))
+
+    linhas, clientes_por_id = [], {}
+    registros = df.to_dict("records")
+    for pos, (row, doc_digits, tamanho, v_invalido, s_desc) in enumerate(
+            zip(registros, docs, tamanhos, valor_invalido, sem_descricao)):
+        erros = []
 
-            # --- ? Marca o draft como consumido ---
-            db.tasks_draft.update_one(
-                {"_id": d["_id"]},
-                {"$set": {"status": "consumed", "consumed_at": datetime.utcnow(), "task_id": task_id}}
-            )
+        if doc_digits:
+            cliente = clientes_por_doc.get(doc_digits) if tamanho in (11, 14) else None
+            if not cliente:
+                erros.append("Cliente não encontrado ou está inativo")
+        else:
+            cliente = anonimo
 
+        if v_invalido:
+            erros.append("Valor inválido")
+        if s_desc:
+            erros.append("Descrição obrigatória")
 
-        except Exception as e:
-            import traceback
-            log.error(f"Erro ao gerar task do draft {d.get('_id')}: {e}")
-            log.error(traceback.format_exc())
-            erros.append({"draft_id": str(d.get("_id")), "erro": str(e)})
+        if cliente:
+            clientes_por_id[str(cliente["_id"])] = cliente
 
-    if created == 1:
-        msg = "1 solicitação criada com sucesso"
-    else:
-        msg = f"{created} solicitações criadas com sucesso"
+        linhas.append({
+            "index": pos + 2,
+            "ok": len(erros) == 0,
+            "erros": erros,
+            "clienteId": str(cliente["_id"]) if cliente else None,
+            **row,
+        })
 
-    return {"msg": msg, "task_ids": task_ids, "erros": erros}
+    return linhas, clientes_por_id
 
 
 @router.post("/preview")
@@ -335,7 +655,6 @@ async def notas_preview(emitterId: str = Form(...), competenciaDefault: Optional
 
     if filename.endswith(".json"):
         try:
-            import json
             data = json.loads(content.decode("utf-8"))
             if not isinstance(data, list):
                 data = [data]  # garante lista única
@@ -359,45 +678,7 @@ async def notas_preview(emitterId: str = Form(...), competenciaDefault: Optional
     if not all(c in df.columns for c in ["cpf_cnpj", "valor", "descricao"]):
         raise HTTPException(status_code=400, detail="Colunas obrigatórias ausentes: cpf_cnpj, valor, descricao")
 
-    linhas = []
-    for idx, row in df.iterrows():
-        erros = []
-        doc_digits = sanitize_document(row.get("cpf_cnpj"))
-
-        cliente = None
-        if doc_digits:
-            if len(doc_digits) == 11:
-                cliente = db.clients.find_one({
-                    "cpf": doc_digits,
-                    "user_id": user_id,
-                    "ativo": {"$ne": False}
-                })
-            elif len(doc_digits) == 14:
-                cliente = db.clients.find_one({
-                    "cnpj": doc_digits,
-                    "user_id": user_id,
-                    "ativo": {"$ne": False}
-                })
-
-        if not cliente and not doc_digits:
-            cliente = db.clients.find_one({"nao_identificado": True, "emissores_ids": emitterId, "user_id": user_id})
-        elif not cliente:
-            erros.append("Cliente não encontrado ou está inativo")
-
-        valor = to_float(row.get("valor"))
-        if not valor or valor <= 0:
-            erros.append("Valor inválido")
-        if not row.get("descricao"):
-            erros.append("Descrição obrigatória")
-
-        linha = {
-            "index": idx + 2,
-            "ok": len(erros) == 0,
-            "erros": erros,
-            "clienteId": str(cliente["_id"]) if cliente else None,
-            **row.to_dict(),
-        }
-        linhas.append(linha)
+    linhas, clientes_por_id = _resolver_linhas_preview(df, emitterId, user_id)
 
     # ? Se for JSON (input manual) e linha válida ? salva automaticamente no tasks_draft
     if filename.endswith(".json") and persist_flag:
@@ -458,6 +739,7 @@ async def notas_preview(emitterId: str = Form(...), competenciaDefault: Optional
     # ? Se for planilha (XLSX/CSV) e linha válida ? também salva automaticamente nos drafts
     if not filename.endswith(".json"):
         todas = [l for l in linhas if l.get("clienteId")]
+        upserts = []
         for l in todas:
             # competência: usa a da linha ou o default do form
             comp_raw = l.get("dataemissao") or l.get("competencia") or competenciaDefault
@@ -487,7 +769,7 @@ async def notas_preview(emitterId: str = Form(...), competenciaDefault: Optional
                 "uniq_key": uniq_key,
                 "cod_servico": l.get("cod_servico") or "01.01.01",
                 "aliquota": aliquota_padrao,
-                "municipio_ibge": cliente.get("codigoIbge") if cliente else None,
+                "municipio_ibge": clientes_por_id[l["clienteId"]].get("codigoIbge"),
                 "pais_prestacao": l.get("pais_prestacao") or "BRASIL",
                 "iss_retido": l.get("iss_retido") or False,
                 "created_at": datetime.utcnow(),
@@ -506,11 +788,15 @@ async def notas_preview(emitterId: str = Form(...), competenciaDefault: Optional
             }
 
             # upsert p/ manter idempotência dentro do preview
-            db.tasks_draft.update_one(
+            upserts.append(UpdateOne(
                 {"uniq_key": uniq_key, "user_id": user_id, "status": status},
                 {"$set": draft_doc},
                 upsert=True
-            )
+            ))
+
+        # ordered: linhas repetidas no mesmo arquivo continuam sobrescrevendo na ordem da planilha
+        if upserts:
+            db.tasks_draft.bulk_write(upserts, ordered=True)
 
     return {
         "linhas": linhas,
@@ -521,7 +807,8 @@ async def notas_preview(emitterId: str = Form(...), competenciaDefault: Optional
 
 
 @router.post("/confirmar")
-def notas_confirmar(payload: dict = Body(...), current_user: UserInDB = Depends(get_current_user)):
+def notas_confirmar(background_tasks: BackgroundTasks, payload: dict = Body(...),
+                    current_user: UserInDB = Depends(get_current_user)):
     user_id = ObjectId(current_user.id)
     emitter_id = payload.get("emitterId")
     items = payload.get("items") or []
@@ -532,50 +819,34 @@ def notas_confirmar(payload: dict = Body(...), current_user: UserInDB = Depends(
         raise HTTPException(status_code=404, detail="Emissor não encontrado ou não pertence ao seu usuário")
     if not emitter.get("certificado_path"): raise HTTPException(status_code=400, detail="Emissor sem certificado")
 
-    created, task_ids, erros = 0, [], []
-    for it in items:
+    # Mesmos itens com um job ainda em andamento (duplo clique, POST repetido) não geram outro lote
+    chave = hashlib.sha256(
+        json.dumps([emitter_id, items], sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    chave = f"{user_id}:{chave}"
+    try:
+        job_id = _criar_job_emissao(user_id, emitter_id, "itens", len(items), chave=chave)
+    except DuplicateKeyError:
+        # o job que segura a chave pode ter morrido sem ninguém consultar o status
+        anterior = db.emissoes.find_one({"chave_ativa": chave})
+        if anterior and _expirar_job_se_parado(anterior).get("status") in ("pending", "running"):
+            raise HTTPException(status_code=409, detail="Estes itens já estão em emissão")
         try:
-            if not it.get("ok"): raise ValueError("Linha inválida na prévia")
+            job_id = _criar_job_emissao(user_id, emitter_id, "itens", len(items), chave=chave)
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail="Estes itens já estão em emissão")
+    background_tasks.add_task(processar_emissao, str(job_id), emitter_id, current_user.id, "itens", items)
+    return {"msg": "Geração iniciada", "job_id": str(job_id), "total": len(items)}
 
-            client = db.clients.find_one({"_id": ObjectId(it["clienteId"]), "user_id": user_id})
-            if not client:
-                raise ValueError("Cliente não encontrado ou não pertence ao seu usuário")
-            service_data = {
-                "descricao": it["descricao"], "valor": float(it["valor"]), "cTribNac": it["cod_servico"],
-                "aliquota": it["aliquota"], "municipioIbge": it.get("municipio_ibge"),
-                "issRetido": it.get("iss_retido"),
-            }
-
-            dps = next_dps(db, emitter_id, serie="U")
-            xml = build_nfse_xml(
-                emitter, client, service_data,
-                numero_dps=dps["numero"], serie_dps=dps["serie"],
-                competencia=it["competencia"],
-                data_emissao=it.get("dataEmissao")
-            )
 
-            pfx_pwd = emitter.get("senha_certificado") or ""
-            xml_signed = assinar_xml(xml, pfx_path=emitter["certificado_path"], pfx_password=pfx_pwd)
-
-            task = {
-                "user_id": user_id, "type": "emit_nfse", "emitter_id": emitter_id, "client_id": it["clienteId"],
-                "valor": float(it["valor"]), "status": "pending", "created_at": datetime.utcnow(),
-                "dps": {"serie": dps["serie"], "numero": dps["numero"], "status": "reservado"},
-                "competencia": it["competencia"],
-                "response": {"xml": xml_signed, "valor": float(it["valor"])},
-            }
-            res = db.tasks.insert_one(task)
-            task_ids.append(str(res.inserted_id))
-            created += 1
-        except Exception as e:
-            erros.append({"index": it.get("index"), "erro": str(e)})
-
-    if created == 1:
-        msg = "1 solicitação criada com sucesso"
-    else:
-        msg = f"{created} solicitações criadas com sucesso"
-
-    return {"msg": msg, "task_ids": task_ids, "erros": erros}
+@router.get("/confirmar/status/{job_id}")
+def notas_confirmar_status(job_id: str, current_user: UserInDB = Depends(get_current_user)):
+    """Progresso de uma emissão em lote (msg, task_ids e erros ficam completos quando status = finished)."""
+    user_id = ObjectId(current_user.id)
+    job = db.emissoes.find_one({"_id": ObjectId(job_id), "user_id": user_id})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    return serialize_doc(_expirar_job_se_parado(job))
 
 
 @router.post("/enviar/{task_id}")
@@ -592,13 +863,21 @@ def notas_enviar_task(task_id: str = Path(...), current_user: UserInDB = Depends
             detail="Status atual não permite envio"
         )
 
+    # Reserva a task (lease) para o scheduler não transmiti-la ao mesmo tempo
+    task = reivindicar_task(db, {**task_query, "status": {"$in": ["pending", "error"]}}, novo_status="transmitting")
+    if not task:
+        raise HTTPException(status_code=409, detail="Task já está sendo transmitida")
+
     emitter = db.emitters.find_one({"_id": ObjectId(task["emitter_id"]), "user_id": user_id})
     if not emitter:
+        liberar_task(db, task)
         raise HTTPException(status_code=404,
                             detail="Emissor associado à task não encontrado ou não pertence ao seu usuário")
 
-    xml_assinado = (task.get("response") or {}).get("xml")
-    if not xml_assinado: raise HTTPException(status_code=400, detail="Task sem XML assinado")
+    xml_assinado = texto_campo(db, task.get("response"), "xml")
+    if not xml_assinado:
+        liberar_task(db, task)
+        raise HTTPException(status_code=400, detail="Task sem XML assinado")
 
     dps_b64 = gerar_dpsXmlGZipB64(xml_assinado)
     pfx_pwd = emitter.get("senha_certificado") or ""
@@ -647,35 +926,41 @@ def notas_enviar_task(task_id: str = Path(...), current_user: UserInDB = Depends
                 "chave_acesso": chave_acesso,
             }
         }
-        db.tasks.update_one(task_query, {"$set": update_set})
-
-        if new_status == "error":
-            raise HTTPException(status_code=502, detail=f"Falha na transmissão: {receipt.get('mensagem') or raw_resp}")
-
-        if new_status == "retry_dps":
-            return {"msg": "DPS já utilizada ? marcada como retry_dps", "status": "retry_dps"}
-
-        return {"msg": "Transmitido", "status": new_status, "receipt": receipt}
-
+        if new_status == "accepted":
+            update_set[CAMPO_NFSE] = extrair_campos_nfse(xml_nfse or xml_assinado)
 
     except Exception as e:
         erro_str = str(e)
         # Se for erro de conexão, devolve para pending para o scheduler pegar depois
         if "RemoteDisconnected" in erro_str or "Connection aborted" in erro_str or "ConnectionError" in erro_str:
-            db.tasks.update_one(
-                task_query,
+            finalizar_task(
+                db, task["_id"],
                 {"$set": {"status": "pending", "updated_at": datetime.utcnow()}}
             )
             raise HTTPException(status_code=503,
                                 detail="O Portal Nacional encerrou a conexão inesperadamente. A nota continuará na fila para envio automático.")
 
         # Outros erros vão para o status de error definitivo
-        db.tasks.update_one(
-            task_query,
+        finalizar_task(
+            db, task["_id"],
             {"$set": {"status": "error", "error_at": datetime.utcnow(), "transmit": {"error": erro_str}}}
         )
         raise HTTPException(status_code=502, detail=f"Falha ao transmitir: {erro_str}")
 
+    # Gravação fora do try do envio: a SEFIN já respondeu, e uma falha aqui não pode
+    # rebaixar o resultado (uma nota autorizada) para 'error'
+    if finalizar_task(db, task["_id"], descarregar_resultado(db, update_set, xml_assinado)):
+        registrar_mudanca_status(db, task, new_status)
+        TASKS_TRANSMITIDAS.inc(status=new_status)
+
+    if new_status == "error":
+        raise HTTPException(status_code=502, detail=f"Falha na transmissão: {receipt.get('mensagem') or raw_resp}")
+
+    if new_status == "retry_dps":
+        return {"msg": "DPS já utilizada ? marcada como retry_dps", "status": "retry_dps"}
+
+    return {"msg": "Transmitido", "status": new_status, "receipt": receipt}
+
 
 # --- ENDPOINTS DE CANCELAMENTO ---
 @router.post("/cancelar/{task_id}")
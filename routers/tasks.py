@@ -1,22 +1,27 @@
 from fastapi import APIRouter, HTTPException, Path, Depends, Query
 from fastapi.responses import StreamingResponse, PlainTextResponse
-import openpyxl
-from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
 from datetime import datetime
 from bson import ObjectId
 from db import db
-from utils import serialize_doc, extract_final_xml
+from utils import serialize_doc, extract_final_xml, filtro_ref, id_ref
 from models import UserInDB
 from dateutil import parser
 from routers.auth import get_current_user
-import xml.etree.ElementTree as ET
-import io
+from backend.zip_stream import gerar_zip, em_lotes, ZIP_LOTE_TASKS
+from backend.blob_store import existe, iterar, pdf_campo, texto_campo
+from backend.faturamento import registrar_mudanca_status, PROJECAO_FATURAMENTO
+from backend.xlsx_stream import gerar_xlsx, nome_aba
+from backend.nfse_campos import CAMPO_NFSE, campos_da_task
+import logging
+import os
 import re
 import json
+import threading
+import time
 import base64
-import zipfile
 
 router = APIRouter(prefix="/tasks", tags=["Tasks"])
+log = logging.getLogger(__name__)
 
 
 MESES_ABREV = {
@@ -24,6 +29,130 @@ MESES_ABREV = {
     7: "JUL", 8: "AGO", 9: "SET", 10: "OUT", 11: "NOV", 12: "DEZ"
 }
 
+# Campos lidos pelos downloads em lote (evita trazer o documento inteiro da task)
+_PROJECAO_ZIP_XML = {
+    "transmit.xml_nfse": 1, "transmit.xml_nfse_ref": 1,
+    "transmit.raw_response": 1, "transmit.raw_response_ref": 1,
+    "response.xml": 1, "response.xml_ref": 1,
+}
+_PROJECAO_ZIP_PDF = {
+    "transmit.pdf_base64": 1, "transmit.pdf_ref": 1, "client_id": 1, "competencia": 1, "created_at": 1
+}
+
+# Referências das tasks resolvidas por $lookup: alvo -> (collection, campo na task)
+_REFERENCIAS = {
+    "cliente": ("clients", lambda t: t.get("client_id")),
+    "emissor": ("emitters", lambda t: t.get("emitter_id")),
+    "draft": ("tasks_draft", lambda t: (t.get("source") or {}).get("draft_id")),
+}
+
+
+def _completar_referencias_legadas(docs: list, alvos: tuple):
+    """
+    Tasks ainda não migradas guardam os ids como string e não casam no $lookup.
+    Resolve essas referências com uma consulta $in por collection.
+    """
+    for alvo in alvos:
+        colecao, ref = _REFERENCIAS[alvo]
+        pendentes = [t for t in docs
+                     if not t.get(alvo) and isinstance(ref(t), str) and ObjectId.is_valid(ref(t))]
+        if not pendentes:
+            continue
+        ids = list({ObjectId(ref(t)) for t in pendentes})
+        encontrados = {d["_id"]: d for d in db[colecao].find({"_id": {"$in": ids}})}
+        for t in pendentes:
+            doc = encontrados.get(ObjectId(ref(t)))
+            if doc:
+                t[alvo] = doc
+
+
+def _com_referencias_legadas(cur, alvos: tuple):
+    for lote in em_lotes(cur):
+        _completar_referencias_legadas(lote, alvos)
+        yield from lote
+
+
+# Paginação do GET /tasks
+TASKS_LIMITE_PADRAO = 50
+TASKS_LIMITE_MAX = 500
+TASKS_CONTAGEM_TTL_SEGUNDOS = int(os.getenv("TASKS_CONTAGEM_TTL_SEGUNDOS", "30"))
+
+# Campos calculados da listagem e o que cada um precisa da task
+_CAMPOS_CLIENTE = {"cliente_nome", "cliente_email", "cliente_documento"}
+_CAMPOS_CALCULADOS = _CAMPOS_CLIENTE | {"emissor_nome", "has_pdf"}
+# Campos aceitos em `fields` (o resto do documento é interno ou pesado demais para a listagem)
+_CAMPOS_LISTAGEM = _CAMPOS_CALCULADOS | {
+    "status", "type", "valor", "competencia", "client_id", "emitter_id", "source", "retry_count",
+    "created_at", "sent_at", "error_at", "canceled_at", "updated_at",
+    "dps", "dps.numero", "dps.serie", "dps.status", CAMPO_NFSE,
+    "transmit.chave_acesso", "transmit.http_status", "transmit.id_dps", "transmit.error",
+    "transmit.receipt.numero_nfse", "transmit.receipt.protocolo", "transmit.receipt.codigo",
+    "transmit.receipt.mensagem", "transmit.receipt.erros",
+}
+_SUBCAMPO_NFSE = re.compile(rf"^{CAMPO_NFSE}\.[A-Za-z_][A-Za-z0-9_]*$")
+
+# Contagem por status de cada filtro (usuário, emissor, mês): {chave: (calculada_em, {status: n})}
+_contagens = {}
+_contagens_lock = threading.Lock()
+
+
+def _codificar_cursor(t: dict) -> str:
+    created_at = t.get("created_at")
+    bruto = json.dumps({"c": created_at.isoformat() if created_at else None, "i": str(t["_id"])})
+    return base64.urlsafe_b64encode(bruto.encode()).decode().rstrip("=")
+
+
+def _filtro_cursor(cursor: str) -> dict:
+    """Tasks depois do cursor na ordem (created_at desc, _id desc)."""
+    try:
+        dados = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        ultimo_id = ObjectId(dados["i"])
+        created_at = datetime.fromisoformat(dados["c"]) if dados.get("c") else None
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido.")
+
+    if created_at is None:
+        # created_at nulo fica no fim da ordem decrescente
+        return {"created_at": None, "_id": {"$lt": ultimo_id}}
+    return {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "_id": {"$lt": ultimo_id}},
+        {"created_at": None},
+    ]}
+
+
+def _contagem_por_status(q: dict, chave: tuple) -> dict:
+    """Contagem por status do filtro (sem o status), reaproveitada por TASKS_CONTAGEM_TTL_SEGUNDOS."""
+    agora = time.monotonic()
+    with _contagens_lock:
+        em_cache = _contagens.get(chave)
+        if em_cache and agora - em_cache[0] < TASKS_CONTAGEM_TTL_SEGUNDOS:
+            return em_cache[1]
+
+    pipeline = [{"$match": q}, {"$group": {"_id": "$status", "n": {"$sum": 1}}}]
+    contagem = {r["_id"] or "": r["n"] for r in db.tasks.aggregate(pipeline)}
+
+    with _contagens_lock:
+        # descarta entradas vencidas para o dicionário não crescer sem limite
+        for k in [k for k, (t0, _) in _contagens.items() if agora - t0 >= TASKS_CONTAGEM_TTL_SEGUNDOS]:
+            del _contagens[k]
+        _contagens[chave] = (agora, contagem)
+    return contagem
+
+
+def _clientes_da_busca(user_id: ObjectId, busca: str) -> list:
+    """Ids (nos dois formatos) dos clientes do usuário cujo nome ou CNPJ/CPF contém o termo."""
+    termo = re.escape(busca.strip())
+    digitos = re.sub(r"\D", "", busca)
+    condicoes = [{"nome": {"$regex": termo, "$options": "i"}},
+                 {"cnpj": {"$regex": termo}}, {"cpf": {"$regex": termo}}]
+    if digitos:
+        condicoes += [{"cnpj": {"$regex": digitos}}, {"cpf": {"$regex": digitos}}]
+    ids = []
+    for c in db.clients.find({"user_id": user_id, "$or": condicoes}, {"_id": 1}):
+        ids += [c["_id"], str(c["_id"])]
+    return ids
+
 
 @router.get("")
 def list_tasks(
@@ -31,15 +160,23 @@ def list_tasks(
         status: str | None = None,
         mes: int | None = Query(None, ge=1, le=12),
         ano: int | None = Query(None, ge=2000),
+        busca: str | None = None,
+        limit: int = Query(TASKS_LIMITE_PADRAO, ge=1, le=TASKS_LIMITE_MAX),
+        cursor: str | None = None,
+        fields: str | None = Query(None, description="Campos separados por vírgula (ex.: status,valor,cliente_nome)"),
         current_user: UserInDB = Depends(get_current_user)
 ):
+    """
+    Lista as tasks em páginas de `limit`, da mais recente para a mais antiga (keyset em
+    created_at + _id). `next_cursor` vem preenchido enquanto houver mais páginas; `total` e
+    `por_status` vêm de uma contagem em cache curto, para a primeira página não depender do
+    tamanho do histórico.
+    """
     user_id = ObjectId(current_user.id)
     q = {"user_id": user_id}
 
     if emitterId:
-        q["emitter_id"] = emitterId
-    if status:
-        q["status"] = status
+        q["emitter_id"] = filtro_ref(emitterId)
 
     if mes and ano:
         inicio = datetime(ano, mes, 1)
@@ -50,64 +187,84 @@ def list_tasks(
             "$lt": fim.strftime("%Y-%m-%d"),
         }
 
-    pipeline = [
-        {"$match": q},
-        {"$sort": {"created_at": -1}},
+    if busca and busca.strip():
+        q["client_id"] = {"$in": _clientes_da_busca(user_id, busca)}
 
-        # --- Tratamento de IDs ---
-        {"$addFields": {
-            "client_id_obj": {
-                "$cond": {
-                    "if": {
-                        "$and": [
-                            {"$ne": ["$client_id", None]},
-                            {"$regexMatch": {"input": "$client_id", "regex": "^[0-9a-fA-F]{24}$"}}
-                        ]
-                    },
-                    "then": {"$toObjectId": "$client_id"},
-                    "else": None
-                }
-            },
-            "emitter_id_obj": {
-                "$cond": {
-                    "if": {
-                        "$and": [
-                            {"$ne": ["$emitter_id", None]},
-                            {"$regexMatch": {"input": "$emitter_id", "regex": "^[0-9a-fA-F]{24}$"}}
-                        ]
-                    },
-                    "then": {"$toObjectId": "$emitter_id"},
-                    "else": None
-                }
-            }
-        }},
+    # contagens: do filtro sem status (cards do dashboard); busca livre não entra no cache
+    if "client_id" in q:
+        por_status = {r["_id"] or "": r["n"] for r in db.tasks.aggregate(
+            [{"$match": q}, {"$group": {"_id": "$status", "n": {"$sum": 1}}}])}
+    else:
+        por_status = _contagem_por_status(dict(q), (str(user_id), emitterId, mes, ano))
+    total = por_status.get(status, 0) if status else sum(por_status.values())
 
-        # --- Lookups ---
-        {"$lookup": {
-            "from": "clients",
-            "localField": "client_id_obj",
-            "foreignField": "_id",
-            "as": "cliente"
-        }},
-        {"$unwind": {"path": "$cliente", "preserveNullAndEmptyArrays": True}},
+    if status:
+        q["status"] = status
 
-        {"$lookup": {
-            "from": "emitters",
-            "localField": "emitter_id_obj",
-            "foreignField": "_id",
-            "as": "emissor"
-        }},
-        {"$unwind": {"path": "$emissor", "preserveNullAndEmptyArrays": True}},
+    match = q
+    if cursor:
+        match = {"$and": [q, _filtro_cursor(cursor)]}
 
-        # --- OTIMIZAÇÃO DE PERFORMANCE (NOVO) ---
+    campos = {f.strip() for f in fields.split(",") if f.strip()} if fields else None
+    if campos is not None:
+        invalidos = sorted(c for c in campos if c not in _CAMPOS_LISTAGEM and not _SUBCAMPO_NFSE.match(c))
+        if invalidos:
+            raise HTTPException(status_code=400, detail=f"Campos não permitidos em fields: {', '.join(invalidos)}")
+    raizes = {c.split(".")[0] for c in campos} if campos is not None else None
+    precisa_cliente = campos is None or bool(campos & _CAMPOS_CLIENTE)
+    precisa_emissor = campos is None or "emissor_nome" in campos
+
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"created_at": -1, "_id": -1}},
+        {"$limit": limit + 1},
+    ]
+    if campos is not None:
+        # projeção: só o que foi pedido + o necessário para cursor, lookups e campos calculados
+        incluir = {c: 1 for c in campos - _CAMPOS_CALCULADOS}
+        incluir.update({"created_at": 1, "client_id": 1, "emitter_id": 1})
+        if "has_pdf" in campos:
+            incluir.update({"transmit.pdf_ref": 1, "transmit.pdf_base64": 1})
+        if "valor" in campos:
+            incluir["response.valor"] = 1
+        # caminho pai e filho juntos ("transmit" e "transmit.pdf_ref") colidem na projeção
+        incluir = {c: 1 for c in incluir if not any(c.startswith(f"{o}.") for o in incluir)}
+        pipeline.append({"$project": incluir})
+
+    # --- Lookups (só da página, e só se os campos pedidos precisarem) ---
+    if precisa_cliente:
+        pipeline += [
+            {"$lookup": {
+                "from": "clients",
+                "localField": "client_id",
+                "foreignField": "_id",
+                "as": "cliente"
+            }},
+            {"$unwind": {"path": "$cliente", "preserveNullAndEmptyArrays": True}},
+        ]
+    if precisa_emissor:
+        pipeline += [
+            {"$lookup": {
+                "from": "emitters",
+                "localField": "emitter_id",
+                "foreignField": "_id",
+                "as": "emissor"
+            }},
+            {"$unwind": {"path": "$emissor", "preserveNullAndEmptyArrays": True}},
+        ]
+
+    pipeline += [
         # 1. Calcula se tem PDF antes de remover o campo pesado
         {"$addFields": {
             "has_pdf_temp": {
                 "$cond": {
                     "if": {
-                        "$and": [
-                            {"$ifNull": ["$transmit.pdf_base64", False]},
-                            {"$ne": ["$transmit.pdf_base64", ""]}
+                        "$or": [
+                            {"$ifNull": ["$transmit.pdf_ref", False]},
+                            {"$and": [
+                                {"$ifNull": ["$transmit.pdf_base64", False]},
+                                {"$ne": ["$transmit.pdf_base64", ""]}
+                            ]}
                         ]
                     },
                     "then": True,
@@ -128,24 +285,17 @@ def list_tasks(
         }}
     ]
 
-    cur = db.tasks.aggregate(pipeline)
+    docs = list(db.tasks.aggregate(pipeline))
+    next_cursor = _codificar_cursor(docs[limit - 1]) if len(docs) > limit else None
+    docs = docs[:limit]
+    _completar_referencias_legadas(
+        docs, tuple(a for a, usa in (("cliente", precisa_cliente), ("emissor", precisa_emissor)) if usa)
+    )
     out = []
 
-    for t in cur:
+    for t in docs:
         t = serialize_doc(t)
 
-        # --- Fallback seguro: busca cliente direto se lookup falhou
-        if not t.get("cliente") and t.get("client_id"):
-            try:
-                if ObjectId.is_valid(t["client_id"]):
-                    cliente = db.clients.find_one({"_id": ObjectId(t["client_id"]), "user_id": user_id})
-                else:
-                    cliente = db.clients.find_one({"_id": t["client_id"], "user_id": user_id})
-            except Exception:
-                cliente = None
-            if cliente:
-                t["cliente"] = serialize_doc(cliente)
-
         # --- Preenche campos de exibição
         t["cliente_nome"] = t.get("cliente", {}).get("nome") or "-"
         t["cliente_email"] = t.get("cliente", {}).get("email") or "-"
@@ -163,9 +313,12 @@ def list_tasks(
         t.pop("has_pdf_temp", None)
         t.pop("cliente", None)
         t.pop("emissor", None)
+
+        if campos is not None:
+            t = {k: v for k, v in t.items() if k == "_id" or k in raizes}
         out.append(t)
 
-    return out
+    return {"items": out, "next_cursor": next_cursor, "total": total, "por_status": por_status}
 
 
 @router.get("/resumo")
@@ -179,34 +332,50 @@ def resumo_por_emissor(
     inicio = datetime(ano, mes, 1)
     fim = datetime(ano, mes + 1, 1) if mes < 12 else datetime(ano + 1, 1, 1)
 
+    # notas aceitas: já somadas por emissor no faturamento_mensal
+    grupos = {}
+    for f in db.faturamento_mensal.find({"user_id": user_id, "periodo": ano * 100 + mes},
+                                        {"emitter_id": 1, "total": 1, "notas": 1}):
+        g = grupos.setdefault(f["emitter_id"], {"total_notas": 0, "valor_total": 0.0})
+        g["total_notas"] += f.get("notas") or 0
+        g["valor_total"] += f.get("total") or 0.0
+
+    # na fila (pending/transmitting) ainda não entram no faturamento: agrega só essas tasks
     pipeline = [
         # FILTRO DE SEGURANÇA: Garante que o resumo é apenas da organização do usuário
         {"$match": {
             "user_id": user_id,
-            "status": {"$in": ["accepted", "pending"]},
+            "status": {"$in": ["pending", "transmitting"]},
             "$or": [
                 {"competencia": {"$gte": inicio.strftime("%Y-%m-%d"), "$lt": fim.strftime("%Y-%m-%d")}},
                 {"competencia": {"$gte": inicio, "$lt": fim}},
             ]
         }},
-        {"$addFields": {
-            "emitter_id_obj": {"$toObjectId": "$emitter_id"}
-        }},
-        {"$lookup": {
-            "from": "emitters", "localField": "emitter_id_obj",
-            "foreignField": "_id", "as": "emissor"
-        }},
-        {"$unwind": {"path": "$emissor", "preserveNullAndEmptyArrays": True}},
         {"$group": {
-            "_id": "$emissor._id",
-            "emissor_nome": {"$first": "$emissor.razaoSocial"},
+            "_id": "$emitter_id",
             "total_notas": {"$sum": 1},
             "valor_total": {"$sum": {"$ifNull": ["$response.valor", "$valor"]}},
         }},
-        {"$sort": {"valor_total": -1}}
     ]
+    for r in db.tasks.aggregate(pipeline):
+        g = grupos.setdefault(id_ref(r["_id"]), {"total_notas": 0, "valor_total": 0.0})
+        g["total_notas"] += r["total_notas"]
+        g["valor_total"] += r["valor_total"] or 0.0
+
+    nomes = {e["_id"]: e.get("razaoSocial")
+             for e in db.emitters.find({"_id": {"$in": [k for k in grupos if isinstance(k, ObjectId)]}},
+                                       {"razaoSocial": 1})}
+
+    # emissores não encontrados (removidos ou ids legados inválidos) ficam num grupo sem emissor
+    resumo = {}
+    for emitter_id, g in grupos.items():
+        chave = emitter_id if emitter_id in nomes else None
+        r = resumo.setdefault(chave, {"_id": chave, "emissor_nome": nomes.get(chave),
+                                      "total_notas": 0, "valor_total": 0.0})
+        r["total_notas"] += g["total_notas"]
+        r["valor_total"] += g["valor_total"]
 
-    return [serialize_doc(r) for r in db.tasks.aggregate(pipeline)]
+    return [serialize_doc(r) for r in sorted(resumo.values(), key=lambda r: r["valor_total"], reverse=True)]
 
 
 # ------------------------------------------------
@@ -226,7 +395,7 @@ def download_all_xml(
     }
 
     if emitterId:
-        q["emitter_id"] = emitterId
+        q["emitter_id"] = filtro_ref(emitterId)
 
     if task_ids:
         valid_ids = [ObjectId(tid) for tid in task_ids if ObjectId.is_valid(tid)]
@@ -253,20 +422,23 @@ def download_all_xml(
     else:
         raise HTTPException(status_code=400, detail="É necessário selecionar notas ou informar um período (mês/ano).")
 
-    cur = db.tasks.find(q)
-    mem = io.BytesIO()
+    cur = db.tasks.find(q, _PROJECAO_ZIP_XML).batch_size(ZIP_LOTE_TASKS)
 
-    with zipfile.ZipFile(mem, "w", zipfile.ZIP_DEFLATED) as zf:
+    def _arquivos():
         for t in cur:
             tr = t.get("transmit") or {}
-            xml_final = _pick_final_xml_from_transmit(tr, t)
+            try:
+                xml_final = _pick_final_xml_from_transmit(tr, t)
+            except Exception:
+                # blob ausente/ilegível: o ZIP já está sendo enviado, então a entrada é pulada
+                log.warning("XML da task %s indisponível no store; fora do ZIP", t["_id"], exc_info=True)
+                continue
             if not xml_final:
                 continue
-            zf.writestr(f"nfse_{t['_id']}.xml", xml_final)
+            yield f"nfse_{t['_id']}.xml", xml_final
 
-    mem.seek(0)
     return StreamingResponse(
-        mem,
+        gerar_zip(_arquivos()),
         media_type="application/zip",
         headers={"Content-Disposition": 'attachment; filename="xml.zip"'}
     )
@@ -288,7 +460,7 @@ def download_all_pdf(
     }
 
     if emitterId:
-        q["emitter_id"] = emitterId
+        q["emitter_id"] = filtro_ref(emitterId)
 
     if task_ids:
         valid_ids = [ObjectId(tid) for tid in task_ids if ObjectId.is_valid(tid)]
@@ -316,50 +488,57 @@ def download_all_pdf(
         raise HTTPException(status_code=400, detail="É necessário selecionar notas ou informar um período (mês/ano).")
 
     # Ordena por data de criação para que o (1), (2) siga a ordem de emissão
-    cur = db.tasks.find(q).sort("created_at", 1)
+    cur = db.tasks.find(q, _PROJECAO_ZIP_PDF).sort("created_at", 1).batch_size(ZIP_LOTE_TASKS)
+
+    return StreamingResponse(
+        gerar_zip(_arquivos_pdf(cur)),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=danfs.zip"}
+    )
+
 
-    mem = io.BytesIO()
+def _docs_clientes(client_ids: set) -> dict:
+    """Busca CNPJ/CPF (só dígitos) de vários clientes numa consulta: {client_id str: doc}."""
+    ids = [ObjectId(c) if ObjectId.is_valid(c) else c for c in client_ids]
+    docs = {}
+    for cli in db.clients.find({"_id": {"$in": ids}}, {"cnpj": 1, "cpf": 1}):
+        raw_doc = cli.get("cnpj") or cli.get("cpf") or ""
+        # Remove pontuação, deixa só números
+        clean_doc = "".join(filter(str.isdigit, raw_doc))
+        if clean_doc:
+            docs[str(cli["_id"])] = clean_doc
+    return docs
 
+
+def _arquivos_pdf(cur):
+    """Gera (nome, pdf) na ordem do cursor, resolvendo os clientes de cada lote de uma vez."""
     # Cache de clientes (CNPJ/CPF)
     client_cache = {}
 
     # Controle de contadores para nomes repetidos
     filename_counters = {}
 
-    with zipfile.ZipFile(mem, "w", zipfile.ZIP_DEFLATED) as zf:
-        for t in cur:
-            tr = t.get("transmit") or {}
-            pdf_b64 = tr.get("pdf_base64")
-
-            if not pdf_b64:
-                continue
+    for lote in em_lotes(cur):
+        novos = {str(t["client_id"]) for t in lote if t.get("client_id")} - client_cache.keys()
+        if novos:
+            encontrados = _docs_clientes(novos)
+            for cid_str in novos:
+                client_cache[cid_str] = encontrados.get(cid_str, "DOC")
 
+        for t in lote:
+            tr = t.get("transmit") or {}
             try:
-                pdf_bytes = base64.b64decode(pdf_b64)
+                pdf_bytes = pdf_campo(db, tr)
             except Exception:
+                log.warning("DANFSe da task %s indisponível no store; fora do ZIP", t["_id"], exc_info=True)
                 continue
 
-            # --- 1. BUSCA DOC DO CLIENTE ---
-            doc_cliente = "DOC"
-            client_id = t.get("client_id")
+            if not pdf_bytes:
+                continue
 
-            if client_id:
-                cid_str = str(client_id)
-                if cid_str in client_cache:
-                    doc_cliente = client_cache[cid_str]
-                else:
-                    try:
-                        cid_obj = ObjectId(client_id) if ObjectId.is_valid(client_id) else client_id
-                        cli = db.clients.find_one({"_id": cid_obj}, {"cnpj": 1, "cpf": 1})
-                        if cli:
-                            raw_doc = cli.get("cnpj") or cli.get("cpf") or ""
-                            # Remove pontuação, deixa só números
-                            clean_doc = "".join(filter(str.isdigit, raw_doc))
-                            if clean_doc:
-                                doc_cliente = clean_doc
-                        client_cache[cid_str] = doc_cliente
-                    except:
-                        pass
+            # --- 1. DOC DO CLIENTE ---
+            client_id = t.get("client_id")
+            doc_cliente = client_cache.get(str(client_id), "DOC") if client_id else "DOC"
 
             # --- 2. FORMATA A DATA ---
             mes_str = "MES"
@@ -393,15 +572,7 @@ def download_all_pdf(
                 filename_counters[base_filename] = count
                 final_filename = f"{base_filename}({count}).pdf"
 
-            # Escreve no ZIP
-            zf.writestr(final_filename, pdf_bytes)
-
-    mem.seek(0)
-    return StreamingResponse(
-        mem,
-        media_type="application/zip",
-        headers={"Content-Disposition": "attachment; filename=danfs.zip"}
-    )
+            yield final_filename, pdf_bytes
 
 
 # -------------------------------------------------
@@ -417,6 +588,15 @@ def download_xml(task_id: str = Path(...), current_user: UserInDB = Depends(get_
         raise HTTPException(status_code=404, detail="Task não encontrada")
 
     tr = task.get("transmit") or {}
+    headers = {"Content-Disposition": f'attachment; filename="nfse_{task_id}.xml"'}
+
+    # XML já no store: repassa direto, sem montar a string inteira
+    if not tr.get("xml_nfse") and tr.get("xml_nfse_ref"):
+        if not existe(db, tr["xml_nfse_ref"]):
+            log.warning("XML da task %s referenciado mas ausente no store", task_id)
+            raise HTTPException(status_code=404, detail="XML da nota não encontrado no armazenamento.")
+        return StreamingResponse(iterar(db, tr["xml_nfse_ref"]), media_type="application/xml", headers=headers)
+
     xml_nfse = _pick_final_xml_from_transmit(tr)
     if not xml_nfse:
         raise HTTPException(status_code=400, detail="Task ainda não possui XML final para download.")
@@ -437,18 +617,21 @@ def download_guia(task_id: str = Path(...), current_user: UserInDB = Depends(get
     if not task:
         raise HTTPException(status_code=404, detail="Task não encontrada")
 
-    # Verifica Base64 (Na memória)
+    # PDF no store (pdf_ref) é repassado em pedaços; o Base64 legado é decodificado
     tr = task.get("transmit") or {}
-    pdf_b64 = tr.get("pdf_base64")
-    if not pdf_b64:
+    if tr.get("pdf_base64"):
+        try:
+            conteudo = [base64.b64decode(tr["pdf_base64"])]
+        except Exception:
+            raise HTTPException(status_code=400, detail="PDF inválido.")
+    elif tr.get("pdf_ref"):
+        if not existe(db, tr["pdf_ref"]):
+            log.warning("DANFSe da task %s referenciado mas ausente no store", task_id)
+            raise HTTPException(status_code=404, detail="Guia não encontrada no armazenamento.")
+        conteudo = iterar(db, tr["pdf_ref"])
+    else:
         raise HTTPException(status_code=400, detail="Guia ainda não disponível.")
 
-    # Decodifica (Processamento CPU - Rápido)
-    try:
-        pdf_bytes = base64.b64decode(pdf_b64)
-    except Exception:
-        raise HTTPException(status_code=400, detail="PDF inválido.")
-
     # --- MONTAGEM DO NOME (Otimizado) ---
     doc_cliente = "DOC"
 
@@ -492,7 +675,7 @@ def download_guia(task_id: str = Path(...), current_user: UserInDB = Depends(get
     filename = f"{doc_cliente}_NF_{mes_str}_{ano_str}.pdf"
 
     return StreamingResponse(
-        io.BytesIO(pdf_bytes),
+        conteudo,
         media_type="application/pdf",
         headers={"Content-Disposition": f'attachment; filename="{filename}"'}
     )
@@ -506,11 +689,14 @@ def delete_task(task_id: str, current_user: UserInDB = Depends(get_current_user)
     user_id = ObjectId(current_user.id)
     query = {"_id": ObjectId(task_id), "user_id": user_id}
 
-    result = db.tasks.delete_one(query)
+    removida = db.tasks.find_one_and_delete(query, projection=PROJECAO_FATURAMENTO)
 
-    if result.deleted_count == 0:
+    if not removida:
         raise HTTPException(status_code=404, detail="Task não encontrada ou já removida")
 
+    # excluir uma nota aceita tira o valor do faturamento do mês
+    registrar_mudanca_status(db, removida, "deleted")
+
     return {"msg": "Task descartada com sucesso"}
 
 
@@ -521,17 +707,17 @@ def _pick_final_xml_from_transmit(tr: dict, task: dict | None = None) -> str | N
     if not tr:
         return None
 
-    # 1) XML final puro já pronto
-    xml_nfse = tr.get("xml_nfse")
+    # 1) XML final puro já pronto (inline ou no store)
+    xml_nfse = texto_campo(db, tr, "xml_nfse")
     if xml_nfse:
         return xml_nfse
 
     # ✅ 2) Fallback legado: response.xml (unitário usa isso)
-    xml_legacy = (task.get("response") or {}).get("xml") if task else None
+    xml_legacy = texto_campo(db, task.get("response"), "xml") if task else None
     if xml_legacy:
         return xml_legacy
 
-    raw = tr.get("raw_response")
+    raw = texto_campo(db, tr, "raw_response")
     if not raw:
         return None
 
@@ -555,6 +741,47 @@ def _pick_final_xml_from_transmit(tr: dict, task: dict | None = None) -> str | N
     return extract_final_xml(raw)
 
 
+_CABECALHO_EXPORT = [
+    "STATUS", "CHAVE DE ACESSO", "Nº DPS", "Nº NFSe", "DATA DE ENVIO",
+    "DATA DE CANCELAMENTO", "VALOR", "ALÍQUOTA (%)", "PRESTADOR",
+    "CNPJ PRESTADOR", "TOMADOR", "CNPJ/CPF TOMADOR", "REGIME DE TRIBUTAÇÃO",
+    "NATUREZA DA OPERAÇÃO", "ISS RETIDO", "DESCRIÇÃO DOS SERVIÇOS",
+    "CÓDIGO DA ATIVIDADE", "CIDADE TOMADOR", "ENDEREÇO TOMADOR"
+]
+
+# num_format por coluna (índice 0-based): datas de envio/cancelamento, valor e alíquota
+_FORMATOS_EXPORT = {4: 'dd/mm/yyyy hh:mm:ss', 5: 'dd/mm/yyyy hh:mm:ss', 6: '#,##0.00', 7: '0.00'}
+
+
+def _format_activity_code(code):
+    if not code:
+        return ""
+    clean = re.sub(r'\D', '', str(code))
+    if len(clean) == 6:
+        return f"{clean[:2]}.{clean[2:4]}.{clean[4:]}"
+    return str(code)
+
+
+def _safe_date(val):
+    if not val: return None
+    if isinstance(val, datetime):
+        return val.replace(tzinfo=None)
+    try:
+        dt = parser.parse(str(val))
+        return dt.replace(tzinfo=None)
+    except:
+        return str(val)
+
+
+def _safe_float(val):
+    if val is None or val == "":
+        return None
+    try:
+        return float(val)
+    except:
+        return None
+
+
 @router.get("/export")
 def export_xlsx(
         mes: int = Query(..., ge=1, le=12),
@@ -578,358 +805,139 @@ def export_xlsx(
     }
 
     if emitterId:
-        filtro["emitter_id"] = emitterId
+        filtro["emitter_id"] = filtro_ref(emitterId)
 
     # --- Pipeline ---
     pipeline = [
         {"$match": filtro},
-        {"$addFields": {
-            "client_id_obj": {
-                "$cond": {
-                    "if": {"$regexMatch": {"input": "$client_id", "regex": "^[0-9a-fA-F]{24}$"}},
-                    "then": {"$toObjectId": "$client_id"},
-                    "else": None
-                }
-            },
-            "emitter_id_obj": {
-                "$cond": {
-                    "if": {"$regexMatch": {"input": "$emitter_id", "regex": "^[0-9a-fA-F]{24}$"}},
-                    "then": {"$toObjectId": "$emitter_id"},
-                    "else": None
-                }
-            },
-            "draft_id_obj": {
-                "$cond": {
-                    "if": {
-                        "$and": [
-                            {"$ne": ["$source.draft_id", None]},
-                            {"$regexMatch": {"input": "$source.draft_id", "regex": "^[0-9a-fA-F]{24}$"}}
-                        ]
-                    },
-                    "then": {"$toObjectId": "$source.draft_id"},
-                    "else": None
-                }
-            }
-        }},
-        {"$lookup": {"from": "clients", "localField": "client_id_obj", "foreignField": "_id", "as": "cliente"}},
+        {"$project": {"transmit.raw_response": 0, "transmit.pdf_base64": 0, "transmit.receipt.bruto": 0}},
+        {"$lookup": {"from": "clients", "localField": "client_id", "foreignField": "_id", "as": "cliente"}},
         {"$unwind": {"path": "$cliente", "preserveNullAndEmptyArrays": True}},
-        {"$lookup": {"from": "emitters", "localField": "emitter_id_obj", "foreignField": "_id", "as": "emissor"}},
+        {"$lookup": {"from": "emitters", "localField": "emitter_id", "foreignField": "_id", "as": "emissor"}},
         {"$unwind": {"path": "$emissor", "preserveNullAndEmptyArrays": True}},
-        {"$lookup": {"from": "tasks_draft", "localField": "draft_id_obj", "foreignField": "_id", "as": "draft"}},
+        {"$lookup": {"from": "tasks_draft", "localField": "source.draft_id", "foreignField": "_id", "as": "draft"}},
         {"$unwind": {"path": "$draft", "preserveNullAndEmptyArrays": True}},
         {"$sort": {"emissor.razaoSocial": 1, "created_at": 1}}
     ]
 
-    cur = db.tasks.aggregate(pipeline)
-
-    # --- Configuração do Excel ---
-    wb = openpyxl.Workbook()
-    if wb.active:
-        wb.remove(wb.active)
-
-    HEADER = [
-        "STATUS", "CHAVE DE ACESSO", "Nº DPS", "Nº NFSe", "DATA DE ENVIO",
-        "DATA DE CANCELAMENTO", "VALOR", "ALÍQUOTA (%)", "PRESTADOR",
-        "CNPJ PRESTADOR", "TOMADOR", "CNPJ/CPF TOMADOR", "REGIME DE TRIBUTAÇÃO",
-        "NATUREZA DA OPERAÇÃO", "ISS RETIDO", "DESCRIÇÃO DOS SERVIÇOS",
-        "CÓDIGO DA ATIVIDADE", "CIDADE TOMADOR", "ENDEREÇO TOMADOR"
-    ]
-
-    # Estilos
-    header_fill = PatternFill(start_color="DDDDDD", end_color="DDDDDD", fill_type="solid")
-    header_border = Border(
-        left=Side(border_style="thin"), right=Side(border_style="thin"),
-        top=Side(border_style="thin"), bottom=Side(border_style="thin"),
-    )
-    header_font = Font(bold=True)
-    header_align = Alignment(horizontal="center")
-
-    sheets_map = {}
-
-    def get_or_create_sheet(emissor_nome):
-        clean_name = re.sub(r'[\\/*?:\[\]]', '', emissor_nome or "Sem Emissor")[:30]
-        if clean_name not in sheets_map:
-            ws = wb.create_sheet(title=clean_name)
-            ws.append(HEADER)
-            for col in range(1, len(HEADER) + 1):
-                c = ws.cell(row=1, column=col)
-                c.font = header_font
-                c.fill = header_fill
-                c.border = header_border
-                c.alignment = header_align
-            sheets_map[clean_name] = ws
-        return sheets_map[clean_name]
-
-    # --- Helpers ---
-    def format_activity_code(code):
-        if not code:
-            return ""
-        clean = re.sub(r'\D', '', str(code))
-        if len(clean) == 6:
-            return f"{clean[:2]}.{clean[2:4]}.{clean[4:]}"
-        return str(code)
-
-    def safe_date(val):
-        if not val: return None
-        if isinstance(val, datetime):
-            return val.replace(tzinfo=None)
-        try:
-            dt = parser.parse(str(val))
-            return dt.replace(tzinfo=None)
-        except:
-            return str(val)
-
-    def safe_float(val):
-        if val is None or val == "":
-            return None
-        try:
-            return float(val)
-        except:
-            return None
-
-    # --- PARSER ROBUSTO (XML + REGEX) ---
-    def parse_nfse_data(xml_content):
-        """
-        Extrai dados do XML usando ElementTree.
-        Se falhar ou não encontrar campos chave, usa Regex como fallback.
-        """
-        data = {}
-        if not xml_content:
-            return data
-
-        # 1. Tentativa Estruturada (ElementTree)
-        try:
-            ns = {"n": "http://www.sped.fazenda.gov.br/nfse"}
-            # Remove possíveis caracteres BOM ou sujeira antes do <
-            clean_xml = xml_content[xml_content.find("<"):]
-            root = ET.fromstring(clean_xml)
-
-            # Busca com namespace
-            aliq_tag = root.find(".//n:pTotTribSN", ns) or root.find(".//n:pAliq", ns) or root.find(".//n:Aliquota", ns)
-            if aliq_tag is not None:
-                data['aliquota'] = aliq_tag.text
-
-            vserv_tag = root.find(".//n:vServ", ns)
-            if vserv_tag is not None:
-                data['valor'] = vserv_tag.text
-
-            iss_tag = root.find(".//n:tpRetISSQN", ns)
-            if iss_tag is not None:
-                data['iss_retido'] = (iss_tag.text == "1")
-
-            desc_tag = root.find(".//n:xDescServ", ns)
-            if desc_tag is not None:
-                data['descricao'] = desc_tag.text
-
-            cod_tag = root.find(".//n:cTribNac", ns)
-            if cod_tag is not None:
-                data['cod_servico'] = cod_tag.text
-
-            nat_desc = root.find(".//n:xTribNac", ns)
-            if nat_desc is not None:
-                data['natureza'] = nat_desc.text
-
-            toma = root.find(".//n:toma", ns)
-            if toma is not None:
-                xNome = toma.find(".//n:xNome", ns)
-                if xNome is not None:
-                    data['tomador_nome'] = xNome.text
-
-                cnpj = toma.find(".//n:CNPJ", ns)
-                cpf = toma.find(".//n:CPF", ns)
-                data['tomador_doc'] = (cnpj.text if cnpj is not None else (cpf.text if cpf is not None else ""))
-
-                end = toma.find(".//n:end", ns)
-                if end is not None:
-                    lgr = end.find(".//n:xLgr", ns)
-                    nro = end.find(".//n:nro", ns)
-                    bairro = end.find(".//n:xBairro", ns)
-                    mun = end.find(".//n:xMun", ns)
-
-                    lgr_t = lgr.text if lgr is not None else ""
-                    nro_t = nro.text if nro is not None else ""
-                    bairro_t = bairro.text if bairro is not None else ""
-                    data['tomador_end'] = f"{lgr_t} {nro_t} {bairro_t}".strip()
-                    if mun is not None: data['tomador_cidade'] = mun.text
-
-        except Exception:
-            # Se der erro no parse estruturado, não faz nada e deixa o regex salvar
-            pass
-
-        # 2. Fallback Bruto (Regex) - "Salva-vidas"
-        # Se a alíquota não foi encontrada via estrutura, busca no texto bruto
-        if data.get('aliquota') is None:
-            match = re.search(r'<(?:pTotTribSN|pAliq|Aliquota)>([\d\.]+)</', xml_content)
-            if match:
-                data['aliquota'] = match.group(1)
-
-        if data.get('descricao') is None:
-            match = re.search(r'<xDescServ>(.*?)</xDescServ>', xml_content, re.DOTALL | re.IGNORECASE)
-            if match:
-                data['descricao'] = match.group(1)
-
-        if data.get('valor') is None:
-            match = re.search(r'<vServ>([\d\.]+)</', xml_content)
-            if match:
-                data['valor'] = match.group(1)
-
-        if data.get('iss_retido') is None:
-            if "<tpRetISSQN>1</tpRetISSQN>" in xml_content:
-                data['iss_retido'] = True
-            elif "<tpRetISSQN>2</tpRetISSQN>" in xml_content:
-                data['iss_retido'] = False
-
-        return data
-
-    has_data = False
+    # allowDiskUse: o $sort depois dos $lookup passa do limite de memória do estágio em meses grandes
+    cur = db.tasks.aggregate(pipeline, allowDiskUse=True)
 
-    for t in cur:
-        has_data = True
-        t = serialize_doc(t)
-
-        tr = t.get("transmit") or {}
-        receipt = tr.get("receipt") or {}
-        dps_resumo = t.get("dps") or {}
-        cliente = t.get("cliente") or {}
-        emissor = t.get("emissor") or {}
-        draft = t.get("draft") or {}
-
-        ws = get_or_create_sheet(emissor.get("razaoSocial"))
-
-        xml_text = (tr.get("xml_nfse") or (t.get("response") or {}).get("xml"))
-
-        # Extração de Dados
-        xml_data = parse_nfse_data(xml_text)
-
-        # --- Consolidação ---
-
-        # Alíquota
-        aliquota_val = safe_float(xml_data.get('aliquota'))
-        if aliquota_val is None:
-            aliquota_val = safe_float(t.get("aliquota"))
-        if aliquota_val is None:
-            aliquota_val = safe_float(draft.get("aliquota"))
-
-        # Valor
-        valor_val = safe_float(xml_data.get('valor'))
-        if valor_val is None:
-            valor_val = safe_float(t.get("valor"))
-
-        # ISS Retido
-        iss_retido_val = xml_data.get('iss_retido')
-        if iss_retido_val is None:
-            iss_retido_val = t.get("iss_retido")
-        if iss_retido_val is None:
-            iss_retido_val = draft.get("iss_retido")
-        iss_retido_str = "Sim" if iss_retido_val is True else ("Não" if iss_retido_val is False else "")
-
-        # Descrição
-        descricao = xml_data.get('descricao')
-        if not descricao:
-            descricao = t.get("descricao")
-        if not descricao:
-            descricao = draft.get("descricao") or ""
-
-        # Limpeza de quebras de linha (solicitado)
-        if descricao:
-            descricao = " ".join(descricao.split())
-
-        # Código Serviço
-        cod_servico_raw = xml_data.get('cod_servico')
-        if not cod_servico_raw:
-            cod_servico_raw = t.get("cod_servico")
-        if not cod_servico_raw:
-            cod_servico_raw = draft.get("cod_servico") or ""
-        cod_servico_final = format_activity_code(cod_servico_raw)
-
-        # Dados do Tomador
-        tomador_nome = xml_data.get('tomador_nome') or cliente.get("nome") or ""
-        tomador_doc = xml_data.get('tomador_doc') or cliente.get("cnpj") or cliente.get("cpf") or ""
-        tomador_end = xml_data.get('tomador_end')
-        if not tomador_end:
-            tomador_end = f"{cliente.get('logradouro', '')} {cliente.get('numero', '')} {cliente.get('bairro', '')}".strip()
-        tomador_cidade = xml_data.get('tomador_cidade') or cliente.get("cidade") or ""
-
-        natureza_texto = xml_data.get('natureza') or ""
-
-        regime_raw = emissor.get("regimeTributacao", "")
-        regime_map = {
-            "Simples Nacional": "Simples Nacional", "MEI": "MEI",
-            "Lucro Presumido": "Lucro Presumido", "Lucro Real": "Lucro Real",
-        }
-        regime = regime_map.get(regime_raw, regime_raw)
+    def _linhas():
+        for t in _com_referencias_legadas(cur, ("cliente", "emissor", "draft")):
+            t = serialize_doc(t)
 
-        status_raw = t.get("status", "")
-        status_map_label = {
-            "accepted": "AUTORIZADA", "rejected": "REJEITADA",
-            "canceled": "CANCELADA", "error": "ERRO",
-            "pending": "PENDENTE", "processing": "PROCESSANDO"
-        }
-        status_final = status_map_label.get(status_raw, status_raw.upper())
-
-        data_envio = safe_date(t.get("sent_at") or t.get("created_at"))
-        data_canc = safe_date(t.get("canceled_at"))
-
-        row = [
-            status_final,
-            tr.get("chave_acesso") or receipt.get("chave_acesso") or "",
-            dps_resumo.get("numero") or "",
-            receipt.get("numero_nfse") or "",
-            data_envio,
-            data_canc,
-            valor_val,
-            aliquota_val,
-            emissor.get("razaoSocial", ""),
-            emissor.get("cnpj", ""),
-            tomador_nome,
-            tomador_doc,
-            regime,
-            natureza_texto,
-            iss_retido_str,
-            descricao,
-            cod_servico_final,
-            tomador_cidade,
-            tomador_end
-        ]
+            tr = t.get("transmit") or {}
+            receipt = tr.get("receipt") or {}
+            dps_resumo = t.get("dps") or {}
+            cliente = t.get("cliente") or {}
+            emissor = t.get("emissor") or {}
+            draft = t.get("draft") or {}
+
+            # Campos da NFS-e gravados na aceitação; o XML só é lido para tasks sem o
+            # subdocumento (não autorizadas, ou antigas ainda fora do backfill)
+            xml_data = t.get(CAMPO_NFSE)
+            if xml_data is None:
+                xml_data = campos_da_task(db, t)
+
+            # --- Consolidação ---
+
+            # Alíquota
+            aliquota_val = _safe_float(xml_data.get('aliquota'))
+            if aliquota_val is None:
+                aliquota_val = _safe_float(t.get("aliquota"))
+            if aliquota_val is None:
+                aliquota_val = _safe_float(draft.get("aliquota"))
+
+            # Valor
+            valor_val = _safe_float(xml_data.get('valor'))
+            if valor_val is None:
+                valor_val = _safe_float(t.get("valor"))
+
+            # ISS Retido
+            iss_retido_val = xml_data.get('iss_retido')
+            if iss_retido_val is None:
+                iss_retido_val = t.get("iss_retido")
+            if iss_retido_val is None:
+                iss_retido_val = draft.get("iss_retido")
+            iss_retido_str = "Sim" if iss_retido_val is True else ("Não" if iss_retido_val is False else "")
+
+            # Descrição
+            descricao = xml_data.get('descricao')
+            if not descricao:
+                descricao = t.get("descricao")
+            if not descricao:
+                descricao = draft.get("descricao") or ""
+
+            # Limpeza de quebras de linha (solicitado)
+            if descricao:
+                descricao = " ".join(descricao.split())
+
+            # Código Serviço
+            cod_servico_raw = xml_data.get('cod_servico')
+            if not cod_servico_raw:
+                cod_servico_raw = t.get("cod_servico")
+            if not cod_servico_raw:
+                cod_servico_raw = draft.get("cod_servico") or ""
+            cod_servico_final = _format_activity_code(cod_servico_raw)
+
+            # Dados do Tomador
+            tomador_nome = xml_data.get('tomador_nome') or cliente.get("nome") or ""
+            tomador_doc = xml_data.get('tomador_doc') or cliente.get("cnpj") or cliente.get("cpf") or ""
+            tomador_end = xml_data.get('tomador_end')
+            if not tomador_end:
+                tomador_end = f"{cliente.get('logradouro', '')} {cliente.get('numero', '')} {cliente.get('bairro', '')}".strip()
+            tomador_cidade = xml_data.get('tomador_cidade') or cliente.get("cidade") or ""
+
+            natureza_texto = xml_data.get('natureza') or ""
+
+            regime_raw = emissor.get("regimeTributacao", "")
+            regime_map = {
+                "Simples Nacional": "Simples Nacional", "MEI": "MEI",
+                "Lucro Presumido": "Lucro Presumido", "Lucro Real": "Lucro Real",
+            }
+            regime = regime_map.get(regime_raw, regime_raw)
+
+            status_raw = t.get("status", "")
+            status_map_label = {
+                "accepted": "AUTORIZADA", "rejected": "REJEITADA",
+                "canceled": "CANCELADA", "error": "ERRO",
+                "pending": "PENDENTE", "processing": "PROCESSANDO",
+                "transmitting": "TRANSMITINDO"
+            }
+            status_final = status_map_label.get(status_raw, status_raw.upper())
+
+            data_envio = _safe_date(t.get("sent_at") or t.get("created_at"))
+            data_canc = _safe_date(t.get("canceled_at"))
+
+            row = [
+                status_final,
+                tr.get("chave_acesso") or receipt.get("chave_acesso") or "",
+                dps_resumo.get("numero") or "",
+                receipt.get("numero_nfse") or "",
+                data_envio,
+                data_canc,
+                valor_val,
+                aliquota_val,
+                emissor.get("razaoSocial", ""),
+                emissor.get("cnpj", ""),
+                tomador_nome,
+                tomador_doc,
+                regime,
+                natureza_texto,
+                iss_retido_str,
+                descricao,
+                cod_servico_final,
+                tomador_cidade,
+                tomador_end
+            ]
 
-        ws.append(row)
-
-        current_row = ws.max_row
-        ws.cell(row=current_row, column=5).number_format = 'dd/mm/yyyy hh:mm:ss'
-        ws.cell(row=current_row, column=6).number_format = 'dd/mm/yyyy hh:mm:ss'
-        ws.cell(row=current_row, column=7).number_format = '#,##0.00'
-        ws.cell(row=current_row, column=8).number_format = '0.00'
-        # Removido alinhamento wrap_text
-
-    if not has_data:
-        wb.create_sheet("Sem Dados")
-
-    for ws in wb.worksheets:
-        for col_cells in ws.columns:
-            col_letter = col_cells[0].column_letter
-            length = 0
-            for c in col_cells:
-                val_str = str(c.value) if c.value is not None else ""
-                # Limita tamanho para cálculo de largura
-                line_len = len(val_str)
-                if line_len > length:
-                    length = line_len
-
-            final_width = length + 2
-            if final_width > 60:
-                final_width = 60
-            if final_width < 10:
-                final_width = 10
-            ws.column_dimensions[col_letter].width = final_width
-
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
+            yield nome_aba(emissor.get("razaoSocial")), row
 
     filename = f"nfse_{str(mes).zfill(2)}{ano}.xlsx"
 
     return StreamingResponse(
-        output,
+        gerar_xlsx(_CABECALHO_EXPORT, _linhas(), _FORMATOS_EXPORT),
         media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
@@ -0,0 +1,7 @@
+import os
+
+from cryptography.fernet import Fernet
+
+# utils exige a chave já no import; os testes não leem .env
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+os.environ.setdefault("SECRET_KEY", "teste")
@@ -0,0 +1,87 @@
+from concurrent.futures.process import BrokenProcessPool
+
+import mongomock
+import pytest
+from bson import ObjectId
+
+import routers.notas as notas
+
+
+TAMANHO = 2
+
+
+def _preparados(n):
+    return [{
+        "ref": {"index": i},
+        "client": {"nome": f"Cliente {i}"},
+        "service": {"descricao": "Serviço", "valor": 10.0},
+        "competencia": "2026-10",
+        "data_emissao": None,
+        "task": {"client_id": str(ObjectId()), "valor": 10.0, "competencia": "2026-10"},
+    } for i in range(n)]
+
+
+@pytest.fixture
+def banco(monkeypatch):
+    db = mongomock.MongoClient().db
+    monkeypatch.setattr(notas, "db", db)
+    return db
+
+
+def _pool_falso(falha_no_pedaco):
+    """Substitui montar_e_assinar: entrega pedaços de TAMANHO itens e quebra no pedaço indicado."""
+    def montar_e_assinar(emitter, itens, ao_concluir_pedaco=None):
+        for n, inicio in enumerate(range(0, len(itens), TAMANHO)):
+            if n == falha_no_pedaco:
+                raise BrokenProcessPool("filho morreu")
+            pedaco = itens[inicio:inicio + TAMANHO]
+            ao_concluir_pedaco(inicio, [(True, f"<xml>{it['numero_dps']}</xml>") for it in pedaco])
+    return montar_e_assinar
+
+
+def _job(db):
+    return db.emissoes.insert_one({"status": "running"}).inserted_id
+
+
+def test_segundo_pedaco_falha_registra_resto_do_bloco(banco, monkeypatch):
+    monkeypatch.setattr(notas, "montar_e_assinar", _pool_falso(falha_no_pedaco=1))
+    emitter = {"_id": ObjectId()}
+
+    with pytest.raises(BrokenProcessPool):
+        notas._emitir_preparados(_job(banco), emitter, ObjectId(), _preparados(5), "1", [])
+
+    assert sorted(t["dps"]["numero"] for t in banco.tasks.find()) == [1, 2]
+    lacunas = list(banco.dps_lacunas.find())
+    assert sorted(l["numero"] for l in lacunas) == [3, 4, 5]
+    assert {l["motivo"] for l in lacunas} == {"job abortado"}
+    assert {l["serie"] for l in lacunas} == {"00001"}
+    assert {l["emitter_id"] for l in lacunas} == {str(emitter["_id"])}
+
+
+def test_erro_do_mongo_no_segundo_pedaco_nao_duplica_lacunas(banco, monkeypatch):
+    monkeypatch.setattr(notas, "montar_e_assinar", _pool_falso(falha_no_pedaco=None))
+    insert_many = banco.tasks.insert_many
+    chamadas = []
+
+    def insert_many_falha_no_segundo(docs, *args, **kwargs):
+        chamadas.append(docs)
+        if len(chamadas) == 2:
+            raise RuntimeError("Mongo indisponível")
+        return insert_many(docs, *args, **kwargs)
+
+    monkeypatch.setattr(banco.tasks, "insert_many", insert_many_falha_no_segundo)
+
+    with pytest.raises(RuntimeError):
+        notas._emitir_preparados(_job(banco), {"_id": ObjectId()}, ObjectId(), _preparados(5), "1", [])
+
+    assert sorted(t["dps"]["numero"] for t in banco.tasks.find()) == [1, 2]
+    assert sorted(l["numero"] for l in banco.dps_lacunas.find()) == [3, 4, 5]
+
+
+def test_lote_completo_nao_registra_lacuna(banco, monkeypatch):
+    monkeypatch.setattr(notas, "montar_e_assinar", _pool_falso(falha_no_pedaco=None))
+
+    criadas, _ = notas._emitir_preparados(_job(banco), {"_id": ObjectId()}, ObjectId(), _preparados(5), "1", [])
+
+    assert criadas == 5
+    assert banco.dps_lacunas.count_documents({}) == 0
@@ -0,0 +1,27 @@
+from datetime import datetime, timedelta
+
+import mongomock
+
+import backend.faturamento as faturamento
+from backend.faturamento import TRAVA_RECONSTRUCAO, carregar_faturamento_se_vazio
+
+
+def test_carga_inicial_so_com_collection_vazia(monkeypatch):
+    db = mongomock.MongoClient().db
+    monkeypatch.setattr(faturamento, "_reconstruir", lambda db, emitter_id=None: 3)
+
+    assert carregar_faturamento_se_vazio(db) == 3
+    assert db.travas.count_documents({}) == 0
+
+    db.faturamento_mensal.insert_one({"_id": "x", "total": 1.0})
+    assert carregar_faturamento_se_vazio(db) is None
+
+
+def test_carga_inicial_pula_com_trava_de_outra_replica(monkeypatch):
+    db = mongomock.MongoClient().db
+    db.travas.insert_one({"_id": TRAVA_RECONSTRUCAO, "expira_em": datetime.utcnow() + timedelta(hours=1)})
+    chamadas = []
+    monkeypatch.setattr(faturamento, "_reconstruir", lambda db, emitter_id=None: chamadas.append(1) or 0)
+
+    assert carregar_faturamento_se_vazio(db) is None
+    assert chamadas == []
@@ -1,4 +1,3 @@
-from cryptography.hazmat.primitives.serialization import pkcs12
 from cryptography.fernet import Fernet
 from fastapi import HTTPException
 from datetime import datetime
@@ -14,6 +13,7 @@ import base64
 from weasyprint import HTML
 import unicodedata
 from dotenv import load_dotenv
+from backend.cert_cache import carregar_certificado
 
 load_dotenv()
 
@@ -69,13 +69,22 @@ def serialize_doc(doc):
     return doc
 
 
+def id_ref(valor):
+    """Id de referência como gravado nas tasks: ObjectId quando o valor é um id válido."""
+    if isinstance(valor, str) and ObjectId.is_valid(valor):
+        return ObjectId(valor)
+    return valor
+
+
+def filtro_ref(valor) -> dict:
+    """Filtro que casa a referência no formato novo (ObjectId) e no legado (string)."""
+    valor = str(valor)
+    return {"$in": [ObjectId(valor), valor]} if ObjectId.is_valid(valor) else {"$in": [valor]}
+
+
 def extrair_validade_certificado(filepath: str, senha: str) -> str:
     try:
-        with open(filepath, "rb") as f:
-            data = f.read()
-        _, certificate, _ = pkcs12.load_key_and_certificates(
-            data, senha.encode() if senha else None
-        )
+        certificate = carregar_certificado(filepath, senha).certificate
         if not certificate:
             raise HTTPException(status_code=400, detail="Certificado inválido")
         return certificate.not_valid_after.strftime("%Y-%m-%d")
@@ -114,25 +123,54 @@ def find_cliente_by_doc(db, doc: str):
 
 
 def next_dps(db, emitter_id: str, serie: str = "1"):
+    return next_dps_block(db, emitter_id, serie=serie, n=1)[0]
+
+
+def next_dps_block(db, emitter_id: str, serie: str = "1", n: int = 1) -> list:
+    """
+    Reserva n números de DPS contíguos com um único $inc no contador do emissor/série.
+    Devolve [{"serie", "numero"}, ...] em ordem crescente. Números reservados que não
+    virarem task devem ser registrados com registrar_dps_nao_usados.
+    """
     try:
         serie_num = int(serie)
     except ValueError:
         raise ValueError("Série do DPS deve ser numérica")
     serie_str = str(serie_num).zfill(5)
+    if n < 1:
+        return []
 
     key = f"{emitter_id}|{serie_str}"
     doc = db.dps_counters.find_one_and_update(
         {"_id": key},
         {
-            "$inc": {"next": 1},
+            "$inc": {"next": n},
             "$setOnInsert": {"emitterId": emitter_id, "serie": serie_str},
             "$set": {"updatedAt": datetime.utcnow()},
         },
         upsert=True,
         return_document=ReturnDocument.AFTER,
     )
-    numero = int(doc.get("next", 1))
-    return {"serie": serie_str, "numero": numero}
+    ultimo = int(doc.get("next", n))
+    return [{"serie": serie_str, "numero": numero} for numero in range(ultimo - n + 1, ultimo + 1)]
+
+
+def registrar_dps_nao_usados(db, emitter_id: str, serie: str, numeros: list, motivo: str = "",
+                             motivos: dict | None = None):
+    """
+    Registra em 'dps_lacunas' os números reservados que não viraram task (falha na
+    montagem/assinatura de um item do lote), para auditoria da sequência do emissor.
+    motivos ({numero: motivo}) permite um motivo por número num único insert.
+    """
+    if not numeros:
+        return
+    agora = datetime.utcnow()
+    motivos = motivos or {}
+    db.dps_lacunas.insert_many([
+        {"emitter_id": emitter_id, "serie": serie, "numero": numero, "motivo": motivos.get(numero, motivo),
+         "created_at": agora}
+        for numero in numeros
+    ], ordered=False)
 
 
 def normalize_label(s: str) -> str:
@@ -175,7 +213,110 @@ def canonical_from_label(label: str) -> str:
     return s_no_paren
 
 
+# Campos do retorno da SEFIN procurados no XML, em ordem de preferência (nome local da tag)
+_RESP_PROTOCOLO = ("protocolo", "numeroProtocolo", "nProtocolo")
+_RESP_NUMERO_NFSE = ("numeroNfse", "nNFSe", "NumeroNFSe")
+_RESP_CODIGO = ("codigo", "codigoRetorno", "status")
+_RESP_MENSAGEM = ("mensagem", "descricao", "message")
+_RESP_VALOR = ("valorServicos", "valorServico", "valor", "vServ")
+_RESP_LISTA_ERROS = ("erros", "Erros", "ListaErros")
+# Tabela de despacho da varredura: tags das quais basta a primeira ocorrência x tags das quais interessam todas
+_RESP_PRIMEIRA = frozenset(_RESP_PROTOCOLO + _RESP_NUMERO_NFSE + _RESP_CODIGO + _RESP_MENSAGEM + _RESP_VALOR)
+_RESP_TODAS = frozenset(_RESP_LISTA_ERROS + ("erro",))
+
+_RE_INICIO_RESPOSTA = re.compile(r"[\s\ufeff]*(\S)")
+
+
+def _nome_local(el) -> str | None:
+    tag = el.tag
+    return tag.rpartition("}")[2] if isinstance(tag, str) else None  # comentários/PIs não têm tag str
+
+
+def _inicio_resposta(raw) -> str:
+    """Primeiro caractere significativo do retorno (ignora espaços e BOM)."""
+    if isinstance(raw, (bytes, bytearray)):
+        raw = bytes(raw[:1024]).decode("utf-8", "ignore")
+    m = _RE_INICIO_RESPOSTA.match(raw)
+    return m.group(1) if m else ""
+
+
+def _parse_resposta_json(data: dict, out: dict) -> dict:
+    get = lambda *keys: next((str(data.get(k)) for k in keys if data.get(k) not in (None, "")), None)
+    out["protocolo"] = get("protocolo", "numeroProtocolo", "nProtocolo", "protocoloEnvio")
+    out["numero_nfse"] = get("numeroNfse", "nNFSe", "nfse", "numeroNFSe")
+    out["codigo"] = get("codigo", "cod", "codigoRetorno", "status", "statusCode")
+    out["mensagem"] = get("mensagem", "message", "descricao", "detalhe")
+    out["valor"] = data.get("valor") or data.get("valorServico")
+    errs = data.get("erros") or data.get("errosValidacao") or data.get("errors") or []
+    if isinstance(errs, dict):
+        errs = [": ".join([k, str(v)]) for k, v in errs.items()]
+    elif isinstance(errs, list):
+        errs = [str(e.get("mensagem") or e.get("message") or e) if isinstance(e, dict) else str(e) for e in errs]
+    else:
+        errs = [str(errs)]
+    out["erros"] = [e for e in errs if e]
+    out["success"] = bool(out["numero_nfse"] or out["protocolo"]) and not out["erros"]
+    return out
+
+
+def _parse_resposta_xml(raw, out: dict) -> dict:
+    root = ET.fromstring(raw.encode("utf-8") if isinstance(raw, str) else raw)
+
+    # Uma única varredura (descendentes da raiz, em ordem de documento)
+    primeiras, todas = {}, {}
+    for el in root.iterdescendants():
+        nome = _nome_local(el)
+        if nome in _RESP_PRIMEIRA:
+            if nome not in primeiras:
+                primeiras[nome] = el
+        elif nome in _RESP_TODAS:
+            todas.setdefault(nome, []).append(el)
+
+    def texto(nomes):
+        # primeira tag da lista que existir com texto; vazia/só espaços passa para a próxima
+        valor = None
+        for nome in nomes:
+            el = primeiras.get(nome)
+            valor = el.text.strip() if el is not None and el.text else None
+            if valor:
+                break
+        return valor
+
+    out["protocolo"] = texto(_RESP_PROTOCOLO)
+    out["numero_nfse"] = texto(_RESP_NUMERO_NFSE)
+    out["codigo"] = texto(_RESP_CODIGO)
+    out["mensagem"] = texto(_RESP_MENSAGEM)
+
+    # 🔹 inclui vServ
+    val_node = next((primeiras[n] for n in _RESP_VALOR if n in primeiras), None)
+    if val_node is not None:
+        try:
+            out["valor"] = float(val_node.text.strip().replace(",", "."))
+        except Exception:
+            pass
+
+    erros = []
+    for en in next((todas[n] for n in _RESP_LISTA_ERROS if n in todas), []):
+        for d in en.iterdescendants():
+            if _nome_local(d) in _RESP_MENSAGEM:
+                msgs = [d.text] + [c.tail for c in d]
+                erros.extend([m.strip() for m in msgs if m and m.strip()])
+    if not erros:
+        for en in todas.get("erro", []):
+            t = (en.text or "").strip()
+            if t:
+                erros.append(t)
+    out["erros"] = erros
+    out["success"] = bool(out["numero_nfse"] or out["protocolo"]) and not out["erros"]
+    return out
+
+
 def parse_nfse_response(raw: str) -> dict:
+    """
+    Resumo do retorno da SEFIN (JSON ou XML): protocolo, número da NFS-e, código, mensagem,
+    valor e erros. O formato é decidido pelo primeiro caractere; o XML é percorrido uma vez.
+    Retorno que não é nem um nem outro (ou inválido) volta só com os padrões e o bruto.
+    """
     out = {
         "success": False,
         "protocolo": None,
@@ -190,62 +331,15 @@ def parse_nfse_response(raw: str) -> dict:
     if not raw:
         return out
 
-    # JSON
+    inicio = _inicio_resposta(raw)
     try:
-        data = json.loads(raw)
-        get = lambda *keys: next((str(data.get(k)) for k in keys if data.get(k) not in (None, "")), None)
-        out["protocolo"] = get("protocolo", "numeroProtocolo", "nProtocolo", "protocoloEnvio")
-        out["numero_nfse"] = get("numeroNfse", "nNFSe", "nfse", "numeroNFSe")
-        out["codigo"] = get("codigo", "cod", "codigoRetorno", "status", "statusCode")
-        out["mensagem"] = get("mensagem", "message", "descricao", "detalhe")
-        out["valor"] = data.get("valor") or data.get("valorServico")
-        errs = data.get("erros") or data.get("errosValidacao") or data.get("errors") or []
-        if isinstance(errs, dict):
-            errs = [": ".join([k, str(v)]) for k, v in errs.items()]
-        elif isinstance(errs, list):
-            errs = [str(e.get("mensagem") or e.get("message") or e) for e in errs]
-        else:
-            errs = [str(errs)]
-        out["erros"] = [e for e in errs if e]
-        out["success"] = bool(out["numero_nfse"] or out["protocolo"]) and not out["erros"]
-        return out
+        if inicio == "{":
+            return _parse_resposta_json(json.loads(raw), out)
+        if inicio == "<":
+            return _parse_resposta_xml(raw, out)
     except Exception:
         pass
-
-    # XML
-    try:
-        root = ET.fromstring(raw.encode("utf-8") if isinstance(raw, str) else raw)
-        def x(tag): return root.xpath(f".//*[local-name()='{tag}']")
-        def text_first(nodes): return nodes[0].text.strip() if nodes and nodes[0].text else None
-
-        out["protocolo"] = text_first(x("protocolo")) or text_first(x("numeroProtocolo")) or text_first(x("nProtocolo"))
-        out["numero_nfse"] = text_first(x("numeroNfse")) or text_first(x("nNFSe")) or text_first(x("NumeroNFSe"))
-        out["codigo"] = text_first(x("codigo")) or text_first(x("codigoRetorno")) or text_first(x("status"))
-        out["mensagem"] = text_first(x("mensagem")) or text_first(x("descricao")) or text_first(x("message"))
-
-        # 🔹 inclui vServ
-        val_node = x("valorServicos") or x("valorServico") or x("valor") or x("vServ")
-        if val_node:
-            try:
-                out["valor"] = float(val_node[0].text.strip().replace(",", "."))
-            except Exception:
-                pass
-
-        erros_nodes = x("erros") or x("Erros") or x("ListaErros")
-        erros = []
-        for en in erros_nodes:
-            msgs = en.xpath(".//*[local-name()='mensagem' or local-name()='descricao' or local-name()='message']/text()")
-            erros.extend([m.strip() for m in msgs if m and m.strip()])
-        if not erros:
-            for en in x("erro"):
-                t = (en.text or "").strip()
-                if t:
-                    erros.append(t)
-        out["erros"] = erros
-        out["success"] = bool(out["numero_nfse"] or out["protocolo"]) and not out["erros"]
-        return out
-    except Exception:
-        return out
+    return out
 
 
 def extract_final_xml(raw_resp: str) -> str | None: